@@ -0,0 +1,158 @@
+"""
+BM25 inverted index over the text of the indexed nodes.
+The postings are kept in CSR arrays (the postings of term t are postings_docs[term_indptr[t]:term_indptr[t + 1]])
+persisted as .npy files and loaded with mmap.
+"""
+
+from collections import Counter
+import json
+import math
+import os
+import re
+
+import numpy as np
+from llama_index.core.schema import MetadataMode
+
+BM25_CONFIG_BASENAME = "bm25.json"
+BM25_ARRAYS = ["term_indptr", "postings_docs", "postings_tfs", "doc_lengths"]
+# Words, numbers and identifiers such as 820.30, 21-CFR or K123456/A
+TOKEN_PATTERN = re.compile(r"\w+(?:[./\-§]\w+)*")
+SUBTOKEN_PATTERN = re.compile(r"[./\-§]")
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase tokens. Identifiers are kept whole and also split into their parts, e.g. 820.30 -> 820.30, 820, 30."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        if SUBTOKEN_PATTERN.search(token):
+            tokens += [part for part in SUBTOKEN_PATTERN.split(token) if part]
+    return tokens
+
+
+class BM25Index:
+    """
+    :param node_ids: Ids of the indexed nodes.
+    :param vocabulary: {term: term id}.
+    :param term_indptr: (num_terms + 1,) int64 offsets of the postings of every term.
+    :param postings_docs: int32 positions in node_ids of the nodes containing the terms.
+    :param postings_tfs: float32 frequencies of the terms in these nodes.
+    :param doc_lengths: (num_nodes,) float32 number of tokens of every node.
+    :param k1: BM25 term frequency saturation.
+    :param b: BM25 length normalization.
+    """
+
+    def __init__(
+        self,
+        node_ids: list,
+        vocabulary: dict,
+        term_indptr: np.ndarray,
+        postings_docs: np.ndarray,
+        postings_tfs: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ) -> None:
+        self.node_ids = node_ids
+        self.vocabulary = vocabulary
+        self.term_indptr = term_indptr
+        self.postings_docs = postings_docs
+        self.postings_tfs = postings_tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = float(np.mean(doc_lengths)) if len(doc_lengths) else 0.0
+
+    @classmethod
+    def build(cls, nodes, k1: float = 1.2, b: float = 0.75):
+        """:param nodes: The indexed nodes."""
+        node_ids, doc_lengths = [], []
+        vocabulary = {}
+        term_ids, docs, tfs = [], [], []
+        for doc, node in enumerate(nodes):
+            node_ids.append(node.node_id)
+            tokens = tokenize(node.get_content(metadata_mode=MetadataMode.NONE))
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                docs.append(doc)
+                tfs.append(tf)
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind="stable")
+        term_indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocabulary)), out=term_indptr[1:])
+        return cls(
+            node_ids,
+            vocabulary,
+            term_indptr,
+            np.asarray(docs, dtype=np.int32)[order],
+            np.asarray(tfs, dtype=np.float32)[order],
+            np.asarray(doc_lengths, dtype=np.float32),
+            k1,
+            b,
+        )
+
+    def search(self, query: str, top_k: int):
+        """
+        :return: The (node_id, score) of the top_k nodes, sorted by descending BM25 score.
+        """
+        term_ids = {
+            self.vocabulary[term] for term in tokenize(query) if term in self.vocabulary
+        }
+        if not term_ids or top_k <= 0:
+            return []
+        num_docs = len(self.node_ids)
+        scores = np.zeros(num_docs, dtype=np.float32)
+        for term_id in term_ids:
+            start, end = self.term_indptr[term_id], self.term_indptr[term_id + 1]
+            docs = self.postings_docs[start:end]
+            tfs = self.postings_tfs[start:end]
+            doc_freq = end - start
+            idf = math.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+            norms = self.k1 * (
+                1 - self.b + self.b * self.doc_lengths[docs] / self.avg_doc_length
+            )
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norms)
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[
+                np.argpartition(-scores[candidates], top_k - 1)[:top_k]
+            ]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(self.node_ids[doc], float(scores[doc])) for doc in candidates]
+
+    @classmethod
+    def load(cls, persist_dir: str):
+        with open(
+            os.path.join(persist_dir, BM25_CONFIG_BASENAME), "r", encoding="utf-8"
+        ) as f:
+            data = json.loads(f.read())
+        arrays = [
+            np.load(os.path.join(persist_dir, f"{name}.npy"), mmap_mode="r")
+            for name in BM25_ARRAYS
+        ]
+        return cls(data["node_ids"], data["vocabulary"], *arrays, data["k1"], data["b"])
+
+    def persist(self, persist_dir: str) -> None:
+        os.makedirs(persist_dir, exist_ok=True)
+        # The current arrays may be memory-mapped from the target files
+        for name in BM25_ARRAYS:
+            array_path = os.path.join(persist_dir, f"{name}.npy")
+            with open(array_path + ".tmp", "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(array_path + ".tmp", array_path)
+        with open(
+            os.path.join(persist_dir, BM25_CONFIG_BASENAME), "w", encoding="utf-8"
+        ) as f:
+            f.write(
+                json.dumps(
+                    {
+                        "k1": self.k1,
+                        "b": self.b,
+                        "node_ids": self.node_ids,
+                        "vocabulary": self.vocabulary,
+                    }
+                )
+            )
@@ -1,21 +1,82 @@
 from autorag.indexer.expanded_indexer import ExpandedIndexer
+from autorag.indexer.sharded_indexer import ShardedIndexer
 from dotenv import load_dotenv
 import hydra
 from omegaconf import DictConfig
 
 
+def build_index(cur_cfg, index_dir, file_names=None):
+    pipeline_cfg = cur_cfg.get("pipeline_cfg", None)
+    dedup_cfg = cur_cfg.get("dedup_cfg", None)
+    if cur_cfg.incremental:
+        # Only reprocess the files changed since the last build of index_dir
+        expanded_indexer = ExpandedIndexer.update(
+            index_dir,
+            cur_cfg.data_dir,
+            cur_cfg.pre_processor_cfg,
+            cur_cfg.post_processor_cfg,
+            cur_cfg.embed_model_name,
+            cur_cfg.embedding_cache_cfg,
+            cur_cfg.embedding_cfg,
+            cur_cfg.vector_store_cfg,
+            file_names,
+            pipeline_cfg,
+            dedup_cfg,
+        )
+    elif (
+        pipeline_cfg
+        and pipeline_cfg.enable
+        and cur_cfg.pre_processor_cfg.pre_processor_type == "azure"
+    ):
+        # Parsing, embedding and writing overlap, and the build resumes from its last checkpoint
+        expanded_indexer = ExpandedIndexer.build_pipelined(
+            index_dir,
+            cur_cfg.data_dir,
+            cur_cfg.pre_processor_cfg,
+            cur_cfg.post_processor_cfg,
+            cur_cfg.embed_model_name,
+            cur_cfg.embedding_cache_cfg,
+            cur_cfg.embedding_cfg,
+            cur_cfg.vector_store_cfg,
+            pipeline_cfg,
+            file_names,
+            dedup_cfg,
+        )
+    else:
+        expanded_indexer = ExpandedIndexer.build(
+            cur_cfg.data_dir,
+            cur_cfg.pre_processor_cfg,
+            cur_cfg.post_processor_cfg,
+            cur_cfg.embed_model_name,
+            cur_cfg.embedding_cache_cfg,
+            cur_cfg.embedding_cfg,
+            cur_cfg.vector_store_cfg,
+            file_names,
+            dedup_cfg,
+        )
+    expanded_indexer.persist(index_dir)
+
+
 @hydra.main(version_base=None, config_path="../../conf", config_name="config")
 def main(cfg: DictConfig):
     # Extracting specific configuration values from the loaded configuration.
     cur_cfg = cfg.indexer.build
+    num_shards = cur_cfg.sharding_cfg.num_shards
 
-    expanded_indexer = ExpandedIndexer.build(
-        cur_cfg.data_dir,
-        cur_cfg.pre_processor_cfg,
-        cur_cfg.post_processor_cfg,
-        cur_cfg.embed_model_name,
-    )
-    expanded_indexer.persist(cur_cfg.index_dir)
+    if num_shards > 1:
+        shard_files = ShardedIndexer.partition_files(cur_cfg.data_dir, num_shards)
+        # Build a single shard if shard_id is set, e.g. to build shards on different machines
+        if cur_cfg.sharding_cfg.shard_id is not None:
+            shard_ids = [cur_cfg.sharding_cfg.shard_id]
+        else:
+            shard_ids = range(num_shards)
+        for shard_id in shard_ids:
+            print(f"Building shard {shard_id} ({len(shard_files[shard_id])} files)")
+            shard_dir = ShardedIndexer.get_shard_dir(cur_cfg.index_dir, shard_id)
+            build_index(cur_cfg, shard_dir, shard_files[shard_id])
+        ShardedIndexer.persist_sharding_config(cur_cfg.index_dir, num_shards)
+    else:
+        build_index(cur_cfg, cur_cfg.index_dir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+"""
+Pipelined index builds: parsing and chunking, embedding and writing to the index run
+concurrently, connected by bounded queues, and the build is checkpointed as it goes.
+"""
+
+import queue
+import threading
+import time
+from typing import Callable, Optional
+
+from llama_index.core import VectorStoreIndex
+
+from .dedup import NearDuplicateFilter
+from .embedding_pipeline import BatchEmbedder
+from .manifest import BuildManifest
+from .process.azure.output import AzureOutputProcessor
+from .process.utils.json import JsonFileLoader
+
+# Marks the end of the stream of a stage
+END_OF_STREAM = None
+# Seconds between two checks of the stop flag when a queue is full
+QUEUE_TIMEOUT = 0.1
+
+
+class BuildPipeline:
+    """
+    Streams files through three overlapping stages:
+    parsing/chunking (a background thread, or a process pool if the processor has workers),
+    embedding (a background thread, itself sending concurrent requests) and
+    writing to the index (the calling thread).
+
+    The queues between the stages are bounded, so a slow stage blocks the stages before it
+    and memory stays bounded by a few files and embedding batches.
+
+    :param processor: AzureOutputProcessor created with stream=True.
+    :param batch_embedder: The embedder of the nodes.
+    :param queue_size: Maximum number of items waiting between two stages.
+    :param embed_batch_nodes: Minimum number of nodes embedded at once, from one or several files.
+    :param checkpoint_interval: Number of written files between two checkpoints.
+    :param deduplicator: If provided, near-duplicate nodes are dropped before embedding and
+                         only added to the docstore.
+    """
+
+    def __init__(
+        self,
+        processor: AzureOutputProcessor,
+        batch_embedder: BatchEmbedder,
+        queue_size: int = 8,
+        embed_batch_nodes: int = 2048,
+        checkpoint_interval: int = 1000,
+        deduplicator: Optional[NearDuplicateFilter] = None,
+    ) -> None:
+        self.processor = processor
+        self.batch_embedder = batch_embedder
+        self.queue_size = queue_size
+        self.embed_batch_nodes = embed_batch_nodes
+        self.checkpoint_interval = checkpoint_interval
+        self.deduplicator = deduplicator
+        self._stop = threading.Event()
+        self._errors = []
+
+    @classmethod
+    def from_config(
+        cls,
+        processor: AzureOutputProcessor,
+        batch_embedder: BatchEmbedder,
+        pipeline_cfg=None,
+        deduplicator: Optional[NearDuplicateFilter] = None,
+    ):
+        pipeline_cfg = pipeline_cfg or {}
+        return cls(
+            processor,
+            batch_embedder,
+            queue_size=pipeline_cfg.get("queue_size", 8),
+            embed_batch_nodes=pipeline_cfg.get("embed_batch_nodes", 2048),
+            checkpoint_interval=pipeline_cfg.get("checkpoint_interval", 1000),
+            deduplicator=deduplicator,
+        )
+
+    def run(
+        self,
+        index: VectorStoreIndex,
+        manifest: BuildManifest,
+        file_hashes: dict[str, str],
+        checkpoint: Optional[Callable[[list], None]] = None,
+        duplicates: Optional[dict] = None,
+    ) -> int:
+        """
+        Processes, embeds and inserts the given files into the index. The manifest is
+        updated as files are written, so that it always describes the content of the index.
+
+        :param index: The index the nodes are inserted into.
+        :param manifest: The build manifest, updated with the written files.
+        :param file_hashes: {file_name: hash} of the files to process.
+        :param checkpoint: Called every checkpoint_interval written files, with the (file_name, file_hash, nodes)
+            of the files written since the previous call.
+        :param duplicates: Updated with the near duplicates of the written files.
+        :return: The number of inserted nodes.
+        """
+        file_names = {
+            JsonFileLoader.document_name(file_name): file_name
+            for file_name in file_hashes
+        }
+        parsed_queue = queue.Queue(maxsize=self.queue_size)
+        embedded_queue = queue.Queue(maxsize=self.queue_size)
+        self._stop.clear()
+        self._errors = []
+        threads = [
+            threading.Thread(
+                target=self._parse, args=(list(file_hashes), parsed_queue), daemon=True
+            ),
+            threading.Thread(
+                target=self._embed, args=(parsed_queue, embedded_queue), daemon=True
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+
+        start_time = time.monotonic()
+        num_files, num_nodes, written_files = 0, 0, []
+        try:
+            while True:
+                item = embedded_queue.get()
+                if item is END_OF_STREAM:
+                    break
+                batch, kept_nodes, batch_duplicates = item
+                if self.deduplicator is not None:
+                    # Near duplicates are only stored in the docstore, in their original order
+                    index.docstore.add_documents(
+                        [node for _, file_nodes in batch for node in file_nodes]
+                    )
+                    if duplicates is not None:
+                        duplicates.update(batch_duplicates)
+                index.insert_nodes(kept_nodes)
+                for document_name, file_nodes in batch:
+                    file_name = file_names[document_name]
+                    manifest.update(
+                        file_name,
+                        file_hashes[file_name],
+                        [node.node_id for node in file_nodes],
+                    )
+                    if checkpoint:
+                        written_files.append(
+                            (file_name, file_hashes[file_name], file_nodes)
+                        )
+                num_files += len(batch)
+                num_nodes += len(kept_nodes)
+                if checkpoint and len(written_files) >= self.checkpoint_interval:
+                    checkpoint(written_files)
+                    written_files = []
+                    print(
+                        f"Checkpoint: {num_files}/{len(file_hashes)} files, {num_nodes} nodes, "
+                        f"{round(time.monotonic() - start_time, 1)} seconds. "
+                        f"Embedding throughput: {self.batch_embedder.stats}"
+                    )
+        finally:
+            # Unblocks the stages if the writer failed
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+        if self._errors:
+            raise self._errors[0]
+
+        # Files without content produce no nodes, record them so they are not reprocessed
+        for file_name, file_hash in file_hashes.items():
+            if file_name not in manifest.files:
+                manifest.update(file_name, file_hash, [])
+        if self.deduplicator is not None:
+            print(f"Near-duplicate nodes: {self.deduplicator.stats}")
+        print(
+            f"Pipelined build: {len(file_hashes)} files, {num_nodes} nodes, "
+            f"{round(time.monotonic() - start_time, 1)} seconds. "
+            f"Embedding throughput: {self.batch_embedder.stats}"
+        )
+        return num_nodes
+
+    def _parse(self, file_names: list[str], parsed_queue: queue.Queue) -> None:
+        file_nodes_iter = self.processor.iter_file_nodes(file_names)
+        try:
+            for document_name, file_nodes in file_nodes_iter:
+                if not self._put(parsed_queue, (document_name, file_nodes)):
+                    return
+        except Exception as e:
+            self._errors.append(e)
+        finally:
+            # Shuts the process pool down if the pipeline was stopped early
+            file_nodes_iter.close()
+            self._put(parsed_queue, END_OF_STREAM)
+
+    def _embed(self, parsed_queue: queue.Queue, embedded_queue: queue.Queue) -> None:
+        try:
+            batch, batch_nodes = [], 0
+            while True:
+                item = self._get(parsed_queue)
+                if item is END_OF_STREAM:
+                    break
+                batch.append(item)
+                batch_nodes += len(item[1])
+                if batch_nodes >= self.embed_batch_nodes:
+                    if not self._put(embedded_queue, self._embed_batch(batch)):
+                        return
+                    batch, batch_nodes = [], 0
+            if batch and not self._errors:
+                self._put(embedded_queue, self._embed_batch(batch))
+        except Exception as e:
+            self._errors.append(e)
+        finally:
+            self._put(embedded_queue, END_OF_STREAM)
+
+    def _embed_batch(self, batch: list) -> tuple:
+        # Returns the batch, its nodes to index and its near duplicates
+        nodes = [node for _, file_nodes in batch for node in file_nodes]
+        batch_duplicates = {}
+        if self.deduplicator is not None:
+            nodes = self.deduplicator.filter(nodes)
+            kept_node_ids = {node.node_id for node in nodes}
+            batch_duplicates = {
+                node.node_id: self.deduplicator.duplicates[node.node_id]
+                for _, file_nodes in batch
+                for node in file_nodes
+                if node.node_id not in kept_node_ids
+            }
+        self.batch_embedder.embed_nodes(nodes, verbose=False)
+        return batch, nodes, batch_duplicates
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """Blocks until there is room in the queue, returns False if the pipeline was stopped."""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                continue
+        return END_OF_STREAM
@@ -0,0 +1,188 @@
+"""
+Near-duplicate node elimination for index builds, with MinHash signatures and LSH banding.
+"""
+
+import json
+import os
+import re
+import zlib
+from typing import Iterable, List
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class NearDuplicateFilter:
+    """
+    Drops the nodes whose text is a near duplicate of a node kept before, e.g. boilerplate
+    repeated on every page. The Jaccard similarity of the word shingles of two texts is
+    estimated with MinHash signatures, and LSH banding restricts the comparisons to the
+    nodes sharing at least one band of their signatures.
+
+    Dropped node ids are mapped to their kept representative in duplicates.
+
+    :param threshold: Minimum estimated Jaccard similarity of a near duplicate.
+    :param num_perm: Number of MinHash permutations, the length of the signatures.
+    :param shingle_size: Number of words per shingle.
+    :param seed: Seed of the permutations.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        num_perm: int = 128,
+        shingle_size: int = 5,
+        seed: int = 0,
+    ) -> None:
+        if not 0.0 < threshold <= 1.0:
+            raise ValueError(f"threshold must be in (0, 1], got {threshold}.")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        # (a * hash + b) % prime stays below 2**64 for 32-bit hashes and 31-bit a and b
+        self._a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+        self.num_bands, self.band_size = optimal_bands(threshold, num_perm)
+        # band key -> ids of the kept nodes, one dict per band
+        self._buckets = [{} for _ in range(self.num_bands)]
+        self._signatures = {}
+        self.duplicates = {}
+
+    @classmethod
+    def from_config(cls, dedup_cfg=None):
+        dedup_cfg = dedup_cfg or {}
+        return cls(
+            threshold=dedup_cfg.get("threshold", 0.9),
+            num_perm=dedup_cfg.get("num_perm", 128),
+            shingle_size=dedup_cfg.get("shingle_size", 5),
+        )
+
+    def signature(self, text: str) -> np.ndarray:
+        words = WORD_PATTERN.findall(text.lower())
+        k = self.shingle_size
+        shingles = {
+            " ".join(words[i : i + k]) for i in range(max(len(words) - k, 0) + 1)
+        }
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        permuted = (np.outer(hashes, self._a) + self._b) % MERSENNE_PRIME
+        return (permuted & MAX_HASH).min(axis=0).astype(np.uint32)
+
+    def filter(self, nodes: List[BaseNode]) -> List[BaseNode]:
+        """
+        Returns the nodes that are not near duplicates of a kept node, in order.
+        The others are recorded in duplicates.
+        """
+        kept_nodes = []
+        for node in nodes:
+            signature = self.signature(node.get_content())
+            representative_id = self._find(signature)
+            if representative_id is None:
+                self._add(node.node_id, signature)
+                kept_nodes.append(node)
+            else:
+                self.duplicates[node.node_id] = representative_id
+        return kept_nodes
+
+    def add_representatives(self, nodes: Iterable[BaseNode]) -> None:
+        """Registers already indexed nodes, e.g. before an incremental update."""
+        for node in nodes:
+            self._add(node.node_id, self.signature(node.get_content()))
+
+    def persist(self, path: str) -> None:
+        """Saves the signatures of the kept nodes, so that an incremental update does not hash the indexed nodes again."""
+        node_ids = list(self._signatures)
+        if node_ids:
+            signatures = np.stack([self._signatures[node_id] for node_id in node_ids])
+        else:
+            signatures = np.empty((0, self.num_perm), dtype=np.uint32)
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                params=np.array(json.dumps(self._signature_params)),
+                node_ids=np.array(node_ids, dtype=str),
+                signatures=signatures,
+            )
+
+    def restore_representatives(self, path: str, node_ids: Iterable[str]) -> List[str]:
+        """
+        Registers already indexed nodes from the signatures persisted in path. The LSH bands are rebuilt
+        from the signatures, so the threshold may differ from the one of the persisted filter.
+
+        :param node_ids: The ids of the indexed nodes, persisted signatures of other nodes are ignored.
+        :return: The ids of node_ids without a persisted signature, e.g. near duplicates indexed after their
+            representative was deleted. They are to be registered with add_representatives.
+        """
+        node_ids = list(node_ids)
+        if not os.path.exists(path):
+            return node_ids
+        with np.load(path, allow_pickle=False) as data:
+            if json.loads(str(data["params"])) != self._signature_params:
+                print(
+                    f"Near-duplicate signatures of {path} do not match dedup_cfg, ignoring them."
+                )
+                return node_ids
+            persisted = dict(zip(data["node_ids"].tolist(), data["signatures"]))
+        missing_ids = []
+        for node_id in node_ids:
+            if node_id in persisted:
+                self._add(node_id, persisted[node_id])
+            else:
+                missing_ids.append(node_id)
+        return missing_ids
+
+    @property
+    def _signature_params(self) -> dict:
+        return {
+            "num_perm": self.num_perm,
+            "shingle_size": self.shingle_size,
+            "seed": self.seed,
+        }
+
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(self.num_bands):
+            start = band * self.band_size
+            yield band, signature[start : start + self.band_size].tobytes()
+
+    def _add(self, node_id: str, signature: np.ndarray) -> None:
+        self._signatures[node_id] = signature
+        for band, key in self._band_keys(signature):
+            self._buckets[band].setdefault(key, []).append(node_id)
+
+    def _find(self, signature: np.ndarray):
+        # The most similar kept node above the threshold, if any
+        candidates = set()
+        for band, key in self._band_keys(signature):
+            candidates.update(self._buckets[band].get(key, ()))
+        best_id, best_similarity = None, self.threshold
+        for node_id in candidates:
+            similarity = np.mean(self._signatures[node_id] == signature)
+            if similarity >= best_similarity:
+                best_id, best_similarity = node_id, similarity
+        return best_id
+
+    @property
+    def stats(self) -> dict:
+        return {"kept": len(self._signatures), "dropped": len(self.duplicates)}
+
+
+def optimal_bands(threshold: float, num_perm: int):
+    """
+    Chooses the number of bands b and their size r (b * r = num_perm) whose LSH
+    threshold (1 / b) ** (1 / r) is the closest below threshold, so that few near
+    duplicates are missed; candidates are then checked against threshold anyway.
+    """
+    options = [(num_perm // r, r) for r in range(1, num_perm + 1) if num_perm % r == 0]
+    below = [(b, r) for b, r in options if (1 / b) ** (1 / r) <= threshold]
+    if not below:
+        return min(options, key=lambda option: (1 / option[0]) ** (1 / option[1]))
+    return max(below, key=lambda option: (1 / option[0]) ** (1 / option[1]))
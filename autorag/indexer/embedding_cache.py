@@ -0,0 +1,190 @@
+"""
+Content-addressed embedding cache.
+Embeddings are stored on disk keyed by the embedding model config and the hash of the normalized text,
+so that they are shared across builds, apps and query time.
+"""
+
+import hashlib
+import json
+import re
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+
+from autorag.utils.sqlite_cache import SqliteLRUCache
+
+DEFAULT_CACHE_PATH = "persist_dir/embedding_cache/embeddings.sqlite"
+# Config keys that do not change the embeddings returned by the model
+IGNORED_CONFIG_KEYS = [
+    "api_key",
+    "api_base",
+    "api_version",
+    "embed_batch_size",
+    "num_workers",
+    "max_retries",
+    "timeout",
+    "reuse_client",
+    "default_headers",
+    "callback_manager",
+]
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Wraps an embedding model and looks up every text in a persistent cache before calling the model."""
+
+    embed_model: BaseEmbedding = Field(description="The wrapped embedding model")
+    cache_path: str = Field(
+        default=DEFAULT_CACHE_PATH, description="Path to the sqlite cache file"
+    )
+    max_entries: Optional[int] = Field(
+        default=None, description="Maximum number of cached embeddings"
+    )
+
+    _cache: SqliteLRUCache = PrivateAttr()
+    _namespace: str = PrivateAttr()
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        cache_path: str = DEFAULT_CACHE_PATH,
+        max_entries: Optional[int] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(
+            embed_model=embed_model,
+            cache_path=cache_path,
+            max_entries=max_entries,
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            **kwargs,
+        )
+        self._cache = SqliteLRUCache(cache_path, max_entries)
+        embed_model_config = {
+            key: value
+            for key, value in embed_model.to_dict().items()
+            if key not in IGNORED_CONFIG_KEYS
+        }
+        self._namespace = hashlib.sha256(
+            json.dumps(embed_model_config, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def stats(self) -> dict:
+        return self._cache.stats
+
+    def _key(self, text: str, kind: str = "text") -> str:
+        text_hash = hashlib.sha256(normalize_text(text).encode()).hexdigest()
+        return f"{self._namespace}:{kind}:{text_hash}"
+
+    def _lookup(self, keys: List[str]) -> List[Optional[Embedding]]:
+        found = self._cache.get_many(keys)
+        return [
+            (
+                np.frombuffer(found[key], dtype=np.float32).tolist()
+                if key in found
+                else None
+            )
+            for key in keys
+        ]
+
+    def _store(self, keys: List[str], embeddings: List[Embedding]) -> None:
+        self._cache.set_many(
+            {
+                key: np.asarray(embedding, dtype=np.float32).tobytes()
+                for key, embedding in zip(keys, embeddings)
+            }
+        )
+
+    def get_cached_text_embeddings(self, texts: List[str]) -> List[Optional[Embedding]]:
+        """Returns the cached embedding of each text, or None if it is not cached."""
+        return self._lookup([self._key(text) for text in texts])
+
+    def cache_text_embeddings(
+        self, texts: List[str], embeddings: List[Embedding]
+    ) -> None:
+        self._store([self._key(text) for text in texts], embeddings)
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        key = self._key(query, kind="query")
+        embedding = self._lookup([key])[0]
+        if embedding is None:
+            embedding = self.embed_model.get_query_embedding(query)
+            self._store([key], [embedding])
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        key = self._key(query, kind="query")
+        embedding = self._lookup([key])[0]
+        if embedding is None:
+            embedding = await self.embed_model.aget_query_embedding(query)
+            self._store([key], [embedding])
+        return embedding
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys = [self._key(text) for text in texts]
+        embeddings = self._lookup(keys)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            # texts are already batched by get_text_embedding_batch of the wrapper
+            new_embeddings = self.embed_model._get_text_embeddings(
+                [texts[i] for i in missing]
+            )
+            self._fill(keys, embeddings, missing, new_embeddings)
+        return embeddings
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys = [self._key(text) for text in texts]
+        embeddings = self._lookup(keys)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            new_embeddings = await self.embed_model._aget_text_embeddings(
+                [texts[i] for i in missing]
+            )
+            self._fill(keys, embeddings, missing, new_embeddings)
+        return embeddings
+
+    def _fill(self, keys, embeddings, missing, new_embeddings) -> None:
+        for i, embedding in zip(missing, new_embeddings):
+            embeddings[i] = embedding
+        self._store([keys[i] for i in missing], new_embeddings)
+
+
+def get_embed_model(
+    embed_model: BaseEmbedding, embedding_cache_cfg=None
+) -> BaseEmbedding:
+    """
+    Wraps the embedding model with a CachedEmbedding if the cache is enabled.
+
+    :param embed_model: The embedding model.
+    :param embedding_cache_cfg: The configuration of the cache (enable, cache_path, max_entries).
+    """
+    if not embedding_cache_cfg or not embedding_cache_cfg.get("enable", False):
+        return embed_model
+    return CachedEmbedding(
+        embed_model,
+        cache_path=embedding_cache_cfg.get("cache_path", DEFAULT_CACHE_PATH),
+        max_entries=embedding_cache_cfg.get("max_entries", None),
+    )
+
+
+def unwrap_embed_model(embed_model: BaseEmbedding) -> BaseEmbedding:
+    # The persisted embed model config is always the one of the underlying model
+    if isinstance(embed_model, CachedEmbedding):
+        return embed_model.embed_model
+    return embed_model
@@ -0,0 +1,268 @@
+"""
+Concurrent, rate-limit-aware batched embedding of nodes for index builds.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.schema import BaseNode, MetadataMode
+from .embedding_cache import CachedEmbedding, unwrap_embed_model
+from autorag.utils.token_counter import get_token_counter
+
+RATE_LIMIT_WINDOW = 60.0
+# HTTP statuses of a request rejected because of its input
+INPUT_ERROR_STATUSES = [400, 413, 422]
+# HTTP statuses worth retrying as is: timeouts, rate limits and server errors
+TRANSIENT_ERROR_STATUSES = [408, 409, 429, 500, 502, 503, 504]
+
+
+def without_client_retries(embed_model: BaseEmbedding) -> BaseEmbedding:
+    """
+    A copy of the embedding model that does not retry failed requests itself (e.g. OpenAIEmbedding
+    retries them in its client and again around each call), so that BatchEmbedder is the only one
+    retrying them, within the budget of its rate limiter.
+    """
+    if not getattr(embed_model, "max_retries", 0):
+        return embed_model
+    return type(embed_model).from_dict({**embed_model.to_dict(), "max_retries": 0})
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    # openai errors have status_code, other clients keep the response
+    status_code = getattr(error, "status_code", None)
+    if status_code is None and getattr(error, "response", None) is not None:
+        status_code = getattr(error.response, "status_code", None)
+    return status_code
+
+
+def is_input_error(error: Exception) -> bool:
+    """Whether the embedding request failed because of its texts, e.g. a text over the context length."""
+    message = str(error).lower()
+    return _status_code(error) in INPUT_ERROR_STATUSES or (
+        "context length" in message or "maximum context" in message
+    )
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether the embedding request may succeed if sent again: rate limits, timeouts, server or network errors."""
+    if _status_code(error) in TRANSIENT_ERROR_STATUSES:
+        return True
+    # e.g. openai.APIConnectionError and openai.APITimeoutError, which have no status
+    return isinstance(error, (ConnectionError, TimeoutError)) or any(
+        cls.__name__ in ["APIConnectionError", "APITimeoutError"]
+        for cls in type(error).__mro__
+    )
+
+
+class RateLimiter:
+    """
+    Sliding-window limiter on the number of requests and tokens sent per minute.
+
+    :param requests_per_minute: Maximum number of requests per minute. None for no limit.
+    :param tokens_per_minute: Maximum number of tokens per minute. None for no limit.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+    ) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._window = deque()  # (timestamp, num_tokens) of the recent requests
+        self._window_tokens = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, num_tokens: int) -> None:
+        """Blocks until a request of num_tokens tokens fits in the budget."""
+        if self.tokens_per_minute:
+            # A single request larger than the budget would never fit
+            num_tokens = min(num_tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._window and now - self._window[0][0] >= RATE_LIMIT_WINDOW:
+                    self._window_tokens -= self._window.popleft()[1]
+                fits_requests = (
+                    not self.requests_per_minute
+                    or len(self._window) < self.requests_per_minute
+                )
+                fits_tokens = (
+                    not self.tokens_per_minute
+                    or self._window_tokens + num_tokens <= self.tokens_per_minute
+                )
+                if fits_requests and fits_tokens:
+                    self._window.append((now, num_tokens))
+                    self._window_tokens += num_tokens
+                    return
+                wait = RATE_LIMIT_WINDOW - (now - self._window[0][0])
+            time.sleep(max(wait, 0.01))
+
+
+class BatchEmbedder:
+    """
+    Embeds nodes with several requests in flight.
+
+    Texts are packed into batches by token count, each batch is one request to the
+    embedding model. A batch rejected because of its input (e.g. a text over the context
+    length) is split in two and each half is retried. A batch that failed on a rate limit or
+    a transient server or network error is retried whole with exponential backoff. Other
+    errors are raised at once. The requests are sent by a copy of the model without retries of its
+    own, see without_client_retries.
+
+    :param embed_model: The embedding model.
+    :param max_batch_tokens: Maximum number of tokens in a single request.
+    :param max_batch_size: Maximum number of texts in a single request.
+    :param max_in_flight: Maximum number of concurrent requests.
+    :param requests_per_minute: Request budget. None for no limit.
+    :param tokens_per_minute: Token budget. None for no limit.
+    :param max_retries: Number of retries of a batch after transient errors before giving up.
+    """
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        max_batch_tokens: int = 50000,
+        max_batch_size: int = 512,
+        max_in_flight: int = 4,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_retries: int = 3,
+    ) -> None:
+        self.embed_model = embed_model
+        # Model of the requests sent to the API, the texts found in the cache are not sent
+        self.api_model = without_client_retries(unwrap_embed_model(embed_model))
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.token_counter = get_token_counter()
+        self.num_requests = 0
+        self.num_tokens = 0
+        self.num_texts = 0
+        self.elapsed = 0.0
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, embed_model: BaseEmbedding, embedding_cfg=None):
+        embedding_cfg = embedding_cfg or {}
+        return cls(
+            embed_model,
+            max_batch_tokens=embedding_cfg.get("max_batch_tokens", 50000),
+            max_batch_size=embedding_cfg.get("max_batch_size", 512),
+            max_in_flight=embedding_cfg.get("max_in_flight", 4),
+            requests_per_minute=embedding_cfg.get("requests_per_minute", None),
+            tokens_per_minute=embedding_cfg.get("tokens_per_minute", None),
+            max_retries=embedding_cfg.get("max_retries", 3),
+        )
+
+    def embed_nodes(self, nodes: List[BaseNode], verbose: bool = True) -> None:
+        """Sets the embedding of every node that does not have one yet."""
+        nodes = [node for node in nodes if node.embedding is None]
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        for node, embedding in zip(nodes, self.embed_texts(texts, verbose)):
+            node.embedding = embedding
+
+    def embed_texts(self, texts: List[str], verbose: bool = True) -> List[Embedding]:
+        start_time = time.monotonic()
+        embeddings: List[Optional[Embedding]] = [None] * len(texts)
+
+        if isinstance(self.embed_model, CachedEmbedding):
+            # Only send the texts missing from the cache to the model
+            embeddings = self.embed_model.get_cached_text_embeddings(texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+        token_counts = {i: self.token_counter.count(texts[i]) for i in missing}
+        batches = self._pack_batches(missing, token_counts)
+
+        def embed_batch(batch):
+            batch_embeddings = self._embed_batch(
+                self.api_model,
+                [texts[i] for i in batch],
+                [token_counts[i] for i in batch],
+            )
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            # list() to propagate the exceptions of the workers
+            list(executor.map(embed_batch, batches))
+
+        if isinstance(self.embed_model, CachedEmbedding) and missing:
+            self.embed_model.cache_text_embeddings(
+                [texts[i] for i in missing], [embeddings[i] for i in missing]
+            )
+        self.elapsed += time.monotonic() - start_time
+        self.num_texts += len(missing)
+        if verbose:
+            print(f"Embedding throughput: {self.stats}")
+        return embeddings
+
+    def _pack_batches(self, indices: List[int], token_counts: dict) -> List[List[int]]:
+        batches = []
+        current_batch = []
+        current_batch_tokens = 0
+        for i in indices:
+            if current_batch and (
+                current_batch_tokens + token_counts[i] > self.max_batch_tokens
+                or len(current_batch) >= self.max_batch_size
+            ):
+                batches.append(current_batch)
+                current_batch = []
+                current_batch_tokens = 0
+            current_batch.append(i)
+            current_batch_tokens += token_counts[i]
+        if current_batch:
+            batches.append(current_batch)
+        return batches
+
+    def _embed_batch(
+        self,
+        api_model: BaseEmbedding,
+        texts: List[str],
+        token_counts: List[int],
+        attempt: int = 0,
+    ) -> List[Embedding]:
+        num_tokens = sum(token_counts)
+        self.rate_limiter.acquire(num_tokens)
+        try:
+            embeddings = api_model._get_text_embeddings(texts)
+        except Exception as e:
+            if is_input_error(e) and len(texts) > 1:
+                # Only the batch is wrong (e.g. a text over the context length), split it and retry each half
+                mid = len(texts) // 2
+                print(f"Embedding batch of {len(texts)} failed ({e}), splitting it.")
+                return self._embed_batch(
+                    api_model, texts[:mid], token_counts[:mid], attempt
+                ) + self._embed_batch(
+                    api_model, texts[mid:], token_counts[mid:], attempt
+                )
+            if not is_transient_error(e) or attempt >= self.max_retries:
+                # e.g. an invalid API key, retrying would only delay the failure
+                raise
+            print(
+                f"Embedding batch of {len(texts)} failed ({e}), retrying in {2**attempt}s."
+            )
+            time.sleep(2**attempt)
+            return self._embed_batch(api_model, texts, token_counts, attempt + 1)
+        with self._stats_lock:
+            self.num_requests += 1
+            self.num_tokens += num_tokens
+        return embeddings
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "texts": self.num_texts,
+            "requests": self.num_requests,
+            "tokens": self.num_tokens,
+            "seconds": round(self.elapsed, 2),
+            "tokens_per_second": (
+                round(self.num_tokens / self.elapsed, 1) if self.elapsed else 0.0
+            ),
+        }
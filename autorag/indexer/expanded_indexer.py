@@ -1,19 +1,47 @@
 from llama_index.core import VectorStoreIndex, SimpleDirectoryReader
 from llama_index.core import StorageContext, load_index_from_storage
 from llama_index.core import Settings
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.ingestion import run_transformations
 from llama_index.core.readers.base import BaseReader
 from llama_index.core.schema import Document
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
 from llama_index.embeddings.openai import OpenAIEmbedding
 
 
+from .embedding_cache import CachedEmbedding, get_embed_model, unwrap_embed_model
+from .bm25_index import BM25Index
+from .build_pipeline import BuildPipeline
+from .dedup import NearDuplicateFilter
+from .embedding_pipeline import BatchEmbedder
+from .manifest import BuildManifest
+from .metadata_index import MetadataIndex
 from .process.azure.output import AzureOutputProcessor
+from .process.utils.json import JsonFileLoader
 from .process.utils.metadata import file_metadata_dict
+from .vector_stores.numpy_vector_store import NumpyVectorStore
+from autorag.retriever.document_routing_retriever import DocumentRoutingRetriever
+from autorag.retriever.hybrid_retriever import BM25Retriever
 from autorag.retriever.post_processors.node_expander import NodeExpander
-import os, json
+import numpy as np
+import os, json, shutil
 
 EMBED_MODEL_CONFIG_PATH = "embed_model_config.json"
 STORAGE_BASENAME = "storage_context"
 EXPANDED_NODE_BASENAME = "expanded_nodes"
+MANIFEST_PATH = "manifest.json"
+INDEX_CONFIG_PATH = "index_config.json"
+BUILD_STATE_PATH = "build_state.json"
+DUPLICATES_PATH = "duplicates.json"
+DEDUP_SIGNATURES_PATH = "dedup_signatures.npz"
+METADATA_INDEX_PATH = "metadata_index.json"
+BM25_BASENAME = "bm25"
+# Directory the checkpoints of a build of index_dir are written to, index_dir only changes on the final persist
+STAGING_SUFFIX = ".building"
+CHECKPOINT_SEGMENT_BASENAME = "checkpoint_{:05d}"
+# Suffixes of the directories used to swap the persisted index in place of index_dir
+PERSIST_TMP_SUFFIX = ".persist.tmp"
+PERSIST_OLD_SUFFIX = ".persist.old"
 
 
 class TxtFileReader(BaseReader):
@@ -27,40 +55,81 @@ class TxtFileReader(BaseReader):
 class ExpandedIndexer:
     """A wrapper over data preprocessor, indexer and postprocessors for building, loading and persisting"""
 
-    def __init__(self, index, node_expander):
+    def __init__(
+        self, index, node_expander, manifest=None, duplicates=None, deduplicator=None
+    ):
         self.index = index
         self.node_expander = node_expander
+        # per-file hashes and node ids, only available for azure builds
+        self.manifest = manifest
+        # {dropped node id: representative node id} of the near-duplicate nodes that were
+        # not embedded, they are only kept in the docstore
+        self.duplicates = duplicates or {}
+        # near-duplicate filter holding the signatures of the indexed nodes, persisted for incremental updates
+        self.deduplicator = deduplicator
+        # number of segments appended to the checkpoint of the current build, None before its first checkpoint
+        self._checkpoint_segments = None
+        # centroid vectors of the NodeExpander parent nodes, for document routing
+        self.document_vectors = None
+        self.document_parent_ids = None
+        # metadata value postings of the indexed nodes, for filtered searches
+        self.metadata_index = None
+        # lexical index of the indexed nodes, for hybrid searches
+        self.bm25_index = None
 
     @classmethod
-    def build(cls, data_dir, pre_processor_cfg, post_processor_cfg, embed_model_name):
-        Settings.embed_model = OpenAIEmbedding(model=embed_model_name)
+    def build(
+        cls,
+        data_dir,
+        pre_processor_cfg,
+        post_processor_cfg,
+        embed_model_name,
+        embedding_cache_cfg=None,
+        embedding_cfg=None,
+        vector_store_cfg=None,
+        file_names=None,
+        dedup_cfg=None,
+    ):
+        """Build an index from the files of data_dir, or only from file_names if provided (e.g. the files of a shard)."""
+        Settings.embed_model = get_embed_model(
+            OpenAIEmbedding(model=embed_model_name), embedding_cache_cfg
+        )
+        batch_embedder = BatchEmbedder.from_config(Settings.embed_model, embedding_cfg)
+        storage_context = ExpandedIndexer.get_storage_context(vector_store_cfg)
+        deduplicator = ExpandedIndexer.get_deduplicator(dedup_cfg)
         # Processing documents based on the specified pre_processor type.
         sentence_splitter_cfg = pre_processor_cfg.sentence_splitter_cfg
+        manifest = None
         if pre_processor_cfg.pre_processor_type == "azure":
-            file_type = pre_processor_cfg.azure_pre_processor_cfg.file_type
-            paragraph_process_cfg = (
-                pre_processor_cfg.azure_pre_processor_cfg.paragraph_process_cfg
+            file_hashes = BuildManifest.scan(data_dir, file_names=file_names)
+            azure_output_processor = cls._process_azure_files(
+                data_dir, pre_processor_cfg, file_names
             )
-            table_process_cfg = (
-                pre_processor_cfg.azure_pre_processor_cfg.table_process_cfg
+            nodes = azure_output_processor.nodes
+            index = cls._build_index(
+                nodes, storage_context, batch_embedder, deduplicator
             )
 
-            nodes = AzureOutputProcessor(
-                data_dir,
-                file_type,
-                paragraph_process_cfg,
-                table_process_cfg,
-                sentence_splitter_cfg,
-            ).nodes
-            index = VectorStoreIndex(nodes, embed_model=Settings.embed_model)
+            manifest = BuildManifest()
+            for file_name, file_hash in file_hashes.items():
+                node_ids = azure_output_processor.file_node_ids.get(
+                    JsonFileLoader.document_name(file_name), []
+                )
+                manifest.update(file_name, file_hash, node_ids)
         else:
             if pre_processor_cfg.file_metadata:
                 file_metadata = file_metadata_dict[pre_processor_cfg.file_metadata]
             else:
                 file_metadata = None
 
+            if file_names is not None:
+                input_dir = None
+                input_files = [os.path.join(data_dir, f) for f in file_names]
+            else:
+                input_dir, input_files = data_dir, None
             documents = SimpleDirectoryReader(
-                data_dir,
+                input_dir,
+                input_files=input_files,
                 file_metadata=file_metadata,
                 # data_dir, file_metadata=file_metadata, file_extractor={".txt": TxtFileReader()}
             ).load_data()
@@ -68,8 +137,9 @@ class ExpandedIndexer:
             # Use sentence splitter configuration if provided
             Settings.chunk_size = sentence_splitter_cfg.chunk_size
             Settings.chunk_overlap = sentence_splitter_cfg.chunk_overlap
-            index = VectorStoreIndex.from_documents(
-                documents, embed_model=Settings.embed_model
+            nodes = run_transformations(documents, Settings.transformations)
+            index = cls._build_index(
+                nodes, storage_context, batch_embedder, deduplicator
             )
 
         if post_processor_cfg.enable_node_expander:
@@ -79,10 +149,379 @@ class ExpandedIndexer:
         else:
             node_expander = None
 
-        return cls(index, node_expander)
+        if isinstance(Settings.embed_model, CachedEmbedding):
+            print(f"Embedding cache stats: {Settings.embed_model.stats}")
+        duplicates = deduplicator.duplicates if deduplicator else None
+        return cls(index, node_expander, manifest, duplicates, deduplicator)
+
+    @staticmethod
+    def _build_index(nodes, storage_context, batch_embedder, deduplicator=None):
+        """Embed the nodes and build the index over them.
+        Near duplicates are only added to the docstore, in their original order, so that parent nodes keep their full text.
+        """
+        if deduplicator is not None:
+            storage_context.docstore.add_documents(nodes)
+            nodes = deduplicator.filter(nodes)
+            print(f"Near-duplicate nodes: {deduplicator.stats}")
+        batch_embedder.embed_nodes(nodes)
+        return VectorStoreIndex(
+            nodes,
+            storage_context=storage_context,
+            embed_model=Settings.embed_model,
+        )
+
+    @classmethod
+    def build_pipelined(
+        cls,
+        index_dir,
+        data_dir,
+        pre_processor_cfg,
+        post_processor_cfg,
+        embed_model_name,
+        embedding_cache_cfg=None,
+        embedding_cfg=None,
+        vector_store_cfg=None,
+        pipeline_cfg=None,
+        file_names=None,
+        dedup_cfg=None,
+        resume=True,
+    ):
+        """Build an index with the files streamed through the BuildPipeline, checkpointing into the staging dir of
+        index_dir. If the previous build of index_dir was interrupted, it is resumed from its last checkpoint.
+        """
+        if pre_processor_cfg.pre_processor_type != "azure":
+            raise ValueError(
+                "Pipelined builds are only supported by the azure pre_processor."
+            )
+        ExpandedIndexer.recover_persist(index_dir)
+        if resume and ExpandedIndexer.is_interrupted(index_dir):
+            print(f"Resuming the interrupted build of {index_dir}.")
+            return cls.update(
+                index_dir,
+                data_dir,
+                pre_processor_cfg,
+                post_processor_cfg,
+                embed_model_name,
+                embedding_cache_cfg,
+                embedding_cfg,
+                vector_store_cfg,
+                file_names,
+                pipeline_cfg,
+                dedup_cfg,
+            )
+
+        # The checkpoints of a previous build are not resumed
+        shutil.rmtree(ExpandedIndexer.get_staging_dir(index_dir), ignore_errors=True)
+        Settings.embed_model = get_embed_model(
+            OpenAIEmbedding(model=embed_model_name), embedding_cache_cfg
+        )
+        batch_embedder = BatchEmbedder.from_config(Settings.embed_model, embedding_cfg)
+        index = VectorStoreIndex(
+            [],
+            storage_context=ExpandedIndexer.get_storage_context(vector_store_cfg),
+            embed_model=Settings.embed_model,
+        )
+        expanded_indexer = cls(
+            index,
+            None,
+            BuildManifest(),
+            deduplicator=ExpandedIndexer.get_deduplicator(dedup_cfg),
+        )
+        file_hashes = BuildManifest.scan(data_dir, file_names=file_names)
+        expanded_indexer._run_pipeline(
+            index_dir,
+            data_dir,
+            pre_processor_cfg,
+            file_hashes,
+            batch_embedder,
+            pipeline_cfg,
+            expanded_indexer.deduplicator,
+        )
+
+        if post_processor_cfg.enable_node_expander:
+            expanded_indexer.node_expander = NodeExpander.build(
+                index, post_processor_cfg.parent_metadata_field
+            )
+        if isinstance(Settings.embed_model, CachedEmbedding):
+            print(f"Embedding cache stats: {Settings.embed_model.stats}")
+        return expanded_indexer
+
+    def _run_pipeline(
+        self,
+        index_dir,
+        data_dir,
+        pre_processor_cfg,
+        file_hashes,
+        batch_embedder,
+        pipeline_cfg=None,
+        deduplicator=None,
+    ):
+        """Process, embed and insert the files of file_hashes, with a checkpoint of index_dir every few files."""
+        processor = ExpandedIndexer._process_azure_files(
+            data_dir, pre_processor_cfg, stream=True
+        )
+        BuildPipeline.from_config(
+            processor, batch_embedder, pipeline_cfg, deduplicator
+        ).run(
+            self.index,
+            self.manifest,
+            file_hashes,
+            checkpoint=lambda written_files: self.checkpoint(index_dir, written_files),
+            duplicates=self.duplicates,
+        )
 
     @classmethod
-    def load(cls, index_dir, enable_node_expander=False):
+    def update(
+        cls,
+        index_dir,
+        data_dir,
+        pre_processor_cfg,
+        post_processor_cfg,
+        embed_model_name,
+        embedding_cache_cfg=None,
+        embedding_cfg=None,
+        vector_store_cfg=None,
+        file_names=None,
+        pipeline_cfg=None,
+        dedup_cfg=None,
+    ):
+        """Incrementally update a persisted index: only the added or changed files are processed and embedded,
+        the nodes of deleted files are dropped and only the affected NodeExpander parent nodes are rebuilt.
+        Also resumes an interrupted pipelined build of index_dir.
+        """
+        if pre_processor_cfg.pre_processor_type != "azure":
+            raise ValueError(
+                "Incremental builds are only supported by the azure pre_processor."
+            )
+        ExpandedIndexer.recover_persist(index_dir)
+        # An interrupted build is resumed from its checkpoint, index_dir still holds the previous complete index
+        interrupted = ExpandedIndexer.is_interrupted(index_dir)
+        load_dir = (
+            ExpandedIndexer.get_staging_dir(index_dir) if interrupted else index_dir
+        )
+        manifest_path = ExpandedIndexer.get_manifest_path(load_dir)
+        if not os.path.exists(manifest_path):
+            print(f"No manifest found in {index_dir}, running a full build.")
+            return cls._full_build(
+                index_dir,
+                data_dir,
+                pre_processor_cfg,
+                post_processor_cfg,
+                embed_model_name,
+                embedding_cache_cfg,
+                embedding_cfg,
+                vector_store_cfg,
+                file_names,
+                pipeline_cfg,
+                dedup_cfg,
+            )
+
+        # The search knobs of vector_store_cfg apply to the loaded vector store, its type and
+        # storage format are the persisted ones
+        vector_search_cfg = {
+            key: (vector_store_cfg or {}).get(key, None)
+            for key in ["nprobe", "rescore_candidates"]
+        }
+        # The parent nodes of an interrupted build are rebuilt from scratch
+        expanded_indexer = cls.load(
+            load_dir,
+            post_processor_cfg.enable_node_expander and not interrupted,
+            embedding_cache_cfg,
+            vector_search_cfg,
+        )
+        if expanded_indexer.index._embed_model.model_name != embed_model_name:
+            print(
+                f"Embedding model changed to {embed_model_name}, running a full build."
+            )
+            return cls._full_build(
+                index_dir,
+                data_dir,
+                pre_processor_cfg,
+                post_processor_cfg,
+                embed_model_name,
+                embedding_cache_cfg,
+                embedding_cfg,
+                vector_store_cfg,
+                file_names,
+                pipeline_cfg,
+                dedup_cfg,
+            )
+        if interrupted:
+            expanded_indexer._replay_checkpoint_segments(
+                load_dir, ExpandedIndexer.load_build_state(index_dir)["segments"]
+            )
+        index = expanded_indexer.index
+        manifest = expanded_indexer.manifest
+        duplicates = expanded_indexer.duplicates
+        batch_embedder = BatchEmbedder.from_config(index._embed_model, embedding_cfg)
+
+        file_hashes = BuildManifest.scan(data_dir, file_names=file_names)
+        added, changed, deleted = manifest.diff(file_hashes)
+        print(f"Added: {len(added)}, changed: {len(changed)}, deleted: {len(deleted)}")
+
+        # Drop the nodes of changed and deleted files
+        stale_node_ids = []
+        for file_name in changed + deleted:
+            stale_node_ids += manifest.remove(file_name)
+        if stale_node_ids:
+            index.delete_nodes(stale_node_ids, delete_from_docstore=True)
+            for node_id in stale_node_ids:
+                # near duplicates are only in the docstore
+                if node_id in index.index_struct.nodes_dict:
+                    index.index_struct.delete(node_id)
+            index.storage_context.index_store.add_index_struct(index.index_struct)
+            expanded_indexer._promote_orphan_duplicates(stale_node_ids, batch_embedder)
+
+        deduplicator = ExpandedIndexer.get_deduplicator(dedup_cfg)
+        if deduplicator is not None:
+            # New nodes are also compared with the nodes already in the index, whose signatures
+            # are persisted; only the indexed nodes without one are hashed
+            missing_ids = deduplicator.restore_representatives(
+                ExpandedIndexer.get_dedup_signatures_path(load_dir),
+                index.index_struct.nodes_dict,
+            )
+            if missing_ids:
+                print(
+                    f"Computing near-duplicate signatures of {len(missing_ids)} nodes."
+                )
+                deduplicator.add_representatives(index.docstore.get_nodes(missing_ids))
+        expanded_indexer.deduplicator = deduplicator
+
+        # Process and embed added and changed files only
+        if (added or changed) and pipeline_cfg and pipeline_cfg.get("enable", False):
+            expanded_indexer._run_pipeline(
+                index_dir,
+                data_dir,
+                pre_processor_cfg,
+                {file_name: file_hashes[file_name] for file_name in added + changed},
+                batch_embedder,
+                pipeline_cfg,
+                deduplicator,
+            )
+        elif added or changed:
+            azure_output_processor = cls._process_azure_files(
+                data_dir, pre_processor_cfg, added + changed
+            )
+            nodes = azure_output_processor.nodes
+            if deduplicator is not None:
+                index.docstore.add_documents(nodes)
+                nodes = deduplicator.filter(nodes)
+                duplicates.update(deduplicator.duplicates)
+                print(f"Near-duplicate nodes: {deduplicator.stats}")
+            batch_embedder.embed_nodes(nodes)
+            index.insert_nodes(nodes)
+            for file_name in added + changed:
+                node_ids = azure_output_processor.file_node_ids.get(
+                    JsonFileLoader.document_name(file_name), []
+                )
+                manifest.update(file_name, file_hashes[file_name], node_ids)
+
+        if post_processor_cfg.enable_node_expander and interrupted:
+            expanded_indexer.node_expander = NodeExpander.build(
+                index, post_processor_cfg.parent_metadata_field
+            )
+        elif expanded_indexer.node_expander:
+            parent_metadata_field = post_processor_cfg.parent_metadata_field
+            if parent_metadata_field == "document_name":
+                affected_parents = [
+                    JsonFileLoader.document_name(file_name)
+                    for file_name in added + changed + deleted
+                ]
+                expanded_indexer.node_expander.update(
+                    index, affected_parents, parent_metadata_field
+                )
+            else:
+                # parents are not tied to files, rebuild all of them
+                expanded_indexer.node_expander = NodeExpander.build(
+                    index, parent_metadata_field
+                )
+
+        if isinstance(index._embed_model, CachedEmbedding):
+            print(f"Embedding cache stats: {index._embed_model.stats}")
+        return expanded_indexer
+
+    @classmethod
+    def _full_build(
+        cls,
+        index_dir,
+        data_dir,
+        pre_processor_cfg,
+        post_processor_cfg,
+        embed_model_name,
+        embedding_cache_cfg=None,
+        embedding_cfg=None,
+        vector_store_cfg=None,
+        file_names=None,
+        pipeline_cfg=None,
+        dedup_cfg=None,
+    ):
+        if pipeline_cfg and pipeline_cfg.get("enable", False):
+            return cls.build_pipelined(
+                index_dir,
+                data_dir,
+                pre_processor_cfg,
+                post_processor_cfg,
+                embed_model_name,
+                embedding_cache_cfg,
+                embedding_cfg,
+                vector_store_cfg,
+                pipeline_cfg,
+                file_names,
+                dedup_cfg,
+                resume=False,
+            )
+        return cls.build(
+            data_dir,
+            pre_processor_cfg,
+            post_processor_cfg,
+            embed_model_name,
+            embedding_cache_cfg,
+            embedding_cfg,
+            vector_store_cfg,
+            file_names,
+            dedup_cfg,
+        )
+
+    def _promote_orphan_duplicates(self, stale_node_ids, batch_embedder):
+        """Embed and index the near duplicates whose representative was deleted, and forget the deleted duplicates."""
+        stale_node_ids = set(stale_node_ids)
+        orphan_ids = []
+        for node_id, representative_id in list(self.duplicates.items()):
+            if node_id in stale_node_ids:
+                del self.duplicates[node_id]
+            elif representative_id in stale_node_ids:
+                del self.duplicates[node_id]
+                orphan_ids.append(node_id)
+        if orphan_ids:
+            print(f"Indexing {len(orphan_ids)} near duplicates of deleted nodes.")
+            orphan_nodes = self.index.docstore.get_nodes(orphan_ids)
+            batch_embedder.embed_nodes(orphan_nodes)
+            self.index.insert_nodes(orphan_nodes)
+
+    @staticmethod
+    def _process_azure_files(
+        data_dir, pre_processor_cfg, file_names=None, stream=False
+    ):
+        azure_pre_processor_cfg = pre_processor_cfg.azure_pre_processor_cfg
+        return AzureOutputProcessor(
+            data_dir,
+            azure_pre_processor_cfg.file_type,
+            azure_pre_processor_cfg.paragraph_process_cfg,
+            azure_pre_processor_cfg.table_process_cfg,
+            pre_processor_cfg.sentence_splitter_cfg,
+            file_names,
+            azure_pre_processor_cfg.get("num_workers", 1),
+            stream,
+        )
+
+    @classmethod
+    def load(
+        cls,
+        index_dir,
+        enable_node_expander=False,
+        embedding_cache_cfg=None,
+        vector_search_cfg=None,
+    ):
         embed_model_config_path = ExpandedIndexer.get_embed_model_config_path(index_dir)
         from llama_index.core.embeddings.loading import load_embed_model
 
@@ -90,21 +529,252 @@ class ExpandedIndexer:
             embed_model_config = json.loads(f.read())
         print(embed_model_config)
         embed_model = load_embed_model(embed_model_config)
-        Settings.embed_model = embed_model
+        Settings.embed_model = get_embed_model(embed_model, embedding_cache_cfg)
         # rebuild storage context
         storage_context_dir = ExpandedIndexer.get_storage_context_dir(index_dir)
-        storage_context = StorageContext.from_defaults(persist_dir=storage_context_dir)
+        index_config = ExpandedIndexer.load_index_config(index_dir)
+        if index_config.get("vector_store_type") == "numpy":
+            vector_store = NumpyVectorStore.from_persist_dir(storage_context_dir)
+            # Query-time overrides of the search knobs (e.g. nprobe, rescore_candidates)
+            for key, value in (vector_search_cfg or {}).items():
+                if value is not None:
+                    setattr(vector_store, key, value)
+        else:
+            vector_store = None
+        storage_context = StorageContext.from_defaults(
+            persist_dir=storage_context_dir, vector_store=vector_store
+        )
 
         # load index
-        index = load_index_from_storage(storage_context)
+        index = load_index_from_storage(
+            storage_context, embed_model=Settings.embed_model
+        )
         if enable_node_expander:
             expanded_node_dir = ExpandedIndexer.get_expanded_node_dir(index_dir)
-            node_expander = NodeExpander.load(expanded_node_dir)
+            node_expander = NodeExpander.load(expanded_node_dir, index.docstore)
         else:
             node_expander = None
-        return cls(index, node_expander)
+
+        manifest_path = ExpandedIndexer.get_manifest_path(index_dir)
+        if os.path.exists(manifest_path):
+            manifest = BuildManifest.load(manifest_path)
+        else:
+            manifest = None
+
+        duplicates_path = ExpandedIndexer.get_duplicates_path(index_dir)
+        if os.path.exists(duplicates_path):
+            with open(duplicates_path, "r", encoding="utf-8") as f:
+                duplicates = json.loads(f.read())
+        else:
+            duplicates = None
+        expanded_indexer = cls(index, node_expander, manifest, duplicates)
+        if node_expander:
+            (
+                expanded_indexer.document_vectors,
+                expanded_indexer.document_parent_ids,
+            ) = DocumentRoutingRetriever.load_document_vectors(expanded_node_dir)
+        metadata_index_path = ExpandedIndexer.get_metadata_index_path(index_dir)
+        if os.path.exists(metadata_index_path):
+            expanded_indexer.metadata_index = MetadataIndex.load(metadata_index_path)
+        bm25_dir = ExpandedIndexer.get_bm25_dir(index_dir)
+        if os.path.exists(bm25_dir):
+            expanded_indexer.bm25_index = BM25Index.load(bm25_dir)
+        return expanded_indexer
+
+    def as_retriever(self, node_ids=None, **kwargs):
+        """
+        :param node_ids: If provided, only these nodes are scored, e.g. the result of filter_node_ids.
+        """
+        # VectorStoreIndex.as_retriever restricts the search to the ids of all the nodes, which makes the
+        # vector store check every id on every query instead of using its own search
+        return VectorIndexRetriever(
+            self.index,
+            node_ids=node_ids,
+            callback_manager=self.index._callback_manager,
+            object_map=self.index._object_map,
+            **kwargs,
+        )
+
+    def filter_node_ids(self, filters):
+        """
+        Returns the ids of the indexed nodes whose metadata match the filters, see MetadataIndex.candidate_ids.
+        The result can be passed as node_ids to as_retriever, so that only these nodes are scored.
+        """
+        if self.metadata_index is None:
+            # index persisted without a metadata index
+            self.metadata_index = MetadataIndex.build(self.get_indexed_nodes())
+        return self.metadata_index.candidate_ids(filters)
+
+    def as_bm25_retriever(self, similarity_top_k):
+        if self.bm25_index is None:
+            # index persisted without a BM25 index
+            self.bm25_index = BM25Index.build(self.get_indexed_nodes())
+        return BM25Retriever(self.bm25_index, self.index.docstore, similarity_top_k)
+
+    def get_indexed_nodes(self):
+        # near-duplicate nodes are only kept in the docstore
+        node_ids = list(self.index.index_struct.nodes_dict)
+        return self.index.docstore.get_nodes(node_ids)
+
+    def as_document_routing_retriever(self, similarity_top_k, top_documents=20):
+        """Retriever that only searches the chunks of the top_documents documents closest to the query."""
+        if self.node_expander is None:
+            raise ValueError(
+                "Document routing uses the parent nodes of the NodeExpander, load the index with enable_node_expander"
+            )
+        self.update_document_vectors()
+        return DocumentRoutingRetriever(
+            self.index,
+            self.node_expander,
+            self.document_vectors,
+            similarity_top_k,
+            top_documents,
+        )
+
+    def update_document_vectors(self):
+        """Computes the document vectors of the parent nodes that changed since they were last computed."""
+        if self.document_parent_ids == self.node_expander.parent_ids:
+            return
+        self.document_vectors = DocumentRoutingRetriever.compute_document_vectors(
+            self.index,
+            self.node_expander,
+            self.document_vectors,
+            self.document_parent_ids,
+        )
+        self.document_parent_ids = list(self.node_expander.parent_ids)
+
+    def checkpoint(self, index_dir, written_files=()):
+        """Checkpoint a partially built index into the staging dir of index_dir. An interrupted build is resumed
+        from its last checkpoint, index_dir keeps serving the previous complete index until the final persist.
+
+        The first checkpoint of a build persists the whole index, the next ones only append a segment with the
+        nodes and vectors of the files written since the previous checkpoint.
+
+        :param written_files: (file_name, file_hash, nodes) of the files written since the previous checkpoint.
+        """
+        staging_dir = ExpandedIndexer.get_staging_dir(index_dir)
+        if self._checkpoint_segments is None:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            os.makedirs(staging_dir)
+            self._persist(staging_dir)
+            self._checkpoint_segments = 0
+        else:
+            self._write_checkpoint_segment(
+                staging_dir, self._checkpoint_segments, written_files
+            )
+            self._checkpoint_segments += 1
+        # Written last, a crash while checkpointing resumes from the previous checkpoint
+        build_state_path = ExpandedIndexer.get_build_state_path(staging_dir)
+        with open(build_state_path + ".tmp", "w") as f:
+            f.write(
+                json.dumps(
+                    {"status": "in_progress", "segments": self._checkpoint_segments}
+                )
+            )
+        os.replace(build_state_path + ".tmp", build_state_path)
+
+    def _write_checkpoint_segment(self, staging_dir, segment, written_files):
+        segment_path = ExpandedIndexer.get_checkpoint_segment_path(staging_dir, segment)
+        files, duplicates, embeddings = [], {}, []
+        for file_name, file_hash, nodes in written_files:
+            node_jsons = []
+            for node in nodes:
+                if node.node_id in self.duplicates:
+                    duplicates[node.node_id] = self.duplicates[node.node_id]
+                else:
+                    embeddings.append(node.embedding)
+                node_without_embedding = node.model_copy()
+                node_without_embedding.embedding = None
+                node_jsons.append(doc_to_json(node_without_embedding))
+            files.append(
+                {"file_name": file_name, "file_hash": file_hash, "nodes": node_jsons}
+            )
+        np.save(segment_path + ".npy", np.array(embeddings, dtype=np.float32))
+        with open(segment_path + ".json", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"files": files, "duplicates": duplicates}))
+
+    def _replay_checkpoint_segments(self, staging_dir, num_segments):
+        """Inserts the nodes of the segments appended to the checkpoint loaded from staging_dir."""
+        for segment in range(num_segments):
+            segment_path = ExpandedIndexer.get_checkpoint_segment_path(
+                staging_dir, segment
+            )
+            with open(segment_path + ".json", "r", encoding="utf-8") as f:
+                segment_data = json.loads(f.read())
+            embeddings = iter(np.load(segment_path + ".npy"))
+            duplicates = segment_data["duplicates"]
+            kept_nodes = []
+            for file in segment_data["files"]:
+                nodes = [json_to_doc(node_json) for node_json in file["nodes"]]
+                for node in nodes:
+                    if node.node_id not in duplicates:
+                        node.embedding = next(embeddings).tolist()
+                        kept_nodes.append(node)
+                if duplicates:
+                    # Near duplicates are only stored in the docstore, in their original order
+                    self.index.docstore.add_documents(nodes)
+                self.manifest.update(
+                    file["file_name"],
+                    file["file_hash"],
+                    [node.node_id for node in nodes],
+                )
+            self.duplicates.update(duplicates)
+            self.index.insert_nodes(kept_nodes)
+        self._checkpoint_segments = num_segments
+
+    @staticmethod
+    def recover_persist(index_dir):
+        """Completes or rolls back a swap of index_dir interrupted by a crash, see persist.
+        Only called by the writers of index_dir, readers never modify it.
+        """
+        tmp_dir = index_dir.rstrip(os.sep) + PERSIST_TMP_SUFFIX
+        old_dir = index_dir.rstrip(os.sep) + PERSIST_OLD_SUFFIX
+        if not os.path.exists(index_dir) and os.path.exists(old_dir):
+            if os.path.exists(tmp_dir):
+                # The new index was complete, index_dir had already been moved away
+                print(f"Completing the interrupted persist of {index_dir}.")
+                os.replace(tmp_dir, index_dir)
+            else:
+                os.replace(old_dir, index_dir)
+        if os.path.exists(old_dir) and not os.path.exists(tmp_dir):
+            # The new index is in place, the checkpoints of its build are obsolete
+            shutil.rmtree(
+                ExpandedIndexer.get_staging_dir(index_dir), ignore_errors=True
+            )
+        # Leftovers of a crash while writing the new index or removing the previous one
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(old_dir, ignore_errors=True)
 
     def persist(self, index_dir):
+        """Persist the complete index next to index_dir and swap it in place of index_dir, then drop the
+        checkpoints of the build. Readers of index_dir see the previous index until the swap.
+        """
+        ExpandedIndexer.recover_persist(index_dir)
+        tmp_dir = index_dir.rstrip(os.sep) + PERSIST_TMP_SUFFIX
+        old_dir = index_dir.rstrip(os.sep) + PERSIST_OLD_SUFFIX
+        os.makedirs(tmp_dir)
+        self._persist(tmp_dir)
+        if self.node_expander:
+            # Only on the final persist, a checkpointed build is still missing documents
+            self.update_document_vectors()
+            DocumentRoutingRetriever.persist_document_vectors(
+                ExpandedIndexer.get_expanded_node_dir(tmp_dir),
+                self.document_vectors,
+                self.document_parent_ids,
+            )
+        indexed_nodes = self.get_indexed_nodes()
+        self.metadata_index = MetadataIndex.build(indexed_nodes)
+        self.metadata_index.persist(ExpandedIndexer.get_metadata_index_path(tmp_dir))
+        self.bm25_index = BM25Index.build(indexed_nodes)
+        self.bm25_index.persist(ExpandedIndexer.get_bm25_dir(tmp_dir))
+        # The memory-mapped arrays of the loaded index stay valid after their files are moved or removed
+        if os.path.exists(index_dir):
+            os.replace(index_dir, old_dir)
+        os.replace(tmp_dir, index_dir)
+        shutil.rmtree(ExpandedIndexer.get_staging_dir(index_dir), ignore_errors=True)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    def _persist(self, index_dir):
         storage_context_dir = ExpandedIndexer.get_storage_context_dir(index_dir)
         expanded_node_dir = ExpandedIndexer.get_expanded_node_dir(index_dir)
         embed_model_config_path = ExpandedIndexer.get_embed_model_config_path(index_dir)
@@ -112,10 +782,63 @@ class ExpandedIndexer:
         self.index.storage_context.persist(persist_dir=storage_context_dir)
         if self.node_expander:
             self.node_expander.persist(expanded_node_dir)
-        embed_model_config = self.index._embed_model.to_dict()
+        embed_model_config = unwrap_embed_model(self.index._embed_model).to_dict()
         embed_model_config.pop("api_key")
         with open(embed_model_config_path, "w", encoding="utf-8") as f:
             f.write(json.dumps(embed_model_config))
+        if self.manifest:
+            self.manifest.persist(ExpandedIndexer.get_manifest_path(index_dir))
+        duplicates_path = ExpandedIndexer.get_duplicates_path(index_dir)
+        if self.duplicates or os.path.exists(duplicates_path):
+            with open(duplicates_path, "w") as f:
+                f.write(json.dumps(self.duplicates))
+        if self.deduplicator is not None:
+            self.deduplicator.persist(
+                ExpandedIndexer.get_dedup_signatures_path(index_dir)
+            )
+
+        if isinstance(self.index.vector_store, NumpyVectorStore):
+            index_config = {"vector_store_type": "numpy"}
+        else:
+            index_config = {"vector_store_type": "simple"}
+        with open(ExpandedIndexer.get_index_config_path(index_dir), "w") as f:
+            f.write(json.dumps(index_config))
+
+    @staticmethod
+    def get_storage_context(vector_store_cfg=None):
+        """Create an empty storage context with the vector store type given by vector_store_cfg."""
+        vector_store_cfg = vector_store_cfg or {}
+        vector_store_type = vector_store_cfg.get("vector_store_type", "simple")
+        if vector_store_type == "numpy":
+            vector_store = NumpyVectorStore(
+                dtype=vector_store_cfg.get("dtype", "float32"),
+                quantization=vector_store_cfg.get("quantization", "none"),
+                rescore_candidates=vector_store_cfg.get("rescore_candidates", 200),
+                ann_type=vector_store_cfg.get("ann_type", "none"),
+                nlist=vector_store_cfg.get("nlist", None),
+                nprobe=vector_store_cfg.get("nprobe", 16),
+            )
+        elif vector_store_type == "simple":
+            vector_store = None
+        else:
+            raise ValueError(f"Unsupported vector_store_type: {vector_store_type}")
+        return StorageContext.from_defaults(vector_store=vector_store)
+
+    @staticmethod
+    def get_deduplicator(dedup_cfg=None):
+        """Create a near-duplicate filter if enabled by dedup_cfg."""
+        if dedup_cfg and dedup_cfg.get("enable", False):
+            return NearDuplicateFilter.from_config(dedup_cfg)
+        return None
+
+    @staticmethod
+    def load_index_config(index_dir):
+        index_config_path = ExpandedIndexer.get_index_config_path(index_dir)
+        # indexes persisted before index_config.json existed use a SimpleVectorStore
+        if not os.path.exists(index_config_path):
+            return {}
+        with open(index_config_path, "r", encoding="utf-8") as f:
+            return json.loads(f.read())
 
     @staticmethod
     def get_storage_context_dir(index_dir):
@@ -128,3 +851,56 @@ class ExpandedIndexer:
     @staticmethod
     def get_embed_model_config_path(index_dir):
         return os.path.join(index_dir, EMBED_MODEL_CONFIG_PATH)
+
+    @staticmethod
+    def get_manifest_path(index_dir):
+        return os.path.join(index_dir, MANIFEST_PATH)
+
+    @staticmethod
+    def get_index_config_path(index_dir):
+        return os.path.join(index_dir, INDEX_CONFIG_PATH)
+
+    @staticmethod
+    def get_duplicates_path(index_dir):
+        return os.path.join(index_dir, DUPLICATES_PATH)
+
+    @staticmethod
+    def get_dedup_signatures_path(index_dir):
+        return os.path.join(index_dir, DEDUP_SIGNATURES_PATH)
+
+    @staticmethod
+    def get_metadata_index_path(index_dir):
+        return os.path.join(index_dir, METADATA_INDEX_PATH)
+
+    @staticmethod
+    def get_bm25_dir(index_dir):
+        return os.path.join(index_dir, BM25_BASENAME)
+
+    @staticmethod
+    def get_build_state_path(index_dir):
+        return os.path.join(index_dir, BUILD_STATE_PATH)
+
+    @staticmethod
+    def get_staging_dir(index_dir):
+        return index_dir.rstrip(os.sep) + STAGING_SUFFIX
+
+    @staticmethod
+    def get_checkpoint_segment_path(staging_dir, segment):
+        return os.path.join(staging_dir, CHECKPOINT_SEGMENT_BASENAME.format(segment))
+
+    @staticmethod
+    def load_build_state(index_dir):
+        build_state_path = ExpandedIndexer.get_build_state_path(
+            ExpandedIndexer.get_staging_dir(index_dir)
+        )
+        with open(build_state_path, "r", encoding="utf-8") as f:
+            return json.loads(f.read())
+
+    @staticmethod
+    def is_interrupted(index_dir):
+        """Whether the staging dir of index_dir holds the checkpoint of a build that did not complete."""
+        return os.path.exists(
+            ExpandedIndexer.get_build_state_path(
+                ExpandedIndexer.get_staging_dir(index_dir)
+            )
+        )
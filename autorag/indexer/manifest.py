@@ -0,0 +1,92 @@
+"""
+Build manifest for incremental index builds.
+Keep track of the content hash and the node ids produced by every corpus file.
+"""
+
+import hashlib
+import json
+import os
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class BuildManifest:
+    """
+    Records, for every file of a corpus, the content hash it had when it was
+    indexed and the ids of the nodes created from it.
+
+    :param files: {file_name: {"hash": str, "node_ids": list[str]}}.
+    """
+
+    def __init__(self, files: dict = None) -> None:
+        self.files = files or {}
+
+    @staticmethod
+    def hash_file(file_path: str) -> str:
+        """
+        Computes the sha256 hash of a file, reading it block by block.
+
+        :param file_path: Path to the file.
+        :return: The hex digest of the file content.
+        """
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @classmethod
+    def scan(
+        cls, data_dir: str, extension: str = ".json", file_names: list[str] = None
+    ) -> dict[str, str]:
+        """
+        Hashes all the files with the given extension in the data directory.
+
+        :param data_dir: Path to the data directory.
+        :param extension: Only files ending with this extension are hashed.
+        :param file_names: If provided, only these files are hashed.
+        :return: {file_name: hash}.
+        """
+        if file_names is None:
+            file_names = os.listdir(data_dir)
+        return {
+            file_name: cls.hash_file(os.path.join(data_dir, file_name))
+            for file_name in sorted(file_names)
+            if file_name.endswith(extension)
+        }
+
+    def diff(self, current_hashes: dict[str, str]):
+        """
+        Compares the manifest with the current state of the corpus.
+
+        :param current_hashes: {file_name: hash} of the current corpus.
+        :return: Three sorted lists of file names: added, changed and deleted.
+        """
+        added = sorted(f for f in current_hashes if f not in self.files)
+        changed = sorted(
+            f
+            for f, file_hash in current_hashes.items()
+            if f in self.files and self.files[f]["hash"] != file_hash
+        )
+        deleted = sorted(f for f in self.files if f not in current_hashes)
+        return added, changed, deleted
+
+    def update(self, file_name: str, file_hash: str, node_ids: list[str]) -> None:
+        self.files[file_name] = {"hash": file_hash, "node_ids": list(node_ids)}
+
+    def remove(self, file_name: str) -> list[str]:
+        """
+        Removes a file from the manifest.
+
+        :return: The node ids that were created from the file.
+        """
+        return self.files.pop(file_name, {}).get("node_ids", [])
+
+    @classmethod
+    def load(cls, manifest_path: str):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return cls(json.loads(f.read()))
+
+    def persist(self, manifest_path: str) -> None:
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(self.files))
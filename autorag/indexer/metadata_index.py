@@ -0,0 +1,137 @@
+"""
+Inverted index from node metadata values to the indexed nodes that have them.
+Metadata filters are turned into candidate node ids, so that a vector search only scores the matching nodes.
+"""
+
+from collections import defaultdict
+import json
+
+import numpy as np
+
+METADATA_INDEX_FIELDS = ["document_name", "document_type", "page_number", "from_table"]
+COMPARISON_OPERATORS = {
+    "gt": lambda value, bound: value > bound,
+    "gte": lambda value, bound: value >= bound,
+    "lt": lambda value, bound: value < bound,
+    "lte": lambda value, bound: value <= bound,
+    "ne": lambda value, bound: value != bound,
+}
+
+
+class MetadataIndex:
+    """
+    Postings of the metadata values of the indexed nodes.
+
+    :param node_ids: Ids of the indexed nodes.
+    :param postings: {field: {value: int array of positions in node_ids}}.
+    """
+
+    def __init__(self, node_ids: list = None, postings: dict = None) -> None:
+        self.node_ids = node_ids or []
+        self.postings = postings or {}
+
+    @classmethod
+    def build(cls, nodes, fields: list = None):
+        """
+        :param nodes: The indexed nodes.
+        :param fields: The metadata fields that can be filtered on.
+        """
+        fields = fields or METADATA_INDEX_FIELDS
+        node_ids = []
+        postings = {field: defaultdict(list) for field in fields}
+        for node in nodes:
+            position = len(node_ids)
+            node_ids.append(node.node_id)
+            for field in fields:
+                if field in node.metadata:
+                    postings[field][node.metadata[field]].append(position)
+        return cls(
+            node_ids,
+            {
+                field: {
+                    value: np.asarray(positions, dtype=np.int32)
+                    for value, positions in values.items()
+                }
+                for field, values in postings.items()
+            },
+        )
+
+    def candidate_ids(self, filters: dict) -> list[str]:
+        """
+        Returns the ids of the nodes matching all the filters.
+
+        :param filters: {field: condition}. A condition is a value, a list of values (matches any of them)
+            or a dict of comparison operators, e.g. {"gte": 3, "lte": 10}.
+        """
+        positions = None
+        for field, condition in filters.items():
+            if field not in self.postings:
+                raise ValueError(
+                    f"Cannot filter on {field}, indexed fields are {list(self.postings)}"
+                )
+            field_positions = [
+                self.postings[field][value]
+                for value in self._matching_values(field, condition)
+            ]
+            field_positions = (
+                np.unique(np.concatenate(field_positions))
+                if field_positions
+                else np.zeros(0, dtype=np.int32)
+            )
+            if positions is None:
+                positions = field_positions
+            else:
+                positions = np.intersect1d(positions, field_positions)
+        if positions is None:
+            return list(self.node_ids)
+        return [self.node_ids[position] for position in positions]
+
+    def _matching_values(self, field, condition):
+        values = self.postings[field]
+        if isinstance(condition, list):
+            return [value for value in condition if value in values]
+        if not isinstance(condition, dict):
+            return [condition] if condition in values else []
+
+        for operator in condition:
+            if operator not in COMPARISON_OPERATORS:
+                raise ValueError(
+                    f"Unknown operator {operator}, expected one of {list(COMPARISON_OPERATORS)}"
+                )
+        matching_values = []
+        # The distinct values of a field are few compared to the nodes
+        for value in values:
+            try:
+                if all(
+                    COMPARISON_OPERATORS[operator](value, bound)
+                    for operator, bound in condition.items()
+                ):
+                    matching_values.append(value)
+            except TypeError:
+                # e.g. a None page number compared with a number
+                continue
+        return matching_values
+
+    @classmethod
+    def load(cls, index_path: str):
+        with open(index_path, "r", encoding="utf-8") as f:
+            data = json.loads(f.read())
+        return cls(
+            data["node_ids"],
+            {
+                field: {
+                    value: np.asarray(positions, dtype=np.int32)
+                    for value, positions in values
+                }
+                for field, values in data["postings"].items()
+            },
+        )
+
+    def persist(self, index_path: str) -> None:
+        # (value, positions) pairs keep the type of the values, e.g. page numbers
+        postings = {
+            field: [[value, positions.tolist()] for value, positions in values.items()]
+            for field, values in self.postings.items()
+        }
+        with open(index_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"node_ids": self.node_ids, "postings": postings}))
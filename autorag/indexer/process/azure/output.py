@@ -3,17 +3,20 @@ Microsoft Azure AI Document Intelligence Output Processor
 Process all the azure-preanalyzed files from data directory.
 """
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 from ..utils.json import JsonFileLoader
 from .paragraph import AzureParagraphProcessor, AzurePolygonParagraphProcessor
-from .table import AzureTablesProcessor
+from .table import AzureTablesProcessor, TABLE_SERIALIZATIONS
 
 
 class AzureOutputProcessor:
     """
     Initializes the AzureOutputProcessor with a specified data directory.
 
-    This processor loads all files from the given directory using JsonFileLoader
-    and process them into TextNode objects.
+    This processor streams the files from the given directory using JsonFileLoader
+    and process them into TextNode objects, one file at a time.
 
     :param data_dir: The directory containing JSON files to be processed.
     :param file_type: The type of the processed files.
@@ -21,6 +24,13 @@ class AzureOutputProcessor:
                                 If polygon_group=True, uses polygon tracking with chunk_size.
                                 Otherwise uses sentence splitter with sentence_splitter_cfg.
     :param table_process_cfg: The configuration for processing tables.
+    :param file_names: Optional list of file names to process. If None, all the
+                       files in data_dir are processed.
+    :param num_workers: Number of worker processes. If greater than 1, files are
+                        loaded and processed in a process pool, nodes are still
+                        returned in file name order.
+    :param stream: If True, files are not processed on init, nodes are consumed
+                   file by file from iter_file_nodes instead.
     """
 
     def __init__(
@@ -30,10 +40,13 @@ class AzureOutputProcessor:
         paragraph_process_cfg: dict = {},
         table_process_cfg: dict = {},
         sentence_splitter_cfg: dict = {},
+        file_names: list[str] = None,
+        num_workers: int = 1,
+        stream: bool = False,
     ) -> None:
-        # Load all files from the specified directory
-        self.all_files = JsonFileLoader(data_dir).load()
+        self.data_dir = data_dir
         self.file_type = file_type
+        self.num_workers = num_workers or 1
 
         # Paragraph processing configuration
         self.polygon_group = paragraph_process_cfg.get("polygon_group", False)
@@ -42,45 +55,166 @@ class AzureOutputProcessor:
         self.include_table = table_process_cfg.get("include_table", False)
         self.by_token = table_process_cfg.get("by_token", False)
         self.token_limit = table_process_cfg.get("token_limit", None)
+        self.table_serialization = table_process_cfg.get("serialization", "dict")
+        self.report_serialization_tokens = table_process_cfg.get(
+            "report_serialization_tokens", False
+        )
+        # Tokens of the table nodes in every serialization, if report_serialization_tokens
+        self.serialization_tokens = {fmt: 0 for fmt in TABLE_SERIALIZATIONS}
+
+        # Node ids created from each file, keyed by file name
+        self.file_node_ids = {}
+        if stream:
+            # Nodes are produced on demand by iter_file_nodes
+            self.nodes = None
+        else:
+            self.nodes = self.get_nodes(file_names)
+
+    def get_nodes(self, file_names: list[str] = None) -> list:
+        nodes = []
+        for file_name, file_nodes in self.iter_file_nodes(file_names):
+            nodes += file_nodes
+        return nodes
+
+    def iter_file_nodes(self, file_names: list[str] = None):
+        """
+        Processes the files one at a time, in file name order.
+
+        :param file_names: Optional list of file names to process.
+        :return: A generator of (document name, nodes) tuples.
+        """
+        if self.num_workers > 1:
+            file_nodes_iter = self._iter_file_nodes_parallel(file_names)
+        else:
+            # Stream all files (or the given files) from the specified directory,
+            # only the file being processed is held in memory
+            file_nodes_iter = (
+                (file_name, self.get_file_nodes(file_name, file_content))
+                for file_name, file_content in JsonFileLoader(self.data_dir).iter_files(
+                    file_names
+                )
+            )
+        for file_name, file_nodes in file_nodes_iter:
+            self.file_node_ids[file_name] = [node.node_id for node in file_nodes]
+            yield file_name, file_nodes
+        if self.report_serialization_tokens:
+            self.print_serialization_report()
+
+    def print_serialization_report(self) -> None:
+        """Prints the tokens of the table nodes in every serialization, and the tokens saved over dict."""
+        dict_tokens = self.serialization_tokens["dict"]
+        for fmt, num_tokens in self.serialization_tokens.items():
+            saved = dict_tokens - num_tokens
+            saved_ratio = round(100 * saved / dict_tokens, 1) if dict_tokens else 0.0
+            selected = " (selected)" if fmt == self.table_serialization else ""
+            print(
+                f"Table tokens as {fmt}{selected}: {num_tokens}, "
+                f"saved over dict: {saved} ({saved_ratio}%)"
+            )
+
+    def _iter_file_nodes_parallel(self, file_names: list[str] = None):
+        """
+        Processes the files in a process pool. Every worker loads the files it
+        processes, so only file names and nodes are sent between processes.
+        """
+        file_names = JsonFileLoader(self.data_dir).list_files(file_names)
+        if not file_names:
+            return
 
-        self.nodes = self.get_nodes()
+        with ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=_init_worker,
+            initargs=(self,),
+        ) as executor:
+            # Bound the number of files in flight, so that processed files do not
+            # pile up in memory when the consumer is slower than the workers
+            max_in_flight = self.num_workers * 4
+            futures = deque()
+            for file_name in file_names:
+                futures.append(executor.submit(_process_file, file_name))
+                if len(futures) >= max_in_flight:
+                    document_name, file_nodes = self._collect(
+                        futures.popleft().result()
+                    )
+                    if document_name is not None:
+                        yield document_name, file_nodes
+            while futures:
+                document_name, file_nodes = self._collect(futures.popleft().result())
+                if document_name is not None:
+                    yield document_name, file_nodes
 
-    def get_nodes(self) -> list:
+    def _collect(self, result: tuple):
+        # Adds the table token counts of a worker to the ones of the processor
+        document_name, file_nodes, serialization_tokens = result
+        for fmt, num_tokens in serialization_tokens.items():
+            self.serialization_tokens[fmt] += num_tokens
+        return document_name, file_nodes
+
+    def get_file_nodes(self, file_name: str, file_content: dict) -> list:
+        """
+        Processes the paragraphs and tables of a single file into nodes.
+
+        :param file_name: The name of the file.
+        :param file_content: The Azure output of the file.
+        :return: A list of TextNode objects created from the file.
+        """
         nodes = []
+        tables_list = file_content.get("tables", [])
+
+        # Process paragraph data
+        if self.polygon_group:
+            pages_list = file_content.get("pages", [])
+            paragraphs_nodes = AzurePolygonParagraphProcessor(
+                pages_list,
+                file_name,
+                self.file_type,
+                self.sentence_splitter_cfg,
+            ).nodes
+        else:
+            paragraphs_list = file_content.get("paragraphs", [])
+            paragraphs_nodes = AzureParagraphProcessor(
+                paragraphs_list,
+                file_name,
+                self.file_type,
+                self.sentence_splitter_cfg,
+            ).nodes
+        nodes += paragraphs_nodes
 
-        # Process the loaded files
-        for file_name, file_content in self.all_files.items():
-
-            tables_list = file_content.get("tables", [])
-
-            # Process paragraph data
-            if self.polygon_group:
-                pages_list = file_content.get("pages", [])
-                paragraphs_nodes = AzurePolygonParagraphProcessor(
-                    pages_list,
-                    file_name,
-                    self.file_type,
-                    self.sentence_splitter_cfg,
-                ).nodes
-            else:
-                paragraphs_list = file_content.get("paragraphs", [])
-                paragraphs_nodes = AzureParagraphProcessor(
-                    paragraphs_list,
-                    file_name,
-                    self.file_type,
-                    self.sentence_splitter_cfg,
-                ).nodes
-            nodes += paragraphs_nodes
-
-            # Process table data
-            if self.include_table and tables_list:
-                table_content_nodes = AzureTablesProcessor(
-                    tables_list,
-                    file_name,
-                    self.file_type,
-                    self.by_token,
-                    self.token_limit,
-                ).nodes
-                nodes += table_content_nodes
+        # Process table data
+        if self.include_table and tables_list:
+            tables_processor = AzureTablesProcessor(
+                tables_list,
+                file_name,
+                self.file_type,
+                self.by_token,
+                self.token_limit,
+                serialization=self.table_serialization,
+                report_tokens=self.report_serialization_tokens,
+            )
+            nodes += tables_processor.nodes
+            for fmt, num_tokens in tables_processor.serialization_tokens.items():
+                self.serialization_tokens[fmt] += num_tokens
 
         return nodes
+
+
+# The processor used by the current worker process, set once by _init_worker
+_worker_processor = None
+
+
+def _init_worker(processor: AzureOutputProcessor) -> None:
+    global _worker_processor
+    _worker_processor = processor
+
+
+def _process_file(file_name: str):
+    # Loads and processes a single file in a worker process
+    loader = JsonFileLoader(_worker_processor.data_dir)
+    file_content = loader._load_a_file(file_name)
+    if not file_content:
+        return None, [], {}
+    document_name = loader.document_name(file_name)
+    # Only the table token counts of this file are sent back
+    _worker_processor.serialization_tokens = {fmt: 0 for fmt in TABLE_SERIALIZATIONS}
+    file_nodes = _worker_processor.get_file_nodes(document_name, file_content)
+    return document_name, file_nodes, _worker_processor.serialization_tokens
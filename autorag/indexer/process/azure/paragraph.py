@@ -1,3 +1,4 @@
+import numpy as np
 from llama_index.core.schema import Document, TextNode
 from llama_index.core.node_parser import SentenceSplitter
 
@@ -7,6 +8,9 @@ DEFAULT_EXCLUDED_ROLES: list[str] = ["pageHeader", "pageNumber"]
 # Define contents to be excluded
 DEFAULT_EXCLUDED_CONTENTS: list[str] = ["Contains Nonbinding Recommendations"]
 
+# Number of coordinates of an Azure word polygon (4 points)
+POLYGON_SIZE = 8
+
 
 class AzureParagraphProcessor:
     """
@@ -115,6 +119,75 @@ class AzureParagraphProcessor:
         return nodes
 
 
+class AzureWordStore:
+    """
+    Columnar store of the words of a document. The words are joined by single spaces
+    into one text buffer, word i spans text[starts[i]:ends[i]]. Page numbers and polygons
+    are arrays with one row per word, polygons are float64 so that the coordinates are
+    returned exactly as parsed.
+
+    :param pages: The list of pages returned from Azure.
+    """
+
+    def __init__(self, pages: list[dict]) -> None:
+        contents = []
+        page_numbers = []
+        page_word_counts = []
+        polygon_blocks = []
+        # Polygons that do not have POLYGON_SIZE coordinates, keyed by word index
+        self.irregular_polygons = {}
+
+        for page in pages:
+            words = page.get("words", [])
+            contents += [word.get("content", "").strip() for word in words]
+            page_numbers.append(page.get("pageNumber", 0))
+            page_word_counts.append(len(words))
+            polygon_blocks.append(
+                self._page_polygons(words, len(contents) - len(words))
+            )
+
+        self.text = " ".join(contents)
+        lengths = np.fromiter(map(len, contents), dtype=np.int64, count=len(contents))
+        # Every word is followed by a space, but the last one
+        self.ends = np.cumsum(lengths + 1) - 1
+        self.starts = self.ends - lengths
+        self.page_numbers = np.repeat(
+            np.asarray(page_numbers, dtype=np.int64), page_word_counts
+        )
+        if polygon_blocks:
+            self.polygons = np.concatenate(polygon_blocks)
+        else:
+            self.polygons = np.zeros((0, POLYGON_SIZE), dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def _page_polygons(self, words: list[dict], first_index: int) -> np.ndarray:
+        polygons = [word.get("polygon", []) for word in words]
+        if all(len(polygon) == POLYGON_SIZE for polygon in polygons):
+            return np.asarray(polygons, dtype=np.float64).reshape(-1, POLYGON_SIZE)
+        # Missing or malformed polygons are kept aside, their rows are left empty
+        block = np.full((len(words), POLYGON_SIZE), np.nan)
+        for i, polygon in enumerate(polygons):
+            if len(polygon) == POLYGON_SIZE:
+                block[i] = polygon
+            else:
+                self.irregular_polygons[first_index + i] = polygon
+        return block
+
+    def text_span(self, start: int, end: int) -> str:
+        """The words start to end (excluded) joined by spaces."""
+        return self.text[self.starts[start] : self.ends[end - 1]]
+
+    def page_number(self, i: int) -> int:
+        return int(self.page_numbers[i])
+
+    def polygon(self, i: int) -> list:
+        if i in self.irregular_polygons:
+            return self.irregular_polygons[i]
+        return self.polygons[i].tolist()
+
+
 class AzurePolygonParagraphProcessor:
     """
     Process azure paragraphs list with polygon tracking and chunk size control.
@@ -163,43 +236,25 @@ class AzurePolygonParagraphProcessor:
 
     def _create_nodes(self, filtered_pages: list[dict]) -> list[TextNode]:
         nodes = []
-        all_words = []
 
         # First, collect all words with their metadata
-        for page in filtered_pages:
-            words = page.get("words", [])
-            for word in words:
-                all_words.append(
-                    {
-                        "content": word.get("content", "").strip(),
-                        "page_number": page.get("pageNumber", 0),
-                        "polygon": word.get("polygon", []),
-                    }
-                )
+        words = AzureWordStore(filtered_pages)
 
         # Process words with overlap
         i = 0
-        while i < len(all_words):
-            current_words = []
-            first_page = all_words[i]["page_number"]
-            first_polygon = all_words[i]["polygon"]
-
+        while i < len(words):
             # Add words until we reach chunk_size
-            end_idx = min(i + self.chunk_size, len(all_words))
-            current_words = [all_words[j]["content"] for j in range(i, end_idx)]
-            current_page = all_words[end_idx - 1]["page_number"]
-            last_polygon = all_words[end_idx - 1]["polygon"]
+            end_idx = min(i + self.chunk_size, len(words))
 
             # Create node
-            if current_words:
-                node = self._create_single_node(
-                    " ".join(current_words),
-                    first_page,
-                    current_page,
-                    first_polygon,
-                    last_polygon,
-                )
-                nodes.append(node)
+            node = self._create_single_node(
+                words.text_span(i, end_idx),
+                words.page_number(i),
+                words.page_number(end_idx - 1),
+                words.polygon(i),
+                words.polygon(end_idx - 1),
+            )
+            nodes.append(node)
 
             # Move forward by (chunk_size - overlap) or at least 1 to avoid infinite loop
             step_size = max(self.chunk_size - self.chunk_overlap, 1)
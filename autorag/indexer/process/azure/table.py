@@ -1,6 +1,9 @@
+import csv
+import io
 from typing import List, Dict, Any, Optional
 from llama_index.core.schema import TextNode
-from nltk.tokenize import word_tokenize
+
+from autorag.utils.token_counter import TokenCounter, get_token_counter
 
 
 UNWANTED_CONTENT: dict[str, Any] = {
@@ -10,6 +13,10 @@ UNWANTED_CONTENT: dict[str, Any] = {
     "-\n:unselected: :unselected:": "-",
 }
 
+# dict: the Python repr of the list of row dicts, every row repeats the headers.
+# markdown and csv: one header line, then one line of values per row.
+TABLE_SERIALIZATIONS: list[str] = ["dict", "markdown", "csv"]
+
 
 class AzureTablesProcessor:
     """
@@ -20,6 +27,10 @@ class AzureTablesProcessor:
     :param file_type: The type of the file.
     :param by_token: Whether to process tables by token or by table row. if False, by row.
     :param token_limit: The maximum number of tokens in a single TextNode (usually limited by model)
+    :param token_counter: Counter of the tokens of the rows. If None, the shared token counter is used.
+    :param serialization: The text format of the table nodes, one of TABLE_SERIALIZATIONS.
+    :param report_tokens: Whether to count the tokens of the table nodes in every serialization,
+                          into serialization_tokens.
     """
 
     def __init__(
@@ -29,7 +40,14 @@ class AzureTablesProcessor:
         file_type: str = None,
         by_token: bool = True,
         token_limit: int = 3000,
+        token_counter: Optional[TokenCounter] = None,
+        serialization: str = "dict",
+        report_tokens: bool = False,
     ) -> None:
+        if serialization not in TABLE_SERIALIZATIONS:
+            raise ValueError(
+                f"serialization must be one of {TABLE_SERIALIZATIONS}, got {serialization}."
+            )
 
         # Initialize the AzureTablesProcessor class.
         self.azure_tables_list = azure_tables_list
@@ -37,6 +55,11 @@ class AzureTablesProcessor:
         self.file_type = file_type
         self.by_token = by_token
         self.token_limit = token_limit
+        self.token_counter = token_counter or get_token_counter()
+        self.serialization = serialization
+        self.report_tokens = report_tokens
+        # Tokens of the table nodes in every serialization, if report_tokens
+        self.serialization_tokens = {fmt: 0 for fmt in TABLE_SERIALIZATIONS}
         self.table_dataframes, self.table_pages = self.get_table_dataframes()
         self.nodes = self.get_table_nodes()
 
@@ -50,6 +73,8 @@ class AzureTablesProcessor:
         table_dataframes = []
         table_pages = []
         last_table_headers = None
+        # Header name of every column of the last table, reused by its continuations
+        last_column_headers = None
         last_table_name = ""
         last_table_col_count = 0
 
@@ -77,7 +102,10 @@ class AzureTablesProcessor:
             ):
                 # Construct the table using last table headers and name
                 single_table = SingleTableProcessor(
-                    table_cells, last_table_name, last_table_headers
+                    table_cells,
+                    last_table_name,
+                    last_table_headers,
+                    last_column_headers,
                 )
                 table_dataframes.append(single_table.table_dataframe)
                 table_pages.append(table_page)
@@ -97,6 +125,7 @@ class AzureTablesProcessor:
                 table_pages.append(table_page)
                 # save the table headers, table name, and table column count
                 last_table_headers = single_table.headers
+                last_column_headers = single_table.column_headers
                 last_table_name = single_table.table_name
                 last_table_col_count = len(last_table_headers[0])
 
@@ -127,10 +156,12 @@ class AzureTablesProcessor:
                     self.split_table_into_groups_by_token_limit(table_df)
                 )
 
+                headers = get_row_headers(table_df)
+
                 # Create a TextNode for each group of rows.
                 for group in groups_of_rows:
                     new_node = TextNode(
-                        text=str(group),
+                        text=self.serialize(group, headers),
                         metadata={
                             "from_table": table_title,
                             "page_number": table_page,
@@ -142,10 +173,11 @@ class AzureTablesProcessor:
         else:
             for idx, table_df in enumerate(self.table_dataframes):
                 table_page = self.table_pages[idx]
+                headers = get_row_headers(table_df, exclude_from=False)
                 for table_row_text in table_df:
                     # Create a new document for each page
                     new_node = TextNode(
-                        text=str(table_row_text),
+                        text=self.serialize(table_row_text, headers),
                         metadata={
                             "page_number": table_page,
                             "document_name": self.file_name,
@@ -166,8 +198,13 @@ class AzureTablesProcessor:
         :return table_title (str): The 'from' value extracted from the rows, if any.
         """
         groups_of_rows = []
+        headers = get_row_headers(table_df)
+        # Every group starts with the header line of the serialization
+        header_token_count = self.token_counter.count(
+            serialize_header(headers, self.serialization)
+        )
         current_group = []
-        current_group_token_count = 0
+        current_group_token_count = header_token_count
         table_title = None
 
         for row in table_df:
@@ -178,17 +215,18 @@ class AzureTablesProcessor:
             # Create a modified row without the 'from' key
             modified_row = {key: value for key, value in row.items() if key != "from"}
             # Convert the modified row to a string
-            modified_row_str = str(modified_row)
-            # Count tokens by splitting the string on whitespace
-            modified_row_tokens = word_tokenize(modified_row_str)
-            modified_row_token_count = len(modified_row_tokens)
+            modified_row_str = serialize_row(modified_row, headers, self.serialization)
+            # Count tokens with the tokenizer of the models, repeated rows are memoized
+            modified_row_token_count = self.token_counter.count(modified_row_str)
 
             # Check if adding the row exceeds the token limit
             if current_group_token_count + modified_row_token_count > self.token_limit:
                 # Start a new group if the current one exceeds the limit
                 groups_of_rows.append(current_group)
                 current_group = [modified_row]
-                current_group_token_count = modified_row_token_count
+                current_group_token_count = (
+                    header_token_count + modified_row_token_count
+                )
             else:
                 # Otherwise, add the row to the current group and update the token count
                 current_group.append(modified_row)
@@ -200,6 +238,32 @@ class AzureTablesProcessor:
 
         return groups_of_rows, table_title
 
+    def serialize(self, rows, headers: List[str]) -> str:
+        """
+        Serializes a group of rows (or a single row dict) in the configured format.
+
+        :param rows: A list of row dictionaries, or a single row dictionary.
+        :param headers: The column headers of the table.
+        :return: The text of the table node.
+        """
+        texts = {
+            fmt: self._serialize(rows, headers, fmt)
+            for fmt in (TABLE_SERIALIZATIONS if self.report_tokens else [])
+        }
+        for fmt, text in texts.items():
+            self.serialization_tokens[fmt] += self.token_counter.count(text)
+        if self.serialization in texts:
+            return texts[self.serialization]
+        return self._serialize(rows, headers, self.serialization)
+
+    @staticmethod
+    def _serialize(rows, headers: List[str], serialization: str) -> str:
+        if serialization == "dict":
+            # Keeps the repr of a single row dict, as in by-row mode
+            return str(rows)
+        group = [rows] if isinstance(rows, dict) else rows
+        return serialize_rows(group, headers, serialization)
+
     def get_table_page_number(self, data: Dict[str, Any]) -> int:
         """
         Extracts the page number from table data.
@@ -211,6 +275,65 @@ class AzureTablesProcessor:
         return bounding_regions[0].get("pageNumber", 0) if bounding_regions else 0
 
 
+def get_row_headers(
+    table_df: List[Dict[str, Any]], exclude_from: bool = True
+) -> List[str]:
+    """
+    Collects the keys of the rows of a table dataframe, in order of first appearance.
+
+    :param table_df: The table dataframe, a list of row dictionaries.
+    :param exclude_from: Whether to leave out the 'from' key holding the table name.
+    :return: The list of column headers.
+    """
+    headers = {}
+    for row in table_df:
+        for key in row:
+            if not (exclude_from and key == "from"):
+                headers[key] = None
+    return list(headers)
+
+
+def _markdown_line(values) -> str:
+    # Pipes and line breaks would break the markdown table
+    cells = [str(value).replace("|", "\\|").replace("\n", " ") for value in values]
+    return "| " + " | ".join(cells) + " |"
+
+
+def _csv_line(values) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerow(values)
+    return buffer.getvalue().rstrip("\n")
+
+
+def serialize_header(headers: List[str], serialization: str) -> str:
+    """The header line(s) of a table in the given serialization, empty for dict."""
+    if serialization == "markdown":
+        return _markdown_line(headers) + "\n" + _markdown_line(["---"] * len(headers))
+    if serialization == "csv":
+        return _csv_line(headers)
+    return ""
+
+
+def serialize_row(row: Dict[str, Any], headers: List[str], serialization: str) -> str:
+    """The line of a row in the given serialization, missing cells are left empty."""
+    if serialization == "markdown":
+        return _markdown_line(row.get(header, "") for header in headers)
+    if serialization == "csv":
+        return _csv_line([row.get(header, "") for header in headers])
+    return str(row)
+
+
+def serialize_rows(
+    rows: List[Dict[str, Any]], headers: List[str], serialization: str
+) -> str:
+    """Serializes a list of rows: the repr of the list for dict, a header line and one line per row otherwise."""
+    if serialization == "dict":
+        return str(rows)
+    lines = [serialize_header(headers, serialization)]
+    lines += [serialize_row(row, headers, serialization) for row in rows]
+    return "\n".join(lines)
+
+
 class SingleTableProcessor:
     """
     Processes a single table data from a list of tables.
@@ -225,6 +348,7 @@ class SingleTableProcessor:
         table_cells: List[Dict[str, Any]],
         table_name: Optional[str] = None,
         table_headers: Optional[List[Dict[str, str]]] = None,
+        column_headers: Optional[Dict[int, str]] = None,
     ) -> None:
         """
         Initializes a new instance of the SingleTableProcessor class.
@@ -232,10 +356,16 @@ class SingleTableProcessor:
         :param table_cells: List of dictionaries, each containing info about a cell.
         :param table_name: Optional name of the table.
         :param table_headers: Optional list of headers for the table.
+        :param column_headers: Optional header names already resolved from table_headers,
+                               keyed by column index (e.g. from the table this one continues).
         """
         self.cell_data = table_cells
         self.table_name = table_name
         self.headers = table_headers
+        # Header name of every column, resolved once per column by find_cell_header
+        self.column_headers: Dict[int, str] = (
+            column_headers if table_headers is not None and column_headers else {}
+        )
 
         self.table_rows: Dict[int, Dict[str, Any]] = self.build_table_rows()
         self.table_dataframe: List[Dict[str, Any]] = self.build_table_df()
@@ -269,11 +399,17 @@ class SingleTableProcessor:
             if col_idx == 0:
                 row_kind = cell_kind
 
-            for r in range(row_span):
-                for c in range(col_span):
-                    if row_idx + r not in table_rows:
-                        table_rows[row_idx + r] = {"kind": row_kind, "content": {}}
-                    table_rows[row_idx + r]["content"][col_idx + c] = content
+            for r in range(row_idx, row_idx + row_span):
+                row = table_rows.get(r)
+                if row is None:
+                    row = table_rows[r] = {"kind": row_kind, "content": {}}
+                if col_span == 1:
+                    row["content"][col_idx] = content
+                else:
+                    # The content of the cell, for every column it spans
+                    row["content"].update(
+                        dict.fromkeys(range(col_idx, col_idx + col_span), content)
+                    )
         return table_rows
 
     def build_table_df(self) -> List[Dict[str, Any]]:
@@ -300,9 +436,12 @@ class SingleTableProcessor:
                 continue
 
             row_dict = {"from": self.table_name}
+            column_headers = self.column_headers
             for col_idx, content in row_data["content"].items():
                 content = UNWANTED_CONTENT.get(content, content)
-                header = self.find_cell_header(col_idx)
+                header = column_headers.get(col_idx)
+                if header is None:
+                    header = column_headers[col_idx] = self.find_cell_header(col_idx)
                 row_dict[header] = content
             table_dataframe.append(row_dict)
 
@@ -1,6 +1,12 @@
 import os
 import json
 
+try:
+    # Optional faster parser, falls back to the standard library
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class JsonFileLoader:
     """
@@ -8,7 +14,8 @@ class JsonFileLoader:
 
     Iterate through each file in the directory. Check if it's a JSON file
     by its extension. Load it using the _load_a_file method, and add to
-    the all_files dict.
+    the all_files dict. Use iter_files to get one document at a time instead.
+    Files are parsed with orjson when it is installed.
 
     :param data_dir (str): Path to the data directory.
     """
@@ -23,20 +30,42 @@ class JsonFileLoader:
 
         self.data_dir = data_dir
 
-    def load(self) -> dict:
-        all_files = {}
-        for filename in os.listdir(self.data_dir):
+    def load(self, file_names: list[str] = None) -> dict:
+        # Store data with filename as key
+        return dict(self.iter_files(file_names))
+
+    def iter_files(self, file_names: list[str] = None):
+        """
+        Loads the files one at a time, so that only one parsed file is held in
+        memory while the caller processes it.
+
+        :param file_names: Optional list of file names to load.
+        :return: A generator of (document name, data) tuples.
+        """
+        for filename in self.list_files(file_names):
             data = self._load_a_file(filename)
-            # Store data with filename as key
             if data:
-                filename = filename.split(".")[0]
-                all_files[filename] = data
-        return all_files
+                yield self.document_name(filename), data
+
+    def list_files(self, file_names: list[str] = None) -> list[str]:
+        # Only list the given files if file_names is provided.
+        # Sorted, so that files are always processed in the same order.
+        if file_names is None:
+            file_names = os.listdir(self.data_dir)
+        return sorted(file_names)
+
+    @staticmethod
+    def document_name(filename: str) -> str:
+        # The document name of a file is its filename without extension
+        return filename.split(".")[0]
 
     def _load_a_file(self, filename: str):
         # Internal method to load a single JSON file.
         # Open the file, load the JSON content, and return the data.
         if filename.endswith(".json"):
             filepath = os.path.join(self.data_dir, filename)
+            if orjson is not None:
+                with open(filepath, "rb") as file:
+                    return orjson.loads(file.read())
             with open(filepath, "r") as file:
                 return json.load(file)
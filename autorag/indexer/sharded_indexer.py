@@ -0,0 +1,142 @@
+"""
+Indexes made of several shards. Files are partitioned across shards by the hash of their document name,
+each shard is a complete ExpandedIndexer persisted in its own directory and can be built independently.
+"""
+
+import hashlib
+import json
+import os
+
+from llama_index.core import Settings
+
+from .expanded_indexer import ExpandedIndexer
+from .process.utils.json import JsonFileLoader
+from autorag.retriever.post_processors.node_expander import NodeExpander
+from autorag.retriever.sharded_retriever import ShardedRetriever
+
+SHARDING_CONFIG_PATH = "sharding.json"
+SHARD_BASENAME = "shard_{}"
+
+
+class ShardedIndexer:
+    """A set of ExpandedIndexer shards searched as a single index"""
+
+    def __init__(self, shards, node_expander=None):
+        self.shards = shards
+        self.node_expander = node_expander
+
+    @classmethod
+    def load(
+        cls,
+        index_dir,
+        enable_node_expander=False,
+        embedding_cache_cfg=None,
+        vector_search_cfg=None,
+    ):
+        sharding_config = ShardedIndexer.load_sharding_config(index_dir)
+        shards = [
+            ExpandedIndexer.load(
+                ShardedIndexer.get_shard_dir(index_dir, shard_id),
+                enable_node_expander,
+                embedding_cache_cfg,
+                vector_search_cfg,
+            )
+            for shard_id in range(sharding_config["num_shards"])
+        ]
+        if enable_node_expander:
+            # Shards are partitioned by document, so are the parent nodes
+            node_expander = NodeExpander.merge(
+                [shard.node_expander for shard in shards]
+            )
+        else:
+            node_expander = None
+        return cls(shards, node_expander)
+
+    @property
+    def duplicates(self):
+        duplicates = {}
+        for shard in self.shards:
+            duplicates.update(shard.duplicates)
+        return duplicates
+
+    @property
+    def non_empty_shards(self):
+        # Documents are hashed to the shards, small corpora may leave some shards without any node
+        return [shard for shard in self.shards if shard.index.index_struct.nodes_dict]
+
+    def as_retriever(self, similarity_top_k, **kwargs):
+        shard_retrievers = [
+            shard.as_retriever(similarity_top_k=similarity_top_k, **kwargs)
+            for shard in self.non_empty_shards
+        ]
+        return ShardedRetriever(
+            shard_retrievers, similarity_top_k, embed_model=Settings.embed_model
+        )
+
+    def as_bm25_retriever(self, similarity_top_k):
+        shard_retrievers = [
+            shard.as_bm25_retriever(similarity_top_k) for shard in self.non_empty_shards
+        ]
+        # BM25 scores depend on the corpus statistics of each shard, merge the shards by rank
+        return ShardedRetriever(shard_retrievers, similarity_top_k, fusion="rrf")
+
+    def filter_node_ids(self, filters):
+        return [
+            node_id
+            for shard in self.shards
+            for node_id in shard.filter_node_ids(filters)
+        ]
+
+    def as_document_routing_retriever(self, similarity_top_k, top_documents=20):
+        # Every shard routes the query to its own top documents
+        shard_retrievers = [
+            shard.as_document_routing_retriever(similarity_top_k, top_documents)
+            for shard in self.non_empty_shards
+        ]
+        return ShardedRetriever(
+            shard_retrievers, similarity_top_k, embed_model=Settings.embed_model
+        )
+
+    @staticmethod
+    def get_shard_id(file_name, num_shards):
+        # A stable hash, so that every machine assigns a file to the same shard
+        document_name = JsonFileLoader.document_name(file_name)
+        digest = hashlib.sha1(document_name.encode("utf-8")).hexdigest()
+        return int(digest, 16) % num_shards
+
+    @staticmethod
+    def partition_files(data_dir, num_shards):
+        """Returns the list of file names of every shard."""
+        shard_files = [[] for _ in range(num_shards)]
+        for file_name in sorted(os.listdir(data_dir)):
+            shard_id = ShardedIndexer.get_shard_id(file_name, num_shards)
+            shard_files[shard_id].append(file_name)
+        return shard_files
+
+    @staticmethod
+    def is_sharded(index_dir):
+        return os.path.exists(os.path.join(index_dir, SHARDING_CONFIG_PATH))
+
+    @staticmethod
+    def persist_sharding_config(index_dir, num_shards):
+        os.makedirs(index_dir, exist_ok=True)
+        with open(os.path.join(index_dir, SHARDING_CONFIG_PATH), "w") as f:
+            f.write(json.dumps({"num_shards": num_shards}))
+
+    @staticmethod
+    def load_sharding_config(index_dir):
+        with open(
+            os.path.join(index_dir, SHARDING_CONFIG_PATH), "r", encoding="utf-8"
+        ) as f:
+            return json.loads(f.read())
+
+    @staticmethod
+    def get_shard_dir(index_dir, shard_id):
+        return os.path.join(index_dir, SHARD_BASENAME.format(shard_id))
+
+
+def load_indexer(index_dir, *args, **kwargs):
+    """Load a ShardedIndexer or an ExpandedIndexer, depending on how index_dir was built."""
+    if ShardedIndexer.is_sharded(index_dir):
+        return ShardedIndexer.load(index_dir, *args, **kwargs)
+    return ExpandedIndexer.load(index_dir, *args, **kwargs)
@@ -0,0 +1,164 @@
+"""
+Inverted file (IVF) index for approximate nearest neighbour search on CPU.
+Vectors are clustered with spherical k-means. A query only scores the vectors of the nprobe
+clusters whose centroids are the closest to it.
+"""
+
+import math
+import os
+from typing import Optional
+
+import numpy as np
+
+# Number of training vectors sampled per cluster
+TRAIN_SAMPLES_PER_LIST = 256
+# Number of rows assigned at once, to bound the temporary memory
+BLOCK_SIZE = 1 << 16
+# Retrain once the number of rows grew by this factor since training,
+# e.g. when an index is built in steps and was first queried or persisted when small
+RETRAIN_GROWTH = 2
+CENTROIDS_SUFFIX = ".ivf_centroids.npy"
+LIST_OFFSETS_SUFFIX = ".ivf_offsets.npy"
+LIST_ROWS_SUFFIX = ".ivf_rows.npy"
+
+
+class IVFIndex:
+    """
+    Clusters of row ids of a normalized matrix, stored in CSR form: the rows of cluster i
+    are list_rows[list_offsets[i]:list_offsets[i + 1]].
+
+    :param nlist: Number of clusters. If None, 4 * sqrt(num_vectors) is used.
+    :param nprobe: Number of clusters searched per query. Higher is more accurate but slower.
+    :param num_iterations: Number of k-means iterations.
+    :param seed: Seed of the k-means initialization.
+    """
+
+    def __init__(
+        self,
+        nlist: Optional[int] = None,
+        nprobe: int = 16,
+        num_iterations: int = 10,
+        seed: int = 0,
+    ) -> None:
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.num_iterations = num_iterations
+        self.seed = seed
+        self.centroids: Optional[np.ndarray] = None
+        self.list_offsets: Optional[np.ndarray] = None
+        self.list_rows: Optional[np.ndarray] = None
+        # Number of rows when the centroids were trained
+        self.num_trained_rows = 0
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    @property
+    def num_rows(self) -> int:
+        return 0 if self.list_rows is None else len(self.list_rows)
+
+    def needs_retraining(self, num_vectors: int) -> bool:
+        return num_vectors >= RETRAIN_GROWTH * max(self.num_trained_rows, 1)
+
+    def train(self, matrix: np.ndarray) -> None:
+        """Runs spherical k-means on a sample of the matrix and assigns all its rows."""
+        num_vectors = len(matrix)
+        nlist = self.nlist or max(1, int(4 * math.sqrt(num_vectors)))
+        nlist = min(nlist, num_vectors)
+        rng = np.random.default_rng(self.seed)
+        num_samples = min(num_vectors, nlist * TRAIN_SAMPLES_PER_LIST)
+        sample_rows = np.sort(rng.choice(num_vectors, num_samples, replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+
+        centroids = sample[rng.choice(num_samples, nlist, replace=False)]
+        for _ in range(self.num_iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=nlist)
+            empty = counts == 0
+            # Re-seed empty clusters with random samples
+            sums[empty] = sample[rng.choice(num_samples, int(empty.sum()))]
+            centroids = _normalize(sums)
+
+        self.centroids = centroids
+        self.num_trained_rows = num_vectors
+        self.list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        self.list_rows = np.zeros(0, dtype=np.int64)
+        self.add(matrix, start_row=0)
+
+    def add(self, matrix: np.ndarray, start_row: Optional[int] = None) -> None:
+        """Assigns the rows of the matrix from start_row (default: the first unassigned row) on."""
+        start_row = self.num_rows if start_row is None else start_row
+        new_assignments = []
+        for start in range(start_row, len(matrix), BLOCK_SIZE):
+            block = np.asarray(matrix[start : start + BLOCK_SIZE], dtype=np.float32)
+            new_assignments.append(np.argmax(block @ self.centroids.T, axis=1))
+        if not new_assignments:
+            return
+        new_assignments = np.concatenate(new_assignments)
+        new_rows = np.arange(start_row, start_row + len(new_assignments))
+
+        nlist = len(self.centroids)
+        old_assignments = np.repeat(np.arange(nlist), np.diff(self.list_offsets))
+        assignments = np.concatenate([old_assignments, new_assignments])
+        rows = np.concatenate([self.list_rows, new_rows])
+        order = np.argsort(assignments, kind="stable")
+        self.list_rows = rows[order]
+        self.list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        self.list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=nlist))
+
+    def search(self, query_vector: np.ndarray, nprobe: Optional[int] = None):
+        """Returns the rows of the nprobe clusters closest to the normalized query vector."""
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_scores = self.centroids @ query_vector
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.concatenate(
+            [
+                self.list_rows[self.list_offsets[p] : self.list_offsets[p + 1]]
+                for p in probes
+            ]
+        )
+
+    def compacted(self, alive: np.ndarray):
+        """Returns a copy without the rows that are not alive, with the remaining rows renumbered."""
+        new_row_ids = np.cumsum(alive) - 1
+        nlist = len(self.centroids)
+        assignments = np.repeat(np.arange(nlist), np.diff(self.list_offsets))
+        keep = alive[self.list_rows]
+        ivf_index = IVFIndex(self.nlist, self.nprobe, self.num_iterations, self.seed)
+        ivf_index.centroids = self.centroids
+        ivf_index.num_trained_rows = self.num_trained_rows
+        ivf_index.list_rows = new_row_ids[self.list_rows[keep]]
+        ivf_index.list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        ivf_index.list_offsets[1:] = np.cumsum(
+            np.bincount(assignments[keep], minlength=nlist)
+        )
+        return ivf_index
+
+    def persist(self, base_path: str) -> None:
+        arrays = {
+            CENTROIDS_SUFFIX: self.centroids,
+            LIST_OFFSETS_SUFFIX: self.list_offsets,
+            LIST_ROWS_SUFFIX: self.list_rows,
+        }
+        for suffix, array in arrays.items():
+            with open(base_path + suffix + ".tmp", "wb") as f:
+                np.save(f, array)
+        for suffix in arrays:
+            os.replace(base_path + suffix + ".tmp", base_path + suffix)
+
+    @classmethod
+    def from_persist_path(cls, base_path: str, nlist=None, nprobe: int = 16):
+        ivf_index = cls(nlist=nlist, nprobe=nprobe)
+        ivf_index.centroids = np.load(base_path + CENTROIDS_SUFFIX)
+        ivf_index.list_offsets = np.load(base_path + LIST_OFFSETS_SUFFIX)
+        ivf_index.list_rows = np.load(base_path + LIST_ROWS_SUFFIX, mmap_mode="r")
+        ivf_index.num_trained_rows = ivf_index.num_rows
+        return ivf_index
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
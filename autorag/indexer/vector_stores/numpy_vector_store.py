@@ -0,0 +1,402 @@
+"""
+Vector store persisted as an id table plus a contiguous NumPy matrix.
+The matrix is loaded with mmap, so loading is immediate and the pages are shared by all the processes
+serving the same index.
+"""
+
+import asyncio
+import json
+import os
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    DEFAULT_PERSIST_DIR,
+    DEFAULT_PERSIST_FNAME,
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.simple import NAMESPACE_SEP, DEFAULT_VECTOR_STORE
+
+from .ivf import IVFIndex
+from .quantization import (
+    QUANTIZATION_TYPES,
+    fit_int8_scales,
+    quantize_binary,
+    quantize_int8,
+    score_binary,
+    score_int8,
+)
+
+IDS_SUFFIX = ".ids.json"
+VECTORS_SUFFIX = ".vectors.npy"
+CODES_SUFFIX = ".codes.npy"
+SCALES_SUFFIX = ".scales.npy"
+SUPPORTED_DTYPES = ["float32", "float16"]
+ANN_TYPES = ["none", "ivf"]
+# Number of rows scored at once when the matrix needs to be upcast
+SCORE_BLOCK_SIZE = 1 << 16
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """
+    Stores L2-normalized embeddings in a single (num_vectors, dim) matrix and searches it with
+    a vectorized cosine similarity top-k.
+
+    With quantization, candidates are generated from int8 (4x smaller than float32) or 1-bit
+    (32x smaller) codes and only the top rescore_candidates are rescored with the full-precision
+    vectors. Since the full-precision matrix is mmap-ed, only the pages of the candidates are read.
+    The stated tolerance is that with rescore_candidates >= 100 * similarity_top_k, hit_rate and MRR
+    stay within 0.01 (int8) and 0.02 (binary) of the exact search. tests/test_quantization_recall.py
+    checks it with autorag.retriever.evaluate on a synthetic clustered benchmark (2000 vectors of
+    dimension 128, exact hit_rate@5 0.63): int8 matches the exact search and binary MRR is 0.0002 off.
+    It has not been measured on a production corpus yet, compare the evaluate runs of a quantized
+    and an exact build before relying on it.
+
+    With ann_type=ivf, a query only scores the vectors of the nprobe clusters closest to it
+    (see IVFIndex), trading recall for latency.
+
+    :param dtype: dtype of the persisted matrix, float32 or float16.
+    :param quantization: none, int8 or binary.
+    :param rescore_candidates: Number of candidates rescored with full precision.
+    :param ann_type: none (exhaustive search) or ivf.
+    :param nlist: Number of IVF clusters. If None, 4 * sqrt(num_vectors).
+    :param nprobe: Number of IVF clusters searched per query.
+    """
+
+    stores_text: bool = False
+    dtype: str = Field(default="float32", description="dtype of the stored vectors")
+    quantization: str = Field(
+        default="none", description="Quantization of the candidate generation codes"
+    )
+    rescore_candidates: int = Field(
+        default=200, description="Number of candidates rescored with full precision"
+    )
+    ann_type: str = Field(default="none", description="Approximate search index")
+    nlist: Optional[int] = Field(default=None, description="Number of IVF clusters")
+    nprobe: int = Field(default=16, description="Number of IVF clusters searched")
+
+    _node_ids: List[str] = PrivateAttr(default_factory=list)
+    _ref_doc_ids: List[Optional[str]] = PrivateAttr(default_factory=list)
+    _id_to_row: dict = PrivateAttr(default_factory=dict)
+    _matrix: Optional[np.ndarray] = PrivateAttr(default=None)
+    _pending: List[np.ndarray] = PrivateAttr(default_factory=list)
+    _alive: Optional[np.ndarray] = PrivateAttr(default=None)
+    _codes: Optional[np.ndarray] = PrivateAttr(default=None)
+    _scales: Optional[np.ndarray] = PrivateAttr(default=None)
+    _ivf_index: Optional[IVFIndex] = PrivateAttr(default=None)
+
+    def __init__(
+        self,
+        dtype: str = "float32",
+        quantization: str = "none",
+        rescore_candidates: int = 200,
+        ann_type: str = "none",
+        nlist: Optional[int] = None,
+        nprobe: int = 16,
+        **kwargs: Any,
+    ) -> None:
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"dtype must be one of {SUPPORTED_DTYPES}, got {dtype}.")
+        if quantization not in QUANTIZATION_TYPES:
+            raise ValueError(
+                f"quantization must be one of {QUANTIZATION_TYPES}, got {quantization}."
+            )
+        if ann_type not in ANN_TYPES:
+            raise ValueError(f"ann_type must be one of {ANN_TYPES}, got {ann_type}.")
+        super().__init__(
+            dtype=dtype,
+            quantization=quantization,
+            rescore_candidates=rescore_candidates,
+            ann_type=ann_type,
+            nlist=nlist,
+            nprobe=nprobe,
+            **kwargs,
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "NumpyVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    @property
+    def node_ids(self) -> List[str]:
+        return self._node_ids
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """The (num_vectors, dim) matrix, including the rows of deleted nodes."""
+        if self._pending:
+            self._codes, self._scales = None, None
+            blocks = [self._matrix] if self._matrix is not None else []
+            # Copies an mmap-ed matrix into memory, only happens when adding to a loaded store
+            self._matrix = np.concatenate(blocks + self._pending).astype(self.dtype)
+            self._pending = []
+        if self._matrix is None:
+            return np.zeros((0, 0), dtype=self.dtype)
+        return self._matrix
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        vectors = normalize(
+            np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        )
+        self._pending.append(vectors.astype(self.dtype))
+        self._alive = np.concatenate(
+            [self._alive_mask(), np.ones(len(nodes), dtype=bool)]
+        )
+        for node in nodes:
+            self._id_to_row[node.node_id] = len(self._node_ids)
+            self._node_ids.append(node.node_id)
+            self._ref_doc_ids.append(node.ref_doc_id)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        rows = [i for i, r_id in enumerate(self._ref_doc_ids) if r_id == ref_doc_id]
+        self._delete_rows(rows)
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[Any] = None,
+        **delete_kwargs: Any,
+    ) -> None:
+        if filters is not None:
+            raise ValueError("NumpyVectorStore does not support metadata filters.")
+        rows = [
+            self._id_to_row[n_id] for n_id in node_ids or [] if n_id in self._id_to_row
+        ]
+        self._delete_rows(rows)
+
+    def clear(self) -> None:
+        self._node_ids, self._ref_doc_ids, self._id_to_row = [], [], {}
+        self._matrix, self._pending, self._alive = None, [], None
+        self._codes, self._scales = None, None
+        self._ivf_index = None
+
+    @property
+    def ivf_index(self) -> Optional[IVFIndex]:
+        """The IVF index of the matrix rows, trained on first use and extended with the added rows.
+        Retrained when the matrix grew a lot since training, e.g. across the checkpoints of a build.
+        """
+        matrix = self.matrix
+        if self.ann_type == "none" or len(matrix) == 0:
+            return None
+        if self._ivf_index is None or self._ivf_index.needs_retraining(len(matrix)):
+            self._ivf_index = IVFIndex(nlist=self.nlist, nprobe=self.nprobe)
+            self._ivf_index.train(matrix)
+        elif self._ivf_index.num_rows < len(matrix):
+            self._ivf_index.add(matrix)
+        return self._ivf_index
+
+    @property
+    def codes(self) -> Optional[np.ndarray]:
+        """The quantized codes of the matrix rows, computed on first use."""
+        matrix = self.matrix
+        if self.quantization == "none":
+            return None
+        if self._codes is None or len(self._codes) != len(matrix):
+            if self.quantization == "int8":
+                self._scales = fit_int8_scales(matrix)
+                self._codes = quantize_int8(matrix, self._scales)
+            else:
+                self._codes = quantize_binary(matrix)
+        return self._codes
+
+    def _alive_mask(self) -> np.ndarray:
+        if self._alive is None:
+            return np.ones(len(self._node_ids), dtype=bool)
+        return self._alive
+
+    def _delete_rows(self, rows: List[int]) -> None:
+        alive = self._alive_mask().copy()
+        alive[rows] = False
+        self._alive = alive
+        for row in rows:
+            self._id_to_row.pop(self._node_ids[row], None)
+
+    def get_embeddings(self, node_ids: List[str]) -> np.ndarray:
+        """Returns the normalized vectors of the given nodes as float32."""
+        rows = [self._id_to_row[n_id] for n_id in node_ids]
+        return np.asarray(self.matrix[rows], dtype=np.float32)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.filters is not None:
+            raise ValueError("NumpyVectorStore does not support metadata filters.")
+        query_vector = normalize(np.asarray(query.query_embedding, dtype=np.float32))
+
+        if query.node_ids is not None:
+            # sorted and unique, _score_rows scores the whole matrix when all the rows are requested
+            rows = np.unique(
+                np.fromiter(
+                    (
+                        self._id_to_row[n_id]
+                        for n_id in query.node_ids
+                        if n_id in self._id_to_row
+                    ),
+                    dtype=np.int64,
+                )
+            )
+        elif self.ann_type == "ivf":
+            rows = self.ivf_index.search(query_vector, self.nprobe)
+            # The rows come in cluster order, _score_rows and top_k expect them sorted
+            rows = np.sort(rows[self._alive_mask()[rows]])
+        else:
+            rows = np.flatnonzero(self._alive_mask())
+        if len(rows) == 0:
+            # e.g. a shard of a sharded index that got no documents
+            return VectorStoreQueryResult(similarities=[], ids=[])
+        num_candidates = max(self.rescore_candidates, query.similarity_top_k)
+        if self.quantization != "none" and len(rows) > num_candidates:
+            # Generate candidates from the quantized codes, then rescore them
+            if self.quantization == "int8":
+                approx_scores = score_int8(self.codes, self._scales, query_vector, rows)
+            else:
+                approx_scores = score_binary(self.codes, query_vector, rows)
+            rows, _ = top_k(rows, approx_scores, num_candidates)
+            rows = np.sort(rows)  # sequential reads of the mmap-ed matrix
+        scores = self._score_rows(query_vector, rows)
+        top_rows, top_scores = top_k(rows, scores, query.similarity_top_k)
+        return VectorStoreQueryResult(
+            similarities=top_scores.tolist(),
+            ids=[self._node_ids[row] for row in top_rows],
+        )
+
+    async def aquery(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> VectorStoreQueryResult:
+        # BLAS releases the GIL, the event loop keeps serving other queries meanwhile
+        return await asyncio.to_thread(self.query, query, **kwargs)
+
+    def _score_rows(self, query_vector: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        matrix = self.matrix
+        # The whole matrix is scored at once only when rows is exactly arange(len(matrix))
+        all_rows = len(rows) == len(matrix) and np.array_equal(
+            rows, np.arange(len(matrix))
+        )
+        if matrix.dtype == np.float32:
+            # BLAS reads the mmap-ed pages directly, without copying the matrix
+            return matrix @ query_vector if all_rows else matrix[rows] @ query_vector
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), SCORE_BLOCK_SIZE):
+            block_rows = rows[start : start + SCORE_BLOCK_SIZE]
+            if all_rows:
+                block = matrix[start : start + SCORE_BLOCK_SIZE]
+            else:
+                block = matrix[block_rows]
+            scores[start : start + len(block_rows)] = (
+                block.astype(np.float32) @ query_vector
+            )
+        return scores
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        """Compacts the deleted rows and writes the id table and the matrix next to persist_path."""
+        base_path = os.path.splitext(persist_path)[0]
+        dirpath = os.path.dirname(base_path)
+        if dirpath:
+            os.makedirs(dirpath, exist_ok=True)
+        alive = self._alive_mask()
+        matrix = self.matrix
+        if not alive.all():
+            matrix = matrix[alive]
+        node_ids = [n_id for n_id, keep in zip(self._node_ids, alive) if keep]
+        ref_doc_ids = [r_id for r_id, keep in zip(self._ref_doc_ids, alive) if keep]
+        # Write to temporary files first: the current matrix may be mmap-ed from the target file
+        with open(base_path + IDS_SUFFIX + ".tmp", "w", encoding="utf-8") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "dtype": self.dtype,
+                        "quantization": self.quantization,
+                        "rescore_candidates": self.rescore_candidates,
+                        "ann_type": self.ann_type,
+                        "nlist": self.nlist,
+                        "nprobe": self.nprobe,
+                        "node_ids": node_ids,
+                        "ref_doc_ids": ref_doc_ids,
+                    }
+                )
+            )
+        arrays = {VECTORS_SUFFIX: matrix}
+        if self.quantization != "none":
+            codes = self.codes
+            arrays[CODES_SUFFIX] = codes if alive.all() else codes[alive]
+        if self.quantization == "int8":
+            arrays[SCALES_SUFFIX] = self._scales
+        for suffix, array in arrays.items():
+            with open(base_path + suffix + ".tmp", "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+        for suffix in [IDS_SUFFIX] + list(arrays):
+            os.replace(base_path + suffix + ".tmp", base_path + suffix)
+        ivf_index = self.ivf_index
+        if ivf_index is not None:
+            if not alive.all():
+                ivf_index = ivf_index.compacted(alive)
+            ivf_index.persist(base_path)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str, mmap: bool = True):
+        base_path = os.path.splitext(persist_path)[0]
+        with open(base_path + IDS_SUFFIX, "r", encoding="utf-8") as f:
+            data = json.loads(f.read())
+        vector_store = cls(
+            dtype=data["dtype"],
+            quantization=data.get("quantization", "none"),
+            rescore_candidates=data.get("rescore_candidates", 200),
+            ann_type=data.get("ann_type", "none"),
+            nlist=data.get("nlist", None),
+            nprobe=data.get("nprobe", 16),
+        )
+        vector_store._node_ids = data["node_ids"]
+        vector_store._ref_doc_ids = data["ref_doc_ids"]
+        vector_store._id_to_row = {n_id: i for i, n_id in enumerate(data["node_ids"])}
+        vector_store._matrix = np.load(
+            base_path + VECTORS_SUFFIX, mmap_mode="r" if mmap else None
+        )
+        if vector_store.quantization != "none":
+            # The codes are searched for every query and kept in memory
+            vector_store._codes = np.load(base_path + CODES_SUFFIX)
+        if vector_store.quantization == "int8":
+            vector_store._scales = np.load(base_path + SCALES_SUFFIX)
+        if vector_store.ann_type != "none" and len(data["node_ids"]):
+            vector_store._ivf_index = IVFIndex.from_persist_path(
+                base_path, vector_store.nlist, vector_store.nprobe
+            )
+        return vector_store
+
+    @classmethod
+    def from_persist_dir(
+        cls,
+        persist_dir: str = DEFAULT_PERSIST_DIR,
+        namespace: str = DEFAULT_VECTOR_STORE,
+        mmap: bool = True,
+    ):
+        persist_path = os.path.join(
+            persist_dir, f"{namespace}{NAMESPACE_SEP}{DEFAULT_PERSIST_FNAME}"
+        )
+        return cls.from_persist_path(persist_path, mmap=mmap)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(rows: np.ndarray, scores: np.ndarray, k: int):
+    """Returns the rows with the k highest scores and their scores, sorted by descending score."""
+    k = min(k, len(scores))
+    if k == 0:
+        return rows[:0], scores[:0]
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    order = candidates[np.argsort(-scores[candidates], kind="stable")]
+    return rows[order], scores[order]
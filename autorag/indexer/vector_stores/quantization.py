@@ -0,0 +1,67 @@
+"""
+Scalar (int8) and binary (1-bit) quantization of normalized vectors, used for candidate generation.
+"""
+
+import numpy as np
+
+QUANTIZATION_TYPES = ["none", "int8", "binary"]
+# Number of rows encoded or scored at once, to bound the temporary memory
+BLOCK_SIZE = 1 << 16
+# Number of set bits of every byte value
+POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(
+    axis=1, dtype=np.uint16
+)
+
+
+def fit_int8_scales(matrix: np.ndarray) -> np.ndarray:
+    """Per-dimension scales mapping the largest absolute value of each dimension to 127."""
+    max_abs = np.zeros(matrix.shape[1], dtype=np.float32)
+    for start in range(0, len(matrix), BLOCK_SIZE):
+        block = np.abs(np.asarray(matrix[start : start + BLOCK_SIZE], np.float32))
+        max_abs = np.maximum(max_abs, block.max(axis=0))
+    return np.maximum(max_abs, 1e-12) / 127.0
+
+
+def quantize_int8(matrix: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    codes = np.empty(matrix.shape, dtype=np.int8)
+    for start in range(0, len(matrix), BLOCK_SIZE):
+        block = np.asarray(matrix[start : start + BLOCK_SIZE], np.float32)
+        codes[start : start + len(block)] = np.clip(np.rint(block / scales), -127, 127)
+    return codes
+
+
+def score_int8(
+    codes: np.ndarray, scales: np.ndarray, query_vector: np.ndarray, rows: np.ndarray
+) -> np.ndarray:
+    """Approximate dot products of the query with the rows, computed on the int8 codes."""
+    # (codes * scales) @ q == codes @ (scales * q)
+    scaled_query = (scales * query_vector).astype(np.float32)
+    scores = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), BLOCK_SIZE):
+        block = codes[rows[start : start + BLOCK_SIZE]]
+        scores[start : start + len(block)] = block.astype(np.float32) @ scaled_query
+    return scores
+
+
+def quantize_binary(matrix: np.ndarray) -> np.ndarray:
+    """Packs the sign of every dimension into one bit."""
+    num_bytes = (matrix.shape[1] + 7) // 8
+    codes = np.empty((len(matrix), num_bytes), dtype=np.uint8)
+    for start in range(0, len(matrix), BLOCK_SIZE):
+        block = np.asarray(matrix[start : start + BLOCK_SIZE])
+        codes[start : start + len(block)] = np.packbits(block > 0, axis=1)
+    return codes
+
+
+def score_binary(
+    codes: np.ndarray, query_vector: np.ndarray, rows: np.ndarray
+) -> np.ndarray:
+    """Approximate similarities from the hamming distance between the sign bits."""
+    query_code = np.packbits(query_vector > 0)
+    dim = len(query_vector)
+    scores = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), BLOCK_SIZE):
+        block = codes[rows[start : start + BLOCK_SIZE]]
+        hamming = POPCOUNT_TABLE[np.bitwise_xor(block, query_code)].sum(axis=1)
+        scores[start : start + len(block)] = 1.0 - 2.0 * hamming / dim
+    return scores
@@ -0,0 +1,187 @@
+"""
+Coarse-to-fine retrieval: the query is first routed to the documents with the closest document vectors,
+the centroid of the embeddings of their chunks, then only the chunks of these documents are searched.
+The documents are the parent nodes of the NodeExpander.
+"""
+
+import json
+import os
+from typing import List, Optional
+import numpy as np
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from autorag.indexer.vector_stores.numpy_vector_store import (
+    NumpyVectorStore,
+    normalize,
+    top_k,
+)
+
+DOCUMENT_VECTORS_BASENAME = "document_vectors.npy"
+DOCUMENT_IDS_BASENAME = "document_vectors.ids.json"
+
+
+class DocumentRoutingRetriever(BaseRetriever):
+    """Custom retriever that searches the chunks of the top_documents documents closest to the query."""
+
+    def __init__(
+        self,
+        index,
+        node_expander,
+        document_vectors: np.ndarray,
+        similarity_top_k: int,
+        top_documents: int = 20,
+        embed_model: Optional[BaseEmbedding] = None,
+    ) -> None:
+        """
+        :param index: The VectorStoreIndex of the chunks.
+        :param node_expander: The NodeExpander built from the index, its parent nodes are the documents.
+        :param document_vectors: (num_parents, dim) normalized vectors, in the order of node_expander.parent_ids.
+        :param similarity_top_k: Number of chunks retrieved.
+        :param top_documents: Number of documents searched.
+        """
+        if len(document_vectors) != len(node_expander.parent_ids):
+            raise ValueError(
+                f"Got {len(document_vectors)} document vectors for {len(node_expander.parent_ids)} documents"
+            )
+        self._index = index
+        self._node_expander = node_expander
+        self._document_vectors = document_vectors
+        self._similarity_top_k = similarity_top_k
+        self._top_documents = top_documents
+        self._embed_model = embed_model or index._embed_model
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Retrieve nodes given query."""
+        if len(self._document_vectors) == 0:
+            # e.g. a shard of a sharded index that got no documents
+            return []
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        result = self._index.vector_store.query(self._routed_query(query_bundle))
+        return self._to_nodes(result)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Asynchronously retrieve nodes given query."""
+        if len(self._document_vectors) == 0:
+            return []
+        if query_bundle.embedding is None:
+            query_bundle.embedding = (
+                await self._embed_model.aget_agg_embedding_from_queries(
+                    query_bundle.embedding_strs
+                )
+            )
+        result = await self._index.vector_store.aquery(self._routed_query(query_bundle))
+        return self._to_nodes(result)
+
+    def _routed_query(self, query_bundle: QueryBundle) -> VectorStoreQuery:
+        """The query of the chunks of the top_documents documents closest to the embedded query."""
+        query_vector = normalize(np.asarray(query_bundle.embedding, dtype=np.float32))
+        document_scores = self._document_vectors @ query_vector
+        top_parents, _ = top_k(
+            np.arange(len(document_scores)), document_scores, self._top_documents
+        )
+
+        child_indptr = self._node_expander.child_indptr
+        node_ids = [
+            node_id
+            for p in top_parents
+            for node_id in self._node_expander.node_ids[
+                child_indptr[p] : child_indptr[p + 1]
+            ]
+        ]
+        return VectorStoreQuery(
+            query_embedding=query_bundle.embedding,
+            similarity_top_k=self._similarity_top_k,
+            node_ids=node_ids,
+        )
+
+    def _to_nodes(self, result) -> List[NodeWithScore]:
+        nodes = self._index.docstore.get_nodes(result.ids)
+        return [
+            NodeWithScore(node=node, score=score)
+            for node, score in zip(nodes, result.similarities)
+        ]
+
+    @staticmethod
+    def compute_document_vectors(
+        index, node_expander, previous_vectors=None, previous_parent_ids=None
+    ):
+        """
+        Computes the centroid of the normalized embeddings of the indexed chunks of every parent node.
+
+        :param index: The VectorStoreIndex of the chunks.
+        :param node_expander: The NodeExpander built from the index.
+        :param previous_vectors: Document vectors of a previous build, reused for the parents that did not change.
+        :param previous_parent_ids: The parent ids of previous_vectors.
+        :return: (num_parents, dim) float32 array, zero for parents without indexed chunks.
+        """
+        previous_rows = {
+            parent_id: row for row, parent_id in enumerate(previous_parent_ids or [])
+        }
+        # near-duplicate chunks are in the docstore but not in the vector store
+        indexed_ids = index.index_struct.nodes_dict
+        child_indptr = node_expander.child_indptr
+        vectors = []
+        for p, parent_id in enumerate(node_expander.parent_ids):
+            if parent_id in previous_rows:
+                vectors.append(previous_vectors[previous_rows[parent_id]])
+                continue
+            child_ids = [
+                node_id
+                for node_id in node_expander.node_ids[
+                    child_indptr[p] : child_indptr[p + 1]
+                ]
+                if node_id in indexed_ids
+            ]
+            if not child_ids:
+                vectors.append(None)
+                continue
+            embeddings = get_embeddings(index.vector_store, child_ids)
+            vectors.append(normalize(normalize(embeddings).mean(axis=0)))
+
+        dim = next((len(v) for v in vectors if v is not None), 0)
+        document_vectors = np.zeros((len(vectors), dim), dtype=np.float32)
+        for p, vector in enumerate(vectors):
+            if vector is not None:
+                document_vectors[p] = vector
+        return document_vectors
+
+    @staticmethod
+    def persist_document_vectors(persist_dir, document_vectors, parent_ids):
+        os.makedirs(persist_dir, exist_ok=True)
+        vectors_path = os.path.join(persist_dir, DOCUMENT_VECTORS_BASENAME)
+        # The previous vectors may be memory-mapped from the target file
+        with open(vectors_path + ".tmp", "wb") as f:
+            np.save(f, document_vectors)
+        os.replace(vectors_path + ".tmp", vectors_path)
+        with open(
+            os.path.join(persist_dir, DOCUMENT_IDS_BASENAME), "w", encoding="utf-8"
+        ) as f:
+            f.write(json.dumps(parent_ids))
+
+    @staticmethod
+    def load_document_vectors(persist_dir):
+        """:return: (document_vectors, parent_ids), or (None, None) if they were not persisted."""
+        ids_path = os.path.join(persist_dir, DOCUMENT_IDS_BASENAME)
+        if not os.path.exists(ids_path):
+            return None, None
+        with open(ids_path, "r", encoding="utf-8") as f:
+            parent_ids = json.loads(f.read())
+        document_vectors = np.load(
+            os.path.join(persist_dir, DOCUMENT_VECTORS_BASENAME), mmap_mode="r"
+        )
+        return document_vectors, parent_ids
+
+
+def get_embeddings(vector_store, node_ids):
+    if isinstance(vector_store, NumpyVectorStore):
+        return vector_store.get_embeddings(node_ids)
+    return np.asarray(
+        [vector_store.get(node_id) for node_id in node_ids], dtype=np.float32
+    )
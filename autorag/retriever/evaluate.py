@@ -1,42 +1,74 @@
-from llama_index.core import ServiceContext
-from llama_index.core import StorageContext, load_index_from_storage
 from omegaconf import DictConfig, OmegaConf
 import hydra
 from llama_index.core.evaluation import RetrieverEvaluator
 from llama_index.core.evaluation import (
     EmbeddingQAFinetuneDataset,
 )
-import pandas as pd
+from autorag.indexer.sharded_indexer import load_indexer
+from autorag.retriever.hybrid_retriever import HybridRetriever
+import numpy as np
 
 
-@hydra.main(version_base=None, config_path="../../conf", config_name="config")
-def main(cfg: DictConfig):
-    index_dir = cfg.retriever.evaluate.index_dir
-    test_data_path = cfg.retriever.evaluate.test_data_path
-    metrics = cfg.retriever.evaluate.metrics
-
-    service_context = ServiceContext.from_defaults()
-    # rebuild storage context
-    storage_context = StorageContext.from_defaults(persist_dir=index_dir)
-    # load index
-    index = load_index_from_storage(storage_context, service_context=service_context)
-    retriever = index.as_retriever()
+def evaluate_retriever(
+    retriever, qa_data, metrics, duplicates=None, max_num_queries=None
+):
+    """
+    :param qa_data: The EmbeddingQAFinetuneDataset of the queries and their relevant node ids.
+    :param duplicates: {dropped node id: representative node id} of the near duplicates of the index.
+    :return: {metric: mean value over the queries}
+    """
     retriever_evaluator = RetrieverEvaluator.from_metric_names(
         metrics, retriever=retriever
     )
-    total_metrics = {m: 0.0 for m in metrics}
-    qa_data = EmbeddingQAFinetuneDataset.from_json(test_data_path)
     metric_dicts = []
-    for qid, query in list(qa_data.queries.items())[:3]:
-        relevant_doc_ids = qa_data.relevant_docs[qid]
+    # Near-duplicate nodes were not indexed, their representative is retrieved instead
+    duplicates = duplicates or {}
+    for qid, query in list(qa_data.queries.items())[:max_num_queries]:
+        relevant_doc_ids = [
+            duplicates.get(doc_id, doc_id) for doc_id in qa_data.relevant_docs[qid]
+        ]
         result = retriever_evaluator.evaluate(
             query=query, expected_ids=relevant_doc_ids
         )
         metric_dicts.append(result.metric_vals_dict)
-    full_df = pd.DataFrame(metric_dicts)
+    return {
+        metric: float(np.mean([metric_dict[metric] for metric_dict in metric_dicts]))
+        for metric in metrics
+    }
+
+
+@hydra.main(version_base=None, config_path="../../conf", config_name="config")
+def main(cfg: DictConfig):
+    index_dir = cfg.retriever.evaluate.index_dir
+    test_data_path = cfg.retriever.evaluate.test_data_path
+    metrics = cfg.retriever.evaluate.metrics
+    similarity_top_k = cfg.retriever.evaluate.similarity_top_k
+    max_num_queries = cfg.retriever.evaluate.max_num_queries
+    document_routing_cfg = cfg.retriever.evaluate.get("document_routing_cfg", None)
+    document_routing = document_routing_cfg and document_routing_cfg.enable
+
+    # load index with the vector store (and quantization) it was built with
+    expanded_index = load_indexer(index_dir, document_routing)
+    if document_routing:
+        retriever = expanded_index.as_document_routing_retriever(
+            similarity_top_k, document_routing_cfg.top_documents
+        )
+    else:
+        retriever = expanded_index.as_retriever(similarity_top_k=similarity_top_k)
+    hybrid_cfg = cfg.retriever.evaluate.get("hybrid_cfg", None)
+    if hybrid_cfg and hybrid_cfg.enable:
+        retriever = HybridRetriever(
+            retriever,
+            expanded_index.as_bm25_retriever(hybrid_cfg.lexical_top_k),
+            similarity_top_k,
+            hybrid_cfg.rrf_k,
+        )
+    qa_data = EmbeddingQAFinetuneDataset.from_json(test_data_path)
+    metric_values = evaluate_retriever(
+        retriever, qa_data, metrics, expanded_index.duplicates, max_num_queries
+    )
     for metric in metrics:
-        metric_ave_val = full_df[metric].mean()
-        print(f"{metric}: {metric_ave_val}")
+        print(f"{metric}: {metric_values[metric]}")
 
 
 if __name__ == "__main__":
@@ -1,69 +1,286 @@
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import os
+import time
 from llama_index.core.schema import TextNode, NodeWithScore, QueryBundle
 from llama_index.core.indices.vector_store.retrievers.retriever import (
     VectorIndexRetriever,
 )
 from llama_index.core.base.base_retriever import BaseRetriever
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 from googleapiclient.discovery import build
-from typing import List
+from autorag.retriever.web_cache import WebCache
+from autorag.retriever.web_page_ranker import WebPageRanker
+from typing import List, Optional
 import re
 
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# Maximum number of seconds spent fetching a page
+DEFAULT_FETCH_TIMEOUT = 10.0
+CONNECT_TIMEOUT = 3.05
+# Pages are truncated after this many bytes
+DEFAULT_MAX_PAGE_BYTES = 2_000_000
+# The Custom Search API returns at most 10 results per call
+MAX_SEARCH_RESULTS = 10
+NON_TEXT_TAGS = ["script", "style", "noscript", "template"]
+
 
 class GoogleRetriever(BaseRetriever):
-    """Custom retriever that performs both semantic search and hybrid search."""
+    """Custom retriever that performs Google search and fetches the result pages concurrently."""
 
     def __init__(
         self,
         api_key: str = None,
         cse_id: str = None,
         topk: int = 10,
+        num_results: Optional[int] = None,
+        max_workers: Optional[int] = None,
+        fetch_timeout: float = DEFAULT_FETCH_TIMEOUT,
+        max_page_bytes: int = DEFAULT_MAX_PAGE_BYTES,
+        cache: Optional[WebCache] = None,
+        page_ranker: Optional[WebPageRanker] = None,
     ) -> None:
-        """Init params."""
+        """
+        :param topk: Number of pages retrieved.
+        :param num_results: Number of search results fetched, the first topk pages to arrive are kept.
+            Defaults to topk.
+        :param max_workers: Number of pages fetched concurrently. Defaults to 2 * num_results.
+        :param fetch_timeout: Maximum number of seconds spent fetching a page.
+        :param max_page_bytes: Pages are truncated after this many bytes.
+        :param cache: Persistent cache of the fetched pages and of the search responses.
+        :param page_ranker: If given, the pages are split into chunks and only the chunks closest to the query
+            are retrieved, instead of whole pages scored by search rank.
+        """
         api_key = api_key or os.environ["GOOGLE_SEARCH_API_KEY"]
         cse_id = cse_id or os.environ["GOOGLE_SEARCH_CSE_ID"]
         self.service = build("customsearch", "v1", developerKey=api_key).cse()
         self.cse_id = cse_id
         self.topk = topk
+        self.num_results = min(max(num_results or topk, topk), MAX_SEARCH_RESULTS)
+        self.fetch_timeout = fetch_timeout
+        self.max_page_bytes = max_page_bytes
+        self.cache = cache
+        self.page_ranker = page_ranker
+        # Headroom for the fetches of the previous queries still running after they returned
+        max_workers = max_workers or 2 * self.num_results
+        # Keep-alive connections are reused across queries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
         super().__init__()
 
     @staticmethod
-    def fetch_page_text(url):
+    def fetch_page_text(
+        url,
+        session: Optional[requests.Session] = None,
+        timeout: float = DEFAULT_FETCH_TIMEOUT,
+        max_bytes: int = DEFAULT_MAX_PAGE_BYTES,
+        cache: Optional[WebCache] = None,
+    ):
+        """
+        :param cache: If given, fresh cached pages are not fetched and stale ones are revalidated.
+        :return: The text of the page, or None if it could not be fetched in time or is not an html or text page.
+        """
+        entry, fresh = cache.get_page(url) if cache is not None else (None, False)
+        if fresh:
+            return entry["text"]
+        headers = {}
+        if entry is not None and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
         try:
-            response = requests.get(url)
-            response.raise_for_status()  # Raises an HTTPError for bad responses
-            soup = BeautifulSoup(response.text, "html.parser")
-            text = soup.get_text()
-            text = re.sub(r"\s+", " ", text)
-            text = re.sub(r"\n+", "\n", text)
+            start = time.monotonic()
+            with (session or requests).get(
+                url,
+                headers=headers,
+                timeout=(min(CONNECT_TIMEOUT, timeout), timeout),
+                stream=True,
+            ) as response:
+                if response.status_code == 304 and entry is not None:
+                    return cache.revalidated(url, entry)
+                response.raise_for_status()  # Raises an HTTPError for bad responses
+                content_type = response.headers.get("content-type", "")
+                if content_type and not content_type.startswith(
+                    ("text/", "application/xhtml")
+                ):
+                    print(f"Skipping {url}: content type {content_type}")
+                    return None
+                content = bytearray()
+                for chunk in response.iter_content(chunk_size=65536):
+                    content += chunk
+                    if len(content) >= max_bytes:
+                        del content[max_bytes:]
+                        break
+                    if time.monotonic() - start > timeout:
+                        raise requests.Timeout(f"Read timed out after {timeout}s")
+                # requests falls back to ISO-8859-1 when the header has no charset, let the parser detect it
+                encoding = response.encoding if "charset" in content_type else None
+            text = GoogleRetriever.extract_text(bytes(content), encoding)
+            if cache is not None:
+                cache.set_page(
+                    url,
+                    text,
+                    response.headers.get("etag"),
+                    response.headers.get("last-modified"),
+                )
             return text
         except requests.RequestException as e:
             print(f"Failed to retrieve {url}: {e}")
+            if entry is not None:
+                # A stale page is better than no page
+                return entry["text"]
             return None
 
+    @staticmethod
+    def extract_text(content: bytes, encoding: Optional[str] = None) -> str:
+        soup = BeautifulSoup(content, HTML_PARSER, from_encoding=encoding)
+        for tag in soup(NON_TEXT_TAGS):
+            tag.decompose()
+        text = soup.get_text()
+        text = re.sub(r"\s+", " ", text)
+        text = re.sub(r"\n+", "\n", text)
+        return text
+
+    def search(self, query: str) -> list:
+        """:return: The items of the Custom Search results of the query."""
+        if self.cache is not None:
+            items = self.cache.get_search(query, cx=self.cse_id, num=self.num_results)
+            if items is not None:
+                return items
+        res = self.service.list(q=query, cx=self.cse_id, num=self.num_results).execute()
+        items = res.get("items", [])
+        if self.cache is not None:
+            self.cache.set_search(query, items, cx=self.cse_id, num=self.num_results)
+        return items
+
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         """Retrieve nodes given query."""
 
         # query_bundle.query_str is the original query
-        res = self.service.list(
-            q=query_bundle.query_str, cx=self.cse_id, num=self.topk
-        ).execute()
-        items = res.get("items", [])
+        items = self.search(query_bundle.query_str)
 
-        nodes_with_score = []
-        total_items = len(items)
+        started = {}
+        futures = {
+            self._executor.submit(self._fetch, item["link"], rank, started): (
+                rank,
+                item,
+            )
+            for rank, item in self._fetched_items(items)
+        }
+        pages = []
+        pending = set(futures)
+        submitted_at = time.monotonic()
+        # Slow pages are not waited for once topk pages arrived
+        while pending and len(pages) < self.topk:
+            done, pending = wait(
+                pending,
+                timeout=self._wait_timeout(pending, futures, started, submitted_at),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                print(f"Stopped waiting for {len(pending)} slow pages")
+                break
+            for future in sorted(done, key=lambda future: futures[future][0]):
+                text = future.result()
+                if text is not None and len(pages) < self.topk:
+                    pages.append((*futures[future], text))
+        for future in futures:
+            future.cancel()
+        if self.cache is not None:
+            print(f"Web cache stats: {self.cache.stats}")
+        nodes = self._to_nodes(pages, len(items))
+        if self.page_ranker is not None:
+            return self.page_ranker.rank(query_bundle, nodes)
+        return nodes
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Asynchronously retrieve nodes given query."""
+
+        # The Custom Search client and the page fetches are blocking, they run in threads
+        items = await asyncio.to_thread(self.search, query_bundle.query_str)
+
+        loop = asyncio.get_running_loop()
+        started = {}
+        futures = {
+            loop.run_in_executor(
+                self._executor, self._fetch, item["link"], rank, started
+            ): (rank, item)
+            for rank, item in self._fetched_items(items)
+        }
+        pages = []
+        pending = set(futures)
+        submitted_at = time.monotonic()
+        while pending and len(pages) < self.topk:
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=self._wait_timeout(pending, futures, started, submitted_at),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                print(f"Stopped waiting for {len(pending)} slow pages")
+                break
+            for future in sorted(done, key=lambda future: futures[future][0]):
+                text = future.result()
+                if text is not None and len(pages) < self.topk:
+                    pages.append((*futures[future], text))
+        for future in pending:
+            future.cancel()
+        if self.cache is not None:
+            print(f"Web cache stats: {self.cache.stats}")
+        nodes = self._to_nodes(pages, len(items))
+        if self.page_ranker is not None:
+            return await self.page_ranker.arank(query_bundle, nodes)
+        return nodes
+
+    @staticmethod
+    def _fetched_items(items):
+        """:return: The (rank, item) of the search results whose page is fetched."""
         for rank, item in enumerate(items):
-            title = item["title"]
             link = item["link"]
             if link.endswith("download") or link.endswith(".pdf"):
                 continue
-            text = GoogleRetriever.fetch_page_text(link)
-            if text is None:
-                continue
+            yield rank, item
+
+    def _fetch(self, url, rank, started):
+        started[rank] = time.monotonic()
+        return GoogleRetriever.fetch_page_text(
+            url, self.session, self.fetch_timeout, self.max_page_bytes, self.cache
+        )
+
+    def _wait_timeout(self, pending, futures, started, submitted_at):
+        """
+        Seconds to wait for the next pending page. Each fetch gets fetch_timeout from when it started, not from
+        when it was submitted, since it may have been queued behind the slow fetches of other queries.
+        """
+        now = time.monotonic()
+        starts = [started.get(futures[future][0]) for future in pending]
+        if None in starts:
+            # Queued fetches, bounded in case the pool stays busy
+            deadline = submitted_at + 2 * (self.fetch_timeout + 1)
+        else:
+            deadline = max(starts) + self.fetch_timeout + 1
+        return max(deadline - now, 0)
+
+    @staticmethod
+    def _to_nodes(pages, total_items) -> List[NodeWithScore]:
+        """:param pages: The (rank, item, text) of the fetched pages."""
+        nodes_with_score = []
+        for rank, item, text in sorted(pages, key=lambda page: page[0]):
+            link = item["link"]
             metadata = {
                 "page_number": None,
-                "document_name": title,
+                "document_name": item["title"],
                 "document_type": "webpage",
                 "url": link,
             }
@@ -86,12 +303,43 @@ class GoogleAndVectorRetriever(BaseRetriever):
 
         self._vector_retriever = vector_retriever
         self._google_retriever = google_retriever
+        # One worker per concurrent query, the web search waits on the network
+        self._executor = ThreadPoolExecutor()
         super().__init__()
 
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         """Retrieve nodes given query."""
 
+        page_ranker = self._google_retriever.page_ranker
+        if page_ranker is not None and query_bundle.embedding is None:
+            # Embedded once for both the vector search and the ranking of the web page chunks
+            query_bundle.embedding = (
+                page_ranker.embed_model.get_agg_embedding_from_queries(
+                    query_bundle.embedding_strs
+                )
+            )
+        # The web search is the slowest, it runs in a worker thread while the vector search runs
+        google_future = self._executor.submit(
+            self._google_retriever.retrieve, query_bundle
+        )
         vector_nodes = self._vector_retriever.retrieve(query_bundle)
-        google_nodes = self._google_retriever.retrieve(query_bundle)
+        google_nodes = google_future.result()
+
+        return vector_nodes + google_nodes
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Asynchronously retrieve nodes given query."""
+
+        page_ranker = self._google_retriever.page_ranker
+        if page_ranker is not None and query_bundle.embedding is None:
+            query_bundle.embedding = (
+                await page_ranker.embed_model.aget_agg_embedding_from_queries(
+                    query_bundle.embedding_strs
+                )
+            )
+        vector_nodes, google_nodes = await asyncio.gather(
+            self._vector_retriever.aretrieve(query_bundle),
+            self._google_retriever.aretrieve(query_bundle),
+        )
 
         return vector_nodes + google_nodes
@@ -0,0 +1,106 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from autorag.indexer.bm25_index import BM25Index
+
+# Reciprocal rank fusion constant, dampens the weight of the top ranks
+DEFAULT_RRF_K = 60
+
+
+class BM25Retriever(BaseRetriever):
+    """Custom retriever that performs lexical search with a BM25 index."""
+
+    def __init__(self, bm25_index: BM25Index, docstore, similarity_top_k: int) -> None:
+        """Init params."""
+        self._bm25_index = bm25_index
+        self._docstore = docstore
+        self._similarity_top_k = similarity_top_k
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Retrieve nodes given query."""
+        results = self._bm25_index.search(
+            query_bundle.query_str, self._similarity_top_k
+        )
+        nodes = self._docstore.get_nodes([node_id for node_id, _ in results])
+        return [
+            NodeWithScore(node=node, score=score)
+            for node, (_, score) in zip(nodes, results)
+        ]
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Asynchronously retrieve nodes given query."""
+        return await asyncio.to_thread(self._retrieve, query_bundle)
+
+
+class HybridRetriever(BaseRetriever):
+    """Custom retriever that performs both Vector search and BM25 search concurrently and fuses
+    their rankings with reciprocal rank fusion."""
+
+    def __init__(
+        self,
+        vector_retriever: BaseRetriever,
+        lexical_retriever: BaseRetriever,
+        similarity_top_k: int,
+        rrf_k: int = DEFAULT_RRF_K,
+    ) -> None:
+        """Init params."""
+        self._vector_retriever = vector_retriever
+        self._lexical_retriever = lexical_retriever
+        self._similarity_top_k = similarity_top_k
+        self._rrf_k = rrf_k
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Retrieve nodes given query."""
+        lexical_future = self._executor.submit(
+            self._lexical_retriever.retrieve, query_bundle
+        )
+        vector_nodes = self._vector_retriever.retrieve(query_bundle)
+        lexical_nodes = lexical_future.result()
+        return self._fuse([vector_nodes, lexical_nodes])
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Asynchronously retrieve nodes given query."""
+        vector_nodes, lexical_nodes = await asyncio.gather(
+            self._vector_retriever.aretrieve(query_bundle),
+            self._lexical_retriever.aretrieve(query_bundle),
+        )
+        return self._fuse([vector_nodes, lexical_nodes])
+
+    def _fuse(self, rankings: List[List[NodeWithScore]]) -> List[NodeWithScore]:
+        """Reciprocal rank fusion of the rankings."""
+        return reciprocal_rank_fusion(rankings, self._similarity_top_k, self._rrf_k)
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[NodeWithScore]],
+    similarity_top_k: int,
+    rrf_k: int = DEFAULT_RRF_K,
+) -> List[NodeWithScore]:
+    """
+    Fuse rankings by the ranks of their nodes rather than their scores, for rankings whose scores are not comparable
+    :param rankings: lists of nodes, each sorted by decreasing score
+    :param similarity_top_k: number of fused nodes to return
+    :param rrf_k: reciprocal rank fusion constant
+    :return: the top nodes by fused score
+    """
+    fused_scores, fused_nodes = {}, {}
+    for nodes in rankings:
+        for rank, node in enumerate(nodes):
+            node_id = node.node.node_id
+            fused_scores[node_id] = fused_scores.get(node_id, 0.0) + 1.0 / (
+                rrf_k + rank + 1
+            )
+            fused_nodes.setdefault(node_id, node.node)
+    top_node_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)[
+        :similarity_top_k
+    ]
+    return [
+        NodeWithScore(node=fused_nodes[node_id], score=fused_scores[node_id])
+        for node_id in top_node_ids
+    ]
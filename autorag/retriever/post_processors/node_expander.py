@@ -1,6 +1,9 @@
 from collections import defaultdict
+import json
 import os
 from typing import Any, List, Optional
+import uuid
+import numpy as np
 from llama_index.core.bridge.pydantic import Field
 from llama_index.core.postprocessor.types import BaseNodePostprocessor
 from llama_index.core.schema import (
@@ -9,111 +12,414 @@ from llama_index.core.schema import (
     NodeWithScore,
     NodeRelationship,
     RelatedNodeInfo,
+    MetadataMode,
 )
 from llama_index.core.storage.docstore import SimpleDocumentStore
+from autorag.utils.token_counter import get_token_counter
 
+PARENT_INDEX_BASENAME = "parent_index.json"
+CHILD_INDPTR_BASENAME = "child_indptr.npy"
+NODE_PARENTS_BASENAME = "node_parents.npy"
+# Legacy files, with copies of the original nodes and of the parent texts
 ORIGINAL_NODE_DIR_BASENAME = "original_docstore.json"
 EXPANDED_NODE_DIR_BASENAME = "parent_docstore.json"
+# "parent": all the nodes of the parent, "neighbours": the nodes around the retrieved ones, up to a token budget
+EXPANSION_MODES = ["parent", "neighbours"]
+DEFAULT_TOKEN_BUDGET = 3000
 
 
 class NodeExpander(BaseNodePostprocessor):
-    """For nodes created from PDF files, NodeExpander will expand the original retrieved node to all the nodes in the same PDF file."""
+    """For nodes created from PDF files, NodeExpander will expand the original retrieved node to all the nodes in the same PDF file.
 
-    all_original_nodes: dict = Field(description="All the original nodes")
-    all_parent_nodes: dict = Field(
-        description="All the parent nodes. For example, one parent is the whole PDF"
+    The original nodes are read from the docstore of the index. The parent/child structure is kept in arrays:
+    node_ids is ordered by parent, the children of parent p are node_ids[child_indptr[p]:child_indptr[p + 1]]
+    and node_parents[i] is the parent of node_ids[i]. The text of a parent node is rebuilt from its children when it is needed.
+    """
+
+    docstore: Any = Field(
+        description="The docstore of the index with the original nodes"
+    )
+    parent_ids: list = Field(description="Ids of the parent nodes")
+    parent_metadata: list = Field(
+        description="Metadata of the parent nodes. For example, one parent is the whole PDF"
+    )
+    node_ids: list = Field(description="Ids of the original nodes, ordered by parent")
+    child_indptr: Any = Field(description="(num_parents + 1,) int64 array")
+    node_parents: Any = Field(description="(num_nodes,) int32 array")
+    node_index: dict = Field(description="{node_id: position in node_ids}")
+    sep: str = Field(default=" ", description="Separator of the parent text")
+    expansion_mode: str = Field(default="parent", description="One of EXPANSION_MODES")
+    token_budget: int = Field(
+        default=DEFAULT_TOKEN_BUDGET,
+        description="Maximum number of tokens of the expanded nodes of a query, in neighbours mode",
     )
 
     def __init__(
         self,
-        all_original_nodes: dict = None,
-        all_parent_nodes: dict = None,
+        docstore=None,
+        parent_ids: list = None,
+        parent_metadata: list = None,
+        node_ids: list = None,
+        child_indptr=None,
+        node_parents=None,
+        sep: str = " ",
+        expansion_mode: str = "parent",
+        token_budget: int = DEFAULT_TOKEN_BUDGET,
     ):
+        node_ids = node_ids or []
         super().__init__(
-            all_original_nodes=all_original_nodes,
-            all_parent_nodes=all_parent_nodes,
+            docstore=docstore,
+            parent_ids=parent_ids or [],
+            parent_metadata=parent_metadata or [],
+            node_ids=node_ids,
+            child_indptr=(
+                child_indptr if child_indptr is not None else np.zeros(1, np.int64)
+            ),
+            node_parents=(
+                node_parents if node_parents is not None else np.zeros(0, np.int32)
+            ),
+            node_index={node_id: i for i, node_id in enumerate(node_ids)},
+            sep=sep,
+        )
+        self.set_expansion_mode(expansion_mode, token_budget)
+
+    @classmethod
+    def from_parent_nodes(cls, docstore, parent_nodes, sep=" "):
+        """
+        :param docstore: The docstore of the index with the original nodes.
+        :param parent_nodes: {parent_id: {"metadata": dict, "child_ids": list}}.
+        """
+        return cls(docstore, sep=sep, **cls._build_structure(parent_nodes))
+
+    @staticmethod
+    def _build_structure(parent_nodes):
+        parent_ids = list(parent_nodes)
+        num_children = np.array(
+            [len(parent_nodes[p]["child_ids"]) for p in parent_ids], dtype=np.int64
         )
+        child_indptr = np.zeros(len(parent_ids) + 1, dtype=np.int64)
+        np.cumsum(num_children, out=child_indptr[1:])
+        return {
+            "parent_ids": parent_ids,
+            "parent_metadata": [parent_nodes[p]["metadata"] for p in parent_ids],
+            "node_ids": [
+                child_id
+                for p in parent_ids
+                for child_id in parent_nodes[p]["child_ids"]
+            ],
+            "child_indptr": child_indptr,
+            "node_parents": np.repeat(
+                np.arange(len(parent_ids), dtype=np.int32), num_children
+            ),
+        }
+
+    @property
+    def parent_nodes(self):
+        """{parent_id: {"metadata": dict, "child_ids": list}}"""
+        return {
+            parent_id: {
+                "metadata": self.parent_metadata[p],
+                "child_ids": self.node_ids[
+                    self.child_indptr[p] : self.child_indptr[p + 1]
+                ],
+            }
+            for p, parent_id in enumerate(self.parent_ids)
+        }
+
+    def set_expansion_mode(self, expansion_mode, token_budget=None):
+        if expansion_mode not in EXPANSION_MODES:
+            raise ValueError(
+                f"Unknown expansion mode {expansion_mode}, expected one of {EXPANSION_MODES}"
+            )
+        self.expansion_mode = expansion_mode
+        if token_budget is not None:
+            self.token_budget = token_budget
 
     def _postprocess_nodes(
         self,
         nodes: List[NodeWithScore],
         query_bundle: Optional[QueryBundle] = None,
     ) -> List[TextNode]:
-        parent_node_scores = {}
-        """The original retrieved node from a PDF file will be expanded to all the nodes in the same PDF file. In other words, 
-        if a node in a file is retrieved, all the nodes from this file will be returned."""
-        for node in nodes:
-            parent_node_info = self.all_original_nodes[node.node.node_id].relationships[
-                NodeRelationship.PARENT
+        """The original retrieved node from a PDF file will be expanded to all the nodes in the same PDF file. In other words,
+        if a node in a file is retrieved, all the nodes from this file will be returned.
+        In neighbours mode, the nodes are only expanded to their neighbours, see _expand_neighbours.
+        """
+        if self.expansion_mode == "neighbours":
+            return self._expand_neighbours(nodes)
+        node_indices = [self.node_index[node.node.node_id] for node in nodes]
+        # parents in the order of their best hit
+        parent_indices = dict.fromkeys(
+            self.node_parents[node_indices].tolist() if node_indices else []
+        )
+        num_parent_nodes = len(parent_indices)
+        expanded_nodes = []
+        for parent_idx, p in enumerate(parent_indices):
+            start, end = int(self.child_indptr[p]), int(self.child_indptr[p + 1])
+            num_children = end - start
+            scores = (num_parent_nodes - parent_idx) + (
+                num_children - np.arange(num_children)
+            ) * 1.0 / num_children
+            child_nodes = self.docstore.get_nodes(self.node_ids[start:end])
+            expanded_nodes += [
+                NodeWithScore(node=child_node, score=score)
+                for child_node, score in zip(child_nodes, scores.tolist())
             ]
-            if parent_node_info.node_id not in parent_node_scores:
-                parent_node_scores[parent_node_info.node_id] = node.score
-        num_parent_nodes = len(parent_node_scores)
+        return expanded_nodes
+
+    def _expand_neighbours(self, nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """The retrieved nodes are expanded to their neighbours in the parent, one position further on
+        each side at a time, until the token budget of the query is spent. Hits in the same parent share
+        the nodes they grow into, which are only counted once."""
+        token_counter = get_token_counter()
+        hits = []
+        selected = {}
+        for node in nodes:
+            node_idx = self.node_index[node.node.node_id]
+            p = int(self.node_parents[node_idx])
+            hits.append((p, node_idx))
+            selected.setdefault(p, {})
+
+        tokens = 0
+
+        def select(p, node_idx):
+            nonlocal tokens
+            parent_selected = selected[p]
+            if node_idx in parent_selected:
+                return True
+            child_node = self.docstore.get_node(self.node_ids[node_idx])
+            node_tokens = token_counter(
+                child_node.get_content(metadata_mode=MetadataMode.LLM)
+            )
+            # The best hit is always kept, even when it is larger than the budget
+            if tokens + node_tokens > self.token_budget and tokens > 0:
+                return False
+            parent_selected[node_idx] = child_node
+            tokens += node_tokens
+            return True
+
+        # (p, node_idx, step) of the sides that can still grow, a side stops at the first node over budget
+        sides = []
+        for p, node_idx in hits:
+            if select(p, node_idx):
+                sides += [(p, node_idx, -1), (p, node_idx, 1)]
+        distance = 1
+        while sides:
+            growing_sides = []
+            for p, node_idx, step in sides:
+                neighbour = node_idx + step * distance
+                if self.child_indptr[p] <= neighbour < self.child_indptr[
+                    p + 1
+                ] and select(p, neighbour):
+                    growing_sides.append((p, node_idx, step))
+            sides = growing_sides
+            distance += 1
+
+        # Same scores as in parent mode: parents in the order of their best hit, then children in their order
+        selected = {
+            p: parent_selected
+            for p, parent_selected in selected.items()
+            if parent_selected
+        }
+        num_parent_nodes = len(selected)
         expanded_nodes = []
-        for parent_idx, (e_node_id, e_node_score) in enumerate(
-            parent_node_scores.items()
-        ):
-            parent_node = self.all_parent_nodes[e_node_id]
-            child_nodes_info = parent_node.relationships[NodeRelationship.CHILD]
-            assert isinstance(child_nodes_info, list), "child_nodes_info is not a list"
-
-            for child_idx, child_node_info in enumerate(child_nodes_info):
+        for parent_idx, (p, parent_selected) in enumerate(selected.items()):
+            start, end = int(self.child_indptr[p]), int(self.child_indptr[p + 1])
+            num_children = end - start
+            for node_idx in sorted(parent_selected):
                 new_score = (num_parent_nodes - parent_idx) + (
-                    len(child_nodes_info) - child_idx
-                ) * 1.0 / len(child_nodes_info)
-                new_node = NodeWithScore(
-                    node=self.all_original_nodes[child_node_info.node_id],
-                    score=new_score,
+                    num_children - (node_idx - start)
+                ) * 1.0 / num_children
+                expanded_nodes.append(
+                    NodeWithScore(node=parent_selected[node_idx], score=new_score)
                 )
-                expanded_nodes.append(new_node)
         return expanded_nodes
 
+    def get_parent_node(self, parent_id):
+        """Rebuild a parent node, its text is the text of its children joined by sep."""
+        return self._get_parent_node(self.parent_ids.index(parent_id))
+
+    def _get_parent_node(self, p):
+        child_ids = self.node_ids[self.child_indptr[p] : self.child_indptr[p + 1]]
+        child_nodes = self.docstore.get_nodes(child_ids)
+        return TextNode(
+            id_=self.parent_ids[p],
+            text=self.sep.join(node.text for node in child_nodes),
+            metadata=dict(self.parent_metadata[p]),
+            relationships={
+                NodeRelationship.CHILD: [
+                    RelatedNodeInfo(node_id=child_id) for child_id in child_ids
+                ]
+            },
+        )
+
+    @property
+    def all_parent_nodes(self):
+        return {
+            parent_id: self._get_parent_node(p)
+            for p, parent_id in enumerate(self.parent_ids)
+        }
+
     @classmethod
-    def load(cls, persist_dir):
-        ori_node_path = os.path.join(persist_dir, ORIGINAL_NODE_DIR_BASENAME)
-        ori_nodes_list = SimpleDocumentStore.from_persist_path(ori_node_path)
-        all_original_nodes = ori_nodes_list.docs
+    def load(cls, persist_dir, docstore=None):
+        """
+        :param persist_dir: Directory of the persisted NodeExpander.
+        :param docstore: The docstore of the index the NodeExpander was built from.
+        """
+        parent_index_path = os.path.join(persist_dir, PARENT_INDEX_BASENAME)
+        if os.path.exists(parent_index_path):
+            if docstore is None:
+                raise ValueError("The docstore of the index is required")
+            with open(parent_index_path, "r", encoding="utf-8") as f:
+                parent_index = json.loads(f.read())
+            if "parent_nodes" in parent_index:
+                # persisted before the arrays
+                return cls.from_parent_nodes(
+                    docstore, parent_index["parent_nodes"], parent_index["sep"]
+                )
+            return cls(
+                docstore,
+                parent_index["parent_ids"],
+                parent_index["parent_metadata"],
+                parent_index["node_ids"],
+                np.load(
+                    os.path.join(persist_dir, CHILD_INDPTR_BASENAME), mmap_mode="r"
+                ),
+                np.load(
+                    os.path.join(persist_dir, NODE_PARENTS_BASENAME), mmap_mode="r"
+                ),
+                parent_index["sep"],
+            )
 
+        # NodeExpander persisted with copies of the nodes, only the parent/child ids are kept
+        if docstore is None:
+            ori_node_path = os.path.join(persist_dir, ORIGINAL_NODE_DIR_BASENAME)
+            docstore = SimpleDocumentStore.from_persist_path(ori_node_path)
         exp_node_path = os.path.join(persist_dir, EXPANDED_NODE_DIR_BASENAME)
         exp_nodes_list = SimpleDocumentStore.from_persist_path(exp_node_path)
-        all_parent_nodes = exp_nodes_list.docs
-        # {node.node_id: node for node in exp_nodes_list}
-
-        return cls(all_original_nodes, all_parent_nodes)
+        parent_nodes = {
+            parent_id: {
+                "metadata": parent_node.metadata,
+                "child_ids": [
+                    child_node_info.node_id
+                    for child_node_info in parent_node.relationships[
+                        NodeRelationship.CHILD
+                    ]
+                ],
+            }
+            for parent_id, parent_node in exp_nodes_list.docs.items()
+        }
+        return cls.from_parent_nodes(docstore, parent_nodes)
 
     def persist(self, persist_dir):
-        ori_node_path = os.path.join(persist_dir, ORIGINAL_NODE_DIR_BASENAME)
-        ori_docstore = SimpleDocumentStore()
-        ori_docstore.add_documents(self.all_original_nodes.values())
-        ori_docstore.persist(persist_path=ori_node_path)
+        os.makedirs(persist_dir, exist_ok=True)
+        # The arrays may be memory-mapped from the files they are persisted to
+        for basename, array in [
+            (CHILD_INDPTR_BASENAME, self.child_indptr),
+            (NODE_PARENTS_BASENAME, self.node_parents),
+        ]:
+            array_path = os.path.join(persist_dir, basename)
+            with open(array_path + ".tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(array_path + ".tmp", array_path)
+        parent_index_path = os.path.join(persist_dir, PARENT_INDEX_BASENAME)
+        with open(parent_index_path, "w", encoding="utf-8") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "sep": self.sep,
+                        "parent_ids": self.parent_ids,
+                        "parent_metadata": self.parent_metadata,
+                        "node_ids": self.node_ids,
+                    }
+                )
+            )
 
-        exp_node_path = os.path.join(persist_dir, EXPANDED_NODE_DIR_BASENAME)
-        exp_docstore = SimpleDocumentStore()
-        exp_docstore.add_documents(self.all_parent_nodes.values())
-        exp_docstore.persist(persist_path=exp_node_path)
+        # The original nodes are persisted with the index
+        for basename in [ORIGINAL_NODE_DIR_BASENAME, EXPANDED_NODE_DIR_BASENAME]:
+            legacy_path = os.path.join(persist_dir, basename)
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
 
     @classmethod
     def build(cls, index, parent_metadata_field="document_name", sep=" "):
+        parent_nodes = cls._build_parent_nodes(
+            index.docstore.docs, parent_metadata_field
+        )
+
+        return cls.from_parent_nodes(index.docstore, parent_nodes, sep)
+
+    @classmethod
+    def merge(cls, node_expanders):
+        """Merge the NodeExpanders of indexes with distinct nodes, e.g. the shards of an index."""
+        parent_nodes = {}
+        for node_expander in node_expanders:
+            parent_nodes.update(node_expander.parent_nodes)
+        docstore = ChainedDocstore([e.docstore for e in node_expanders])
+        sep = node_expanders[0].sep if node_expanders else " "
+        return cls.from_parent_nodes(docstore, parent_nodes, sep)
+
+    def update(
+        self,
+        index,
+        parent_metadata_values,
+        parent_metadata_field="document_name",
+        sep=" ",
+    ):
+        """Rebuild only the parent nodes whose parent_metadata_field value is in parent_metadata_values,
+        e.g. the documents added, changed or deleted by an incremental build."""
+        parent_metadata_values = set(parent_metadata_values)
+        parent_nodes = {
+            parent_id: parent_node
+            for parent_id, parent_node in self.parent_nodes.items()
+            if parent_node["metadata"].get(parent_metadata_field)
+            not in parent_metadata_values
+        }
+
+        new_original_nodes = {
+            node_id: node
+            for node_id, node in index.docstore.docs.items()
+            if node.metadata.get(parent_metadata_field) in parent_metadata_values
+        }
+        parent_nodes.update(
+            self._build_parent_nodes(new_original_nodes, parent_metadata_field)
+        )
+        for name, value in self._build_structure(parent_nodes).items():
+            setattr(self, name, value)
+        self.node_index = {node_id: i for i, node_id in enumerate(self.node_ids)}
+        self.docstore = index.docstore
+        self.sep = sep
+
+    @staticmethod
+    def _build_parent_nodes(all_original_nodes, parent_metadata_field):
         parent2original_mapping = defaultdict(list)
-        all_original_nodes = index.docstore.docs
         for node_id, node in all_original_nodes.items():
             # assuming nodes in index.docstore.docs are ordered in the preferred way
             # For example, when parent_metadata_field is document_name, the nodes are ordered in the doc order
             parent2original_mapping[node.metadata[parent_metadata_field]] += [node_id]
         all_parent_nodes = {}
         for parent_metadata, child_nodes in parent2original_mapping.items():
-            parent_text = sep.join(all_original_nodes[n].text for n in child_nodes)
-            child_nodes_info = [RelatedNodeInfo(node_id=n_id) for n_id in child_nodes]
-            parent_node = TextNode(
-                text=parent_text,
-                metadata={parent_metadata_field: parent_metadata},
-                relationships={NodeRelationship.CHILD: child_nodes_info},
-            )
-            all_parent_nodes[parent_node.node_id] = parent_node
-            for child_node_id in child_nodes:
-                related_parent_info = RelatedNodeInfo(node_id=parent_node.node_id)
-                all_original_nodes[child_node_id].relationships = {
-                    NodeRelationship.PARENT: related_parent_info
-                }
-
-        return cls(all_original_nodes, all_parent_nodes)
+            all_parent_nodes[str(uuid.uuid4())] = {
+                "metadata": {parent_metadata_field: parent_metadata},
+                "child_ids": child_nodes,
+            }
+
+        return all_parent_nodes
+
+
+class ChainedDocstore:
+    """Read-only view over the docstores of indexes with distinct nodes."""
+
+    def __init__(self, docstores):
+        self.docstores = docstores
+
+    def get_node(self, node_id, raise_error=True):
+        for docstore in self.docstores:
+            node = docstore.get_document(node_id, raise_error=False)
+            if node is not None:
+                return node
+        if raise_error:
+            raise ValueError(f"node_id {node_id} not found.")
+        return None
+
+    def get_nodes(self, node_ids, raise_error=True):
+        return [self.get_node(node_id, raise_error) for node_id in node_ids]
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from llama_index.core.schema import TextNode, NodeWithScore, QueryBundle
 from llama_index.core.indices.vector_store.retrievers.retriever import (
@@ -53,6 +54,9 @@ KEYWORD_IMPROVEMENT_PROMPT = PromptTemplate(
     List of keywords:"""
 )
 
+# Relevance checks in flight at once in aretrieve, bounded to stay under the LLM rate limits
+DEFAULT_MAX_CONCURRENT_CHECKS = 8
+
 
 class SemanticScholarRetriever(BaseRetriever):
     """Custom retriever that performs semantic search for papers"""
@@ -63,11 +67,17 @@ class SemanticScholarRetriever(BaseRetriever):
         api_key: str = None,
         topk: int = 10,
         openai_model_name: str = "gpt-4-1106-preview",
+        max_concurrent_checks: int = DEFAULT_MAX_CONCURRENT_CHECKS,
     ) -> None:
-        """Init params."""
+        """
+        Init params.
+
+        :param max_concurrent_checks: Maximum number of relevance checks sent to the LLM at once by aretrieve.
+        """
         self.directory = directory
         self.api_key = api_key or os.environ["S2_API_KEY"]
         self.topk = topk
+        self.max_concurrent_checks = max_concurrent_checks
         self.llm = OpenAI(model=openai_model_name, temperature=0)
         super().__init__()
 
@@ -138,17 +148,22 @@ class SemanticScholarRetriever(BaseRetriever):
     def query_to_keywords(self, query):
         return self.llm.predict(QUERY2KEYWORD_PROMPT_TEMPLATE, question=query)
 
-    def _retrieve_with_iterative_improvement(
+    def _iterative_improvement(
         self,
-        query_bundle: QueryBundle,
-        max_iterations: int = 3,
-        min_highly_relevant: int = 10,
-        relevance_score_threshold: int = 4,
-    ) -> List[NodeWithScore]:
-        """Retrieve nodes with iterative keyword improvement."""
-        question = query_bundle.query_str
-        keywords = self.query_to_keywords(question)
-        highly_relevant_count = 0
+        question: str,
+        max_iterations: int,
+        min_highly_relevant: int,
+        relevance_score_threshold: int,
+    ) -> Generator[tuple, Union[dict, List[str], None], List[NodeWithScore]]:
+        """
+        The iterative keyword improvement loop shared by the sync and async retrieval. It yields the calls it needs,
+        ("search", keywords) or ("predict", [(prompt, prompt_args), ...]), and is sent back their results, so that
+        the caller decides how to run them.
+        """
+        (keywords,) = yield (
+            "predict",
+            [(QUERY2KEYWORD_PROMPT_TEMPLATE, {"question": question})],
+        )
         highly_relevant_nodes = []
         list_of_keywords = [keywords]
         set_of_paper_ids = set()
@@ -157,36 +172,36 @@ class SemanticScholarRetriever(BaseRetriever):
                 break
             cur_keywords = list_of_keywords[iteration]
             print(f"Iteration {iteration}, keywords: {cur_keywords}")
-            res = self.search(cur_keywords, self.topk)
-            items = res.get("data", [])
-
-            for item in items:
-                title = item["title"]
-                abstract = item["abstract"]
-                if item["paperId"] in set_of_paper_ids:
-                    continue
-                relevance_score = self.llm.predict(
-                    RELEVANCE_CHECK_PROMPT,
-                    question=question,
-                    title=title,
-                    abstract=abstract,
-                )
-
-                try:
-                    relevance_score = float(relevance_score.strip())
-                except ValueError:
-                    print(
-                        f"Invalid relevance score: {relevance_score}. Skipping this item."
+            res = yield ("search", cur_keywords)
+            items = list(
+                {
+                    item["paperId"]: item
+                    for item in (res or {}).get("data", [])
+                    if item["paperId"] not in set_of_paper_ids
+                }.values()
+            )
+            relevance_scores = yield (
+                "predict",
+                [
+                    (
+                        RELEVANCE_CHECK_PROMPT,
+                        {
+                            "question": question,
+                            "title": item["title"],
+                            "abstract": item["abstract"],
+                        },
                     )
-                    continue
-
-                if relevance_score >= relevance_score_threshold:
-                    if item["abstract"] is None:
-                        print(f"Skipping {title} because it has no abstract")
-                        continue
-                    node = self._create_node_from_item(item, relevance_score)
-                    highly_relevant_nodes.append(node)
-                    set_of_paper_ids.add(item["paperId"])
+                    for item in items
+                ],
+            )
+            for item, relevance_score in zip(items, relevance_scores):
+                self._add_if_relevant(
+                    item,
+                    relevance_score,
+                    relevance_score_threshold,
+                    highly_relevant_nodes,
+                    set_of_paper_ids,
+                )
 
             print(
                 f"So far found {len(highly_relevant_nodes)} highly relevant papers (score >= {relevance_score_threshold})"
@@ -202,27 +217,125 @@ class SemanticScholarRetriever(BaseRetriever):
                 break
 
             if iteration == 0:
-                list_of_keywords_str = self.llm.predict(
-                    KEYWORD_IMPROVEMENT_PROMPT,
-                    keywords=cur_keywords,
-                    question=question,
-                    num_keywords=max_iterations - 1,
+                (list_of_keywords_str,) = yield (
+                    "predict",
+                    [
+                        (
+                            KEYWORD_IMPROVEMENT_PROMPT,
+                            {
+                                "keywords": cur_keywords,
+                                "question": question,
+                                "num_keywords": max_iterations - 1,
+                            },
+                        )
+                    ],
                 )
-                try:
-                    list_of_keywords += [
-                        kws.strip("- \n")
-                        for kws in list_of_keywords_str.split("\n")
-                        if kws.strip("- \n") != ""
-                    ]
-                    print(list_of_keywords)
-                except Exception as e:
-                    print(f"failed to parse {list_of_keywords_str}. error: {str(e)}")
+                if not self._add_keywords(list_of_keywords_str, list_of_keywords):
                     break
 
         # Sort the relevant_nodes by score in descending order
         highly_relevant_nodes.sort(key=lambda x: x.score, reverse=True)
         return highly_relevant_nodes
 
+    def _retrieve_with_iterative_improvement(
+        self,
+        query_bundle: QueryBundle,
+        max_iterations: int = 3,
+        min_highly_relevant: int = 10,
+        relevance_score_threshold: int = 4,
+    ) -> List[NodeWithScore]:
+        """Retrieve nodes with iterative keyword improvement."""
+        steps = self._iterative_improvement(
+            query_bundle.query_str,
+            max_iterations,
+            min_highly_relevant,
+            relevance_score_threshold,
+        )
+        result = None
+        while True:
+            try:
+                kind, args = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            if kind == "search":
+                result = self.search(args, self.topk)
+            else:
+                result = [
+                    self.llm.predict(prompt, **prompt_args)
+                    for prompt, prompt_args in args
+                ]
+
+    async def _aretrieve_with_iterative_improvement(
+        self,
+        query_bundle: QueryBundle,
+        max_iterations: int = 3,
+        min_highly_relevant: int = 10,
+        relevance_score_threshold: int = 4,
+    ) -> List[NodeWithScore]:
+        """Asynchronous _retrieve_with_iterative_improvement, the relevance of the papers of an iteration is checked concurrently."""
+        semaphore = asyncio.Semaphore(self.max_concurrent_checks)
+
+        async def apredict(prompt, prompt_args):
+            async with semaphore:
+                return await self.llm.apredict(prompt, **prompt_args)
+
+        steps = self._iterative_improvement(
+            query_bundle.query_str,
+            max_iterations,
+            min_highly_relevant,
+            relevance_score_threshold,
+        )
+        result = None
+        while True:
+            try:
+                kind, args = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            if kind == "search":
+                result = await asyncio.to_thread(self.search, args, self.topk)
+            else:
+                result = await asyncio.gather(
+                    *[apredict(prompt, prompt_args) for prompt, prompt_args in args]
+                )
+
+    def _add_if_relevant(
+        self,
+        item,
+        relevance_score,
+        relevance_score_threshold,
+        highly_relevant_nodes,
+        set_of_paper_ids,
+    ):
+        """Adds the node of the item to highly_relevant_nodes if the LLM relevance score reaches the threshold."""
+        try:
+            relevance_score = float(relevance_score.strip())
+        except ValueError:
+            print(f"Invalid relevance score: {relevance_score}. Skipping this item.")
+            return
+
+        if relevance_score >= relevance_score_threshold:
+            if item["abstract"] is None:
+                print(f"Skipping {item['title']} because it has no abstract")
+                return
+            node = self._create_node_from_item(item, relevance_score)
+            highly_relevant_nodes.append(node)
+            set_of_paper_ids.add(item["paperId"])
+
+    @staticmethod
+    def _add_keywords(list_of_keywords_str, list_of_keywords):
+        """Parses the improved keywords suggested by the LLM into list_of_keywords, returns False if it failed."""
+        try:
+            list_of_keywords += [
+                kws.strip("- \n")
+                for kws in list_of_keywords_str.split("\n")
+                if kws.strip("- \n") != ""
+            ]
+            print(list_of_keywords)
+        except Exception as e:
+            print(f"failed to parse {list_of_keywords_str}. error: {str(e)}")
+            return False
+        return True
+
     def _create_node_from_item(self, item, relevance_score=None):
         title = item["title"]
         paper_id = item["paperId"]
@@ -245,3 +358,7 @@ class SemanticScholarRetriever(BaseRetriever):
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         """Retrieve nodes given query using the iterative improvement method."""
         return self._retrieve_with_iterative_improvement(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Asynchronously retrieve nodes given query using the iterative improvement method."""
+        return await self._aretrieve_with_iterative_improvement(query_bundle)
@@ -0,0 +1,83 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+from typing import List, Optional
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from autorag.retriever.hybrid_retriever import DEFAULT_RRF_K, reciprocal_rank_fusion
+
+FUSION_MODES = ("score", "rrf")
+
+
+class ShardedRetriever(BaseRetriever):
+    """Custom retriever that searches all the shards of an index concurrently and merges their top-k results.
+
+    With fusion="score" the shard results are merged by raw score, which is only valid when the scores are
+    comparable between shards (e.g. cosine similarity). Scores that depend on the corpus statistics of the
+    shard (e.g. BM25) must be merged with fusion="rrf", reciprocal rank fusion of the shard rankings.
+    """
+
+    def __init__(
+        self,
+        shard_retrievers: List[BaseRetriever],
+        similarity_top_k: int,
+        embed_model: Optional[BaseEmbedding] = None,
+        max_workers: Optional[int] = None,
+        fusion: str = "score",
+        rrf_k: int = DEFAULT_RRF_K,
+    ) -> None:
+        """Init params."""
+        if fusion not in FUSION_MODES:
+            raise ValueError(
+                f"Unknown fusion {fusion}, expected one of {', '.join(FUSION_MODES)}"
+            )
+        self._shard_retrievers = shard_retrievers
+        self._similarity_top_k = similarity_top_k
+        self._embed_model = embed_model
+        self._fusion = fusion
+        self._rrf_k = rrf_k
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or max(len(shard_retrievers), 1)
+        )
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Retrieve nodes given query."""
+
+        # Embed the query once for all the shards
+        if self._embed_model is not None and query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        shard_nodes = self._executor.map(
+            lambda retriever: retriever.retrieve(query_bundle), self._shard_retrievers
+        )
+        return self._merge(list(shard_nodes))
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Asynchronously retrieve nodes given query."""
+        if self._embed_model is not None and query_bundle.embedding is None:
+            query_bundle.embedding = (
+                await self._embed_model.aget_agg_embedding_from_queries(
+                    query_bundle.embedding_strs
+                )
+            )
+        shard_nodes = await asyncio.gather(
+            *[retriever.aretrieve(query_bundle) for retriever in self._shard_retrievers]
+        )
+        return self._merge(shard_nodes)
+
+    def _merge(self, shard_nodes: List[List[NodeWithScore]]) -> List[NodeWithScore]:
+        """Merge the top-k results of the shards."""
+        if self._fusion == "rrf":
+            # Shards are partitioned by document, a node is only ranked by its own shard
+            return reciprocal_rank_fusion(
+                shard_nodes, self._similarity_top_k, self._rrf_k
+            )
+        return heapq.nlargest(
+            self._similarity_top_k,
+            (node for nodes in shard_nodes for node in nodes),
+            key=lambda node: node.score or 0.0,
+        )
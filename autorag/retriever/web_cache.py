@@ -0,0 +1,146 @@
+"""
+Persistent cache of the web search path: the text extracted from the fetched pages, keyed by URL,
+and the Custom Search API responses, keyed by query.
+Stale pages are revalidated with their ETag / Last-Modified validators instead of being downloaded again.
+"""
+
+from collections import Counter
+import hashlib
+import json
+import threading
+import time
+from typing import Optional
+import zlib
+
+from autorag.indexer.embedding_cache import normalize_text
+from autorag.utils.sqlite_cache import SqliteLRUCache
+
+DEFAULT_WEB_CACHE_PATH = "persist_dir/web_cache/web_cache.sqlite"
+# Seconds during which a cached entry is used without contacting the server
+DEFAULT_PAGE_TTL = 24 * 3600
+DEFAULT_SEARCH_TTL = 24 * 3600
+
+
+class WebCache:
+    """
+    :param cache_path: Path to the sqlite cache file.
+    :param page_ttl: Seconds during which a cached page is used without revalidation.
+    :param search_ttl: Seconds during which a cached search response is used.
+    :param max_entries: Maximum number of cached pages and search responses, the least recently used are evicted.
+    """
+
+    def __init__(
+        self,
+        cache_path: str = DEFAULT_WEB_CACHE_PATH,
+        page_ttl: float = DEFAULT_PAGE_TTL,
+        search_ttl: float = DEFAULT_SEARCH_TTL,
+        max_entries: Optional[int] = None,
+    ) -> None:
+        self._cache = SqliteLRUCache(cache_path, max_entries)
+        self.page_ttl = page_ttl
+        self.search_ttl = search_ttl
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def get_page(self, url: str):
+        """
+        :return: (entry, fresh). entry is the cached {"text", "etag", "last_modified", "fetched_at"} of the page
+            or None, fresh tells whether it can be used without revalidation.
+        """
+        entry = self._get(f"page:{url}")
+        fresh = entry is not None and time.time() - entry["fetched_at"] < self.page_ttl
+        self._count("page_lookups", "page_hits" if fresh else None)
+        return entry, fresh
+
+    def set_page(
+        self,
+        url: str,
+        text: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        self._set(
+            f"page:{url}",
+            {
+                "text": text,
+                "etag": etag,
+                "last_modified": last_modified,
+                "fetched_at": time.time(),
+            },
+        )
+
+    def revalidated(self, url: str, entry: dict) -> str:
+        """Marks a cached page as fresh again after a 304 Not Modified response, returns its text."""
+        self._count("page_revalidations")
+        self._set(f"page:{url}", {**entry, "fetched_at": time.time()})
+        return entry["text"]
+
+    def get_search(self, query: str, **params) -> Optional[list]:
+        """:return: The cached items of the search of the query with the given API params, None if stale or missing."""
+        entry = self._get(self._search_key(query, params))
+        fresh = (
+            entry is not None and time.time() - entry["fetched_at"] < self.search_ttl
+        )
+        self._count("search_lookups", "search_hits" if fresh else None)
+        return entry["items"] if fresh else None
+
+    def set_search(self, query: str, items: list, **params) -> None:
+        self._set(
+            self._search_key(query, params), {"items": items, "fetched_at": time.time()}
+        )
+
+    @staticmethod
+    def _search_key(query, params):
+        key = json.dumps({"q": normalize_text(query), **params}, sort_keys=True)
+        return f"search:{hashlib.sha256(key.encode()).hexdigest()}"
+
+    def _get(self, key):
+        value = self._cache.get(key)
+        return json.loads(zlib.decompress(value)) if value is not None else None
+
+    def _set(self, key, entry):
+        self._cache.set(key, zlib.compress(json.dumps(entry).encode()))
+
+    def _count(self, *names):
+        with self._lock:
+            for name in names:
+                if name is not None:
+                    self._counts[name] += 1
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        page_lookups = counts.get("page_lookups", 0)
+        page_hits = counts.get("page_hits", 0)
+        page_revalidations = counts.get("page_revalidations", 0)
+        search_lookups = counts.get("search_lookups", 0)
+        search_hits = counts.get("search_hits", 0)
+        return {
+            "page_lookups": page_lookups,
+            "page_hits": page_hits,
+            "page_revalidations": page_revalidations,
+            # Revalidated pages are not downloaded nor parsed again
+            "page_hit_rate": (
+                (page_hits + page_revalidations) / page_lookups if page_lookups else 0.0
+            ),
+            "search_lookups": search_lookups,
+            "search_hits": search_hits,
+            "search_hit_rate": search_hits / search_lookups if search_lookups else 0.0,
+            "entries": len(self._cache),
+        }
+
+
+def get_web_cache(web_cache_cfg=None) -> Optional[WebCache]:
+    """
+    :param web_cache_cfg: The configuration of the cache (enable, cache_path, page_ttl, search_ttl, max_entries).
+    :return: The WebCache, or None if the cache is not enabled.
+    """
+    if not web_cache_cfg or not web_cache_cfg.get("enable", False):
+        return None
+    return WebCache(
+        cache_path=web_cache_cfg.get("cache_path", DEFAULT_WEB_CACHE_PATH),
+        page_ttl=web_cache_cfg.get("page_ttl", DEFAULT_PAGE_TTL),
+        search_ttl=web_cache_cfg.get("search_ttl", DEFAULT_SEARCH_TTL),
+        max_entries=web_cache_cfg.get("max_entries", None),
+    )
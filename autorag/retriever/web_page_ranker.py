@@ -0,0 +1,166 @@
+"""
+Pre-ranking of the fetched web pages: the pages are split into chunks and only the chunks most similar
+to the query are kept, up to a token budget, so that the synthesizer does not refine over whole pages.
+"""
+
+from typing import List, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle, TextNode
+
+from autorag.indexer.bm25_index import BM25Index
+from autorag.indexer.embedding_cache import get_embed_model, unwrap_embed_model
+from autorag.indexer.vector_stores.numpy_vector_store import normalize
+from autorag.utils.token_counter import get_token_counter
+
+DEFAULT_CHUNK_SIZE = 512
+DEFAULT_CHUNK_OVERLAP = 50
+DEFAULT_TOKEN_BUDGET = 2000
+# Maximum number of chunks embedded per query
+DEFAULT_MAX_CANDIDATES = 64
+
+
+class WebPageRanker:
+    """
+    Splits the web page nodes into chunks and keeps the chunks closest to the query.
+
+    :param embed_model: The embedding model of the index, chunks and query are compared in its space.
+    :param chunk_embed_model: The model embedding the chunks, the same model without the embedding cache of the
+        index or with a cache of its own. Defaults to embed_model without its cache, so that web chunks do not
+        evict the cached embeddings of the index.
+    :param chunk_size: Number of tokens of the chunks.
+    :param chunk_overlap: Number of tokens shared by consecutive chunks.
+    :param token_budget: Maximum number of tokens of the kept chunks. The best chunk is always kept.
+    :param max_candidates: Maximum number of chunks embedded. When the pages have more chunks, the candidates
+        are the best BM25 matches of the query, completed with the first chunks of the best ranked pages.
+    """
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+        token_budget: int = DEFAULT_TOKEN_BUDGET,
+        max_candidates: int = DEFAULT_MAX_CANDIDATES,
+        chunk_embed_model: Optional[BaseEmbedding] = None,
+    ) -> None:
+        self.embed_model = embed_model
+        self.chunk_embed_model = chunk_embed_model or unwrap_embed_model(embed_model)
+        self.splitter = SentenceSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
+        self.token_budget = token_budget
+        self.max_candidates = max_candidates
+
+    def rank(
+        self, query_bundle: QueryBundle, nodes: List[NodeWithScore]
+    ) -> List[NodeWithScore]:
+        """
+        :param nodes: The page nodes, sorted by search rank.
+        :return: The kept chunks, sorted by descending similarity to the query.
+        """
+        candidates = self._candidates(query_bundle.query_str, nodes)
+        if not candidates:
+            return []
+        query_embedding = query_bundle.embedding
+        if query_embedding is None:
+            query_embedding = self.embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        chunk_embeddings = self.chunk_embed_model.get_text_embedding_batch(
+            [
+                chunk.get_content(metadata_mode=MetadataMode.EMBED)
+                for chunk in candidates
+            ]
+        )
+        return self._select(candidates, query_embedding, chunk_embeddings)
+
+    async def arank(
+        self, query_bundle: QueryBundle, nodes: List[NodeWithScore]
+    ) -> List[NodeWithScore]:
+        candidates = self._candidates(query_bundle.query_str, nodes)
+        if not candidates:
+            return []
+        query_embedding = query_bundle.embedding
+        if query_embedding is None:
+            query_embedding = await self.embed_model.aget_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        chunk_embeddings = await self.chunk_embed_model.aget_text_embedding_batch(
+            [
+                chunk.get_content(metadata_mode=MetadataMode.EMBED)
+                for chunk in candidates
+            ]
+        )
+        return self._select(candidates, query_embedding, chunk_embeddings)
+
+    def _candidates(self, query_str: str, nodes: List[NodeWithScore]) -> List[TextNode]:
+        chunks = [
+            TextNode(text=text, metadata=dict(node.node.metadata))
+            for node in nodes
+            for text in self.splitter.split_text(node.node.get_content())
+        ]
+        if len(chunks) <= self.max_candidates:
+            return chunks
+
+        # Embedding every chunk of long pages would cost more than it saves
+        candidate_ids = [
+            node_id
+            for node_id, _ in BM25Index.build(chunks).search(
+                query_str, self.max_candidates
+            )
+        ]
+        selected = set(candidate_ids)
+        for chunk in chunks:
+            if len(candidate_ids) == self.max_candidates:
+                break
+            if chunk.node_id not in selected:
+                candidate_ids.append(chunk.node_id)
+        chunks_by_id = {chunk.node_id: chunk for chunk in chunks}
+        return [chunks_by_id[node_id] for node_id in candidate_ids]
+
+    def _select(
+        self, candidates: List[TextNode], query_embedding, chunk_embeddings
+    ) -> List[NodeWithScore]:
+        query_vector = normalize(np.asarray(query_embedding, dtype=np.float32))
+        chunk_vectors = normalize(np.asarray(chunk_embeddings, dtype=np.float32))
+        similarities = chunk_vectors @ query_vector
+        token_counter = get_token_counter()
+        selected, num_tokens = [], 0
+        for i in np.argsort(-similarities, kind="stable"):
+            chunk_tokens = token_counter(
+                candidates[i].get_content(metadata_mode=MetadataMode.LLM)
+            )
+            # Smaller chunks may still fit after a larger one did not
+            if selected and num_tokens + chunk_tokens > self.token_budget:
+                continue
+            selected.append(
+                NodeWithScore(node=candidates[i], score=float(similarities[i]))
+            )
+            num_tokens += chunk_tokens
+        return selected
+
+
+def get_web_page_ranker(embed_model: BaseEmbedding, page_ranker_cfg=None):
+    """
+    :param embed_model: The embedding model of the index.
+    :param page_ranker_cfg: The configuration of the ranker (enable, chunk_size, chunk_overlap, token_budget,
+        max_candidates, embedding_cache_cfg). embedding_cache_cfg is the cache of the chunk embeddings, separate
+        from the cache of the index.
+    :return: The WebPageRanker, or None if pre-ranking is not enabled.
+    """
+    if not page_ranker_cfg or not page_ranker_cfg.get("enable", False):
+        return None
+    return WebPageRanker(
+        embed_model,
+        chunk_size=page_ranker_cfg.get("chunk_size", DEFAULT_CHUNK_SIZE),
+        chunk_overlap=page_ranker_cfg.get("chunk_overlap", DEFAULT_CHUNK_OVERLAP),
+        token_budget=page_ranker_cfg.get("token_budget", DEFAULT_TOKEN_BUDGET),
+        max_candidates=page_ranker_cfg.get("max_candidates", DEFAULT_MAX_CANDIDATES),
+        chunk_embed_model=get_embed_model(
+            unwrap_embed_model(embed_model),
+            page_ranker_cfg.get("embedding_cache_cfg", None),
+        ),
+    )
@@ -1,7 +1,12 @@
 from flask import Flask, request, jsonify
 from llama_index.llms.openai import OpenAI
 from llama_index.core.indices.query.query_transform import HyDEQueryTransform
-from autorag.synthesizer.utils import init_query_engine, replace_with_identifiers
+from autorag.indexer.sharded_indexer import load_indexer
+from autorag.synthesizer.utils import (
+    init_query_engine,
+    filter_query_engine,
+    replace_with_identifiers,
+)
 from llama_index.core.chat_engine.condense_question import (
     DEFAULT_PROMPT as DEFAULT_CONDENSE_PROMPT,
 )
@@ -21,6 +26,8 @@ load_dotenv()
 
 # Initialize global variables
 query_engine = None
+expanded_index = None
+similarity_top_k = None
 llm = None
 hyde = None
 port = None  # Add port as a global variable
@@ -30,7 +37,8 @@ app_name = None
 
 @hydra.main(version_base=None, config_path="../../conf", config_name="config")
 def init_app(cfg: DictConfig):
-    global query_engine, llm, hyde, port, document_bucket_name, app_name
+    global query_engine, expanded_index, similarity_top_k, llm, hyde, port
+    global document_bucket_name, app_name
 
     cur_cfg = cfg.synthesizer.app
     index_dir = cur_cfg.index_dir
@@ -57,8 +65,28 @@ def init_app(cfg: DictConfig):
             semantic_scholar=True,
         )
     else:
+        document_routing_cfg = cur_cfg.get("document_routing_cfg", None)
+        # Kept to serve the queries with metadata filters
+        expanded_index = load_indexer(
+            index_dir,
+            enable_node_expander
+            or bool(document_routing_cfg and document_routing_cfg.enable),
+            cur_cfg.embedding_cache_cfg,
+            cur_cfg.vector_search_cfg,
+        )
+        similarity_top_k = citation_cfg.similarity_top_k
         query_engine = init_query_engine(
-            index_dir, llm, citation_cfg, enable_node_expander, streaming
+            index_dir,
+            llm,
+            citation_cfg,
+            enable_node_expander,
+            streaming,
+            embedding_cache_cfg=cur_cfg.embedding_cache_cfg,
+            vector_search_cfg=cur_cfg.vector_search_cfg,
+            node_expander_cfg=cur_cfg.get("node_expander_cfg", None),
+            hybrid_cfg=cur_cfg.get("hybrid_cfg", None),
+            document_routing_cfg=document_routing_cfg,
+            expanded_index=expanded_index,
         )
         if enable_hyde:
             hyde = HyDEQueryTransform(include_original=True)
@@ -93,7 +121,18 @@ def query():
     if hyde:
         prompt = hyde(prompt)
 
-    response = query_engine.query(prompt)
+    # e.g. {"document_name": "report.json", "page_number": {"gte": 3, "lte": 10}}
+    filters = data.get("filters", None)
+    if filters and expanded_index is not None:
+        try:
+            filtered_query_engine = filter_query_engine(
+                query_engine, expanded_index, filters, similarity_top_k
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        response = filtered_query_engine.query(prompt)
+    else:
+        response = query_engine.query(prompt)
     mapping = {}
     references = []
 
@@ -35,6 +35,11 @@ def main(cfg: DictConfig):
         citation_cfg,
         enable_node_expander,
         streaming,
+        embedding_cache_cfg=cur_cfg.embedding_cache_cfg,
+        vector_search_cfg=cur_cfg.vector_search_cfg,
+        node_expander_cfg=cur_cfg.get("node_expander_cfg", None),
+        hybrid_cfg=cur_cfg.get("hybrid_cfg", None),
+        document_routing_cfg=cur_cfg.get("document_routing_cfg", None),
     )
     if enable_hyde:
         hyde = HyDEQueryTransform(include_original=True)
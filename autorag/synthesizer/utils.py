@@ -4,12 +4,17 @@ from llama_index.core.query_engine.citation_query_engine import (
     CITATION_REFINE_TEMPLATE,
 )
 import re
-from autorag.indexer.expanded_indexer import ExpandedIndexer
+from autorag.indexer.sharded_indexer import load_indexer
 from autorag.retriever.google_and_vector_retriever import (
+    DEFAULT_FETCH_TIMEOUT,
+    DEFAULT_MAX_PAGE_BYTES,
     GoogleAndVectorRetriever,
     GoogleRetriever,
 )
+from autorag.retriever.hybrid_retriever import HybridRetriever
 from autorag.retriever.semantic_scholar_retriever import SemanticScholarRetriever
+from autorag.retriever.web_cache import get_web_cache
+from autorag.retriever.web_page_ranker import get_web_page_ranker
 from llama_index.core import Settings
 from llama_index.core.response_synthesizers import CompactAndRefine
 
@@ -26,6 +31,12 @@ def init_query_engine(
     enable_node_expander=False,
     streaming=True,
     semantic_scholar=False,
+    embedding_cache_cfg=None,
+    vector_search_cfg=None,
+    node_expander_cfg=None,
+    document_routing_cfg=None,
+    expanded_index=None,
+    hybrid_cfg=None,
 ):
 
     # Set global settings
@@ -39,16 +50,60 @@ def init_query_engine(
         query_engine_callback_manager = Settings.callback_manager
 
     else:
-        expanded_index = ExpandedIndexer.load(index_dir, enable_node_expander)
-        index = expanded_index.index
-        retriever = index.as_retriever(similarity_top_k=_citation_cfg.similarity_top_k)
+        document_routing = document_routing_cfg and document_routing_cfg.enable
+        if expanded_index is None:
+            # Documents are routed with the parent nodes of the NodeExpander
+            expanded_index = load_indexer(
+                index_dir,
+                enable_node_expander or document_routing,
+                embedding_cache_cfg,
+                vector_search_cfg,
+            )
+        if document_routing:
+            retriever = expanded_index.as_document_routing_retriever(
+                similarity_top_k=_citation_cfg.similarity_top_k,
+                top_documents=document_routing_cfg.top_documents,
+            )
+        else:
+            retriever = expanded_index.as_retriever(
+                similarity_top_k=_citation_cfg.similarity_top_k
+            )
+        if hybrid_cfg and hybrid_cfg.enable:
+            # Exact identifiers, e.g. CFR sections, are found by the lexical search
+            retriever = HybridRetriever(
+                retriever,
+                expanded_index.as_bm25_retriever(hybrid_cfg.lexical_top_k),
+                _citation_cfg.similarity_top_k,
+                hybrid_cfg.rrf_k,
+            )
         if _citation_cfg.google_search_topk > 0:
-            google_retriever = GoogleRetriever(topk=_citation_cfg.google_search_topk)
+            google_search_cfg = _citation_cfg.get("google_search_cfg", None) or {}
+            google_retriever = GoogleRetriever(
+                topk=_citation_cfg.google_search_topk,
+                num_results=google_search_cfg.get("num_results", None),
+                max_workers=google_search_cfg.get("max_workers", None),
+                fetch_timeout=google_search_cfg.get(
+                    "fetch_timeout", DEFAULT_FETCH_TIMEOUT
+                ),
+                max_page_bytes=google_search_cfg.get(
+                    "max_page_bytes", DEFAULT_MAX_PAGE_BYTES
+                ),
+                cache=get_web_cache(google_search_cfg.get("web_cache_cfg", None)),
+                page_ranker=get_web_page_ranker(
+                    Settings.embed_model, google_search_cfg.get("page_ranker_cfg", None)
+                ),
+            )
             retriever = GoogleAndVectorRetriever(retriever, google_retriever)
 
-        node_postprocessors = (
-            [expanded_index.node_expander] if enable_node_expander else None
-        )
+        if enable_node_expander:
+            if node_expander_cfg:
+                expanded_index.node_expander.set_expansion_mode(
+                    node_expander_cfg.get("expansion_mode", "parent"),
+                    node_expander_cfg.get("token_budget", None),
+                )
+            node_postprocessors = [expanded_index.node_expander]
+        else:
+            node_postprocessors = None
         query_engine_callback_manager = Settings.callback_manager
 
     if _citation_cfg.citation_qa_template_path:
@@ -74,6 +129,26 @@ def init_query_engine(
     return query_engine
 
 
+def filter_query_engine(query_engine, expanded_index, filters, similarity_top_k):
+    """
+    Returns a copy of a CitationQueryEngine whose vector search only scores the nodes matching the metadata filters,
+    e.g. {"document_name": "report.json", "page_number": {"gte": 3, "lte": 10}}. Web search is not used,
+    web pages do not belong to the filtered documents.
+    """
+    retriever = expanded_index.as_retriever(
+        similarity_top_k=similarity_top_k,
+        node_ids=expanded_index.filter_node_ids(filters),
+    )
+    return CitationQueryEngine(
+        retriever=retriever,
+        response_synthesizer=query_engine._response_synthesizer,
+        callback_manager=query_engine.callback_manager,
+        text_splitter=query_engine.text_splitter,
+        node_postprocessors=query_engine._node_postprocessors,
+        metadata_mode=query_engine._metadata_mode,
+    )
+
+
 def replace_with_identifiers(s, existing_mapping=None):
     # Initialize a counter
     mapping = existing_mapping if existing_mapping is not None else {}
@@ -0,0 +1,146 @@
+"""
+A small disk-backed key/value cache on top of sqlite3 with LRU eviction.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional
+
+# Fraction of max_entries evicted at once, so that eviction is not run on every insert
+EVICTION_FRACTION = 0.05
+# sqlite limits the number of variables in a single statement
+MAX_SQL_VARIABLES = 900
+
+
+class SqliteLRUCache:
+    """
+    Persistent key/value store of bytes, shared by every process using the same path.
+
+    Every read refreshes the last access time of the entry. When the number of entries
+    exceeds max_entries, the least recently used entries are evicted.
+
+    The number of entries is counted once when the cache is opened and then kept up to date in
+    memory, counting the table is a full scan. Entries added by other processes are only seen
+    when the count is refreshed, before evicting.
+
+    :param path: Path to the sqlite database file.
+    :param max_entries: Maximum number of entries to keep. If None, the cache is unbounded.
+    """
+
+    def __init__(self, path: str, max_entries: Optional[int] = None) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value BLOB, last_access REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)"
+        )
+        self._conn.commit()
+        self._num_entries = self._count()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, bytes]:
+        """
+        Looks up several keys at once.
+
+        :return: {key: value} for the keys found in the cache.
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), MAX_SQL_VARIABLES):
+                batch = keys[start : start + MAX_SQL_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE cache SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key: str, value: bytes) -> None:
+        self.set_many({key: value})
+
+    def set_many(self, items: dict[str, bytes]) -> None:
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._num_entries += len(items) - self._count_existing(list(items))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, last_access) VALUES (?, ?, ?)",
+                [(key, sqlite3.Binary(value), now) for key, value in items.items()],
+            )
+            self._conn.commit()
+            if self.max_entries is not None and self._num_entries > self.max_entries:
+                self._evict()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+            self._num_entries -= cursor.rowcount
+
+    def _count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def _count_existing(self, keys: list) -> int:
+        # Number of keys already in the cache, looked up with the primary key index
+        num_existing = 0
+        for start in range(0, len(keys), MAX_SQL_VARIABLES):
+            batch = keys[start : start + MAX_SQL_VARIABLES]
+            placeholders = ",".join("?" * len(batch))
+            num_existing += self._conn.execute(
+                f"SELECT COUNT(*) FROM cache WHERE key IN ({placeholders})", batch
+            ).fetchone()[0]
+        return num_existing
+
+    def _evict(self) -> None:
+        # Must be called with the lock held. The count is refreshed first, other processes
+        # may have added or evicted entries
+        self._num_entries = self._count()
+        if self._num_entries <= self.max_entries:
+            return
+        num_evicted = self._num_entries - self.max_entries
+        num_evicted += int(self.max_entries * EVICTION_FRACTION)
+        cursor = self._conn.execute(
+            "DELETE FROM cache WHERE key IN "
+            "(SELECT key FROM cache ORDER BY last_access LIMIT ?)",
+            (num_evicted,),
+        )
+        self._conn.commit()
+        self._num_entries -= cursor.rowcount
+
+    def __len__(self) -> int:
+        return self._num_entries
+
+    @property
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+        }
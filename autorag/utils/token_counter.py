@@ -0,0 +1,75 @@
+"""
+Token counting for chunking and token budgets, compatible with the tokenizer of the OpenAI models.
+"""
+
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+from llama_index.core.utils import get_tokenizer
+
+# Number of strings whose token count is memoized
+DEFAULT_CACHE_SIZE = 1 << 14
+# Longer strings are rarely repeated, they are not memoized to bound the cache memory
+DEFAULT_MAX_CACHED_LENGTH = 1024
+
+
+class TokenCounter:
+    """
+    Counts the tokens of strings, memoizing the counts of recently seen short strings
+    (e.g. repeated table cells and rows).
+
+    :param tokenizer: Callable returning the tokens of a string. If None, the tiktoken tokenizer
+                      of llama_index is used (cl100k_base, the encoding of the OpenAI embedding
+                      and chat models).
+    :param cache_size: Maximum number of memoized counts.
+    :param max_cached_length: Strings longer than this are counted without being memoized.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Optional[Callable[[str], List]] = None,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        max_cached_length: int = DEFAULT_MAX_CACHED_LENGTH,
+    ) -> None:
+        self.tokenizer = tokenizer or get_tokenizer()
+        self.max_cached_length = max_cached_length
+        self._cached_count = lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text: str) -> int:
+        return len(self.tokenizer(text))
+
+    def count(self, text: str) -> int:
+        if len(text) > self.max_cached_length:
+            return self._count(text)
+        return self._cached_count(text)
+
+    def __call__(self, text: str) -> int:
+        return self.count(text)
+
+    @property
+    def stats(self) -> dict:
+        cache_info = self._cached_count.cache_info()
+        lookups = cache_info.hits + cache_info.misses
+        return {
+            "hits": cache_info.hits,
+            "misses": cache_info.misses,
+            "hit_rate": round(cache_info.hits / lookups, 4) if lookups else 0.0,
+            "entries": cache_info.currsize,
+        }
+
+
+_token_counter: Optional[TokenCounter] = None
+
+
+def get_token_counter() -> TokenCounter:
+    """The token counter shared by the project, created on first use."""
+    global _token_counter
+    if _token_counter is None:
+        _token_counter = TokenCounter()
+    return _token_counter
+
+
+def set_token_counter(token_counter: TokenCounter) -> None:
+    """Replaces the shared token counter, e.g. with the tokenizer of another model."""
+    global _token_counter
+    _token_counter = token_counter
@@ -19,4 +19,8 @@ setup(
         "flask==3.1.0",
         "flask_cors==5.0.0",
     ],
+    extras_require={
+        # Faster parsing of the Azure output files
+        "fast_json": ["orjson>=3.9"],
+    },
 )
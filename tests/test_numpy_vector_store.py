@@ -0,0 +1,51 @@
+import numpy as np
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from autorag.indexer.vector_stores.numpy_vector_store import NumpyVectorStore
+
+
+def build_store(vectors, **kwargs):
+    store = NumpyVectorStore(**kwargs)
+    store.add(
+        [
+            TextNode(id_=f"n{i}", text="", embedding=vector.tolist())
+            for i, vector in enumerate(vectors)
+        ]
+    )
+    return store
+
+
+def test_ivf_matches_exact_search_when_all_clusters_are_probed():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((50, 16)).astype(np.float32)
+    exact = build_store(vectors)
+    ivf = build_store(vectors, ann_type="ivf", nlist=4, nprobe=16)
+    for query_vector in rng.standard_normal((10, 16)):
+        query = VectorStoreQuery(
+            query_embedding=query_vector.tolist(), similarity_top_k=3
+        )
+        exact_result = exact.query(query)
+        ivf_result = ivf.query(query)
+        assert ivf_result.ids == exact_result.ids
+        np.testing.assert_allclose(
+            ivf_result.similarities, exact_result.similarities, rtol=1e-5
+        )
+
+
+def test_unsorted_node_ids_covering_all_rows():
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((20, 8)).astype(np.float32)
+    store = build_store(vectors, dtype="float16")
+    query_vector = rng.standard_normal(8).tolist()
+    exact_result = store.query(
+        VectorStoreQuery(query_embedding=query_vector, similarity_top_k=5)
+    )
+    filtered_result = store.query(
+        VectorStoreQuery(
+            query_embedding=query_vector,
+            similarity_top_k=5,
+            node_ids=[f"n{i}" for i in reversed(range(20))],
+        )
+    )
+    assert filtered_result.ids == exact_result.ids
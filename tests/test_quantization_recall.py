@@ -0,0 +1,91 @@
+import numpy as np
+from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.evaluation import EmbeddingQAFinetuneDataset
+from llama_index.core.schema import TextNode
+
+from autorag.indexer.vector_stores.numpy_vector_store import NumpyVectorStore
+from autorag.retriever.evaluate import evaluate_retriever
+
+NUM_NODES = 2000
+DIM = 128
+NUM_QUERIES = 300
+SIMILARITY_TOP_K = 5
+METRICS = ["hit_rate", "mrr"]
+# Tolerances stated in the NumpyVectorStore docstring
+TOLERANCES = {"int8": 0.01, "binary": 0.02}
+
+
+class QueryVectorEmbedding(MockEmbedding):
+    """Returns the precomputed vector of each query."""
+
+    query_vectors: dict
+
+    def _get_query_embedding(self, query):
+        return self.query_vectors[query]
+
+    async def _aget_query_embedding(self, query):
+        return self.query_vectors[query]
+
+
+def build_benchmark(seed=0):
+    """
+    Documents drawn around topic centroids, so that their neighbours are close competitors, and
+    queries that are noisy copies of one document each, with exact search hit_rate well below 1.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((NUM_NODES // 50, DIM))
+    vectors = centroids[rng.integers(0, len(centroids), NUM_NODES)]
+    vectors = vectors + 0.5 * rng.standard_normal((NUM_NODES, DIM))
+    nodes = [
+        TextNode(id_=f"n{i}", text=f"node {i}", embedding=vector.tolist())
+        for i, vector in enumerate(vectors)
+    ]
+    relevant = rng.choice(NUM_NODES, NUM_QUERIES, replace=False)
+    query_vectors, queries, relevant_docs = {}, {}, {}
+    for qid, i in enumerate(relevant):
+        query = f"query {qid}"
+        query_vectors[query] = (vectors[i] + 3.0 * rng.standard_normal(DIM)).tolist()
+        queries[str(qid)] = query
+        relevant_docs[str(qid)] = [f"n{i}"]
+    qa_data = EmbeddingQAFinetuneDataset(
+        queries=queries, corpus={}, relevant_docs=relevant_docs
+    )
+    return (
+        nodes,
+        qa_data,
+        QueryVectorEmbedding(embed_dim=DIM, query_vectors=query_vectors),
+    )
+
+
+def evaluate_store(nodes, qa_data, embed_model, **vector_store_kwargs):
+    index = VectorStoreIndex(
+        nodes,
+        storage_context=StorageContext.from_defaults(
+            vector_store=NumpyVectorStore(**vector_store_kwargs)
+        ),
+        embed_model=embed_model,
+    )
+    retriever = index.as_retriever(similarity_top_k=SIMILARITY_TOP_K)
+    return evaluate_retriever(retriever, qa_data, METRICS)
+
+
+def test_quantized_search_stays_within_the_stated_tolerance():
+    nodes, qa_data, embed_model = build_benchmark()
+    exact = evaluate_store(nodes, qa_data, embed_model)
+    assert exact["hit_rate"] < 0.8
+    for quantization, tolerance in TOLERANCES.items():
+        quantized = evaluate_store(
+            nodes,
+            qa_data,
+            embed_model,
+            quantization=quantization,
+            rescore_candidates=100 * SIMILARITY_TOP_K,
+        )
+        for metric in METRICS:
+            assert abs(quantized[metric] - exact[metric]) <= tolerance, (
+                quantization,
+                metric,
+                quantized,
+                exact,
+            )